@@ -0,0 +1,119 @@
+"""Synthetic fixtures for the benchmarks: OpenSSH keys and certificates, and stub 'tofu'/'vault' executables.
+
+Certificates are assembled in the OpenSSH wire format (PROTOCOL.certkeys) with a random nonce,
+key and signature. Nothing in the benchmarks verifies signatures, so no CA or ssh-keygen is needed.
+"""
+
+import base64
+import os
+import stat
+import struct
+import sys
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SSH_CERT_TYPE_USER = 1
+ED25519_KEY_TYPE = "ssh-ed25519"
+ED25519_CERT_TYPE = "ssh-ed25519-cert-v01@openssh.com"
+
+
+def _ssh_string(value):
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+    return struct.pack(">I", len(value)) + value
+
+
+def make_ssh_public_key(comment="benchmark"):
+    """Returns a random ed25519 public key line ('ssh-ed25519 <base64> comment')."""
+    blob = _ssh_string(ED25519_KEY_TYPE) + _ssh_string(os.urandom(32))
+    return f"{ED25519_KEY_TYPE} {base64.b64encode(blob).decode('ascii')} {comment}"
+
+
+def make_ssh_certificate(public_key_line, principals, valid_after, valid_before, serial=1, key_id="benchmark"):
+    """Returns an ed25519 user certificate line for public_key_line.
+
+    valid_after and valid_before are Unix timestamps; the CA key and signature are random bytes.
+    """
+    key_type, key_base64 = public_key_line.split()[:2]
+    if key_type != ED25519_KEY_TYPE:
+        raise ValueError(f"only {ED25519_KEY_TYPE} keys are supported, not '{key_type}'")
+    key_blob = base64.b64decode(key_base64)
+    # The plain key blob is string(key type) + string(key); the certificate repeats only the key
+    public_key = key_blob[len(_ssh_string(ED25519_KEY_TYPE)):]
+
+    ca_key = _ssh_string(ED25519_KEY_TYPE) + _ssh_string(os.urandom(32))
+    signature = _ssh_string(ED25519_KEY_TYPE) + _ssh_string(os.urandom(64))
+    blob = b"".join([
+        _ssh_string(ED25519_CERT_TYPE),
+        _ssh_string(os.urandom(32)),                                  # nonce
+        public_key,
+        struct.pack(">QI", serial, SSH_CERT_TYPE_USER),
+        _ssh_string(key_id),
+        _ssh_string(b"".join(_ssh_string(principal) for principal in principals)),
+        struct.pack(">QQ", int(valid_after), int(valid_before)),
+        _ssh_string(b""),                                             # critical options
+        _ssh_string(_ssh_string("permit-pty") + _ssh_string(b"")),    # extensions
+        _ssh_string(b""),                                             # reserved
+        _ssh_string(ca_key),
+        _ssh_string(signature),
+    ])
+    return f"{ED25519_CERT_TYPE} {base64.b64encode(blob).decode('ascii')} {key_id}"
+
+
+def write_key_pair(directory, name="id_ed25519"):
+    """Writes a synthetic public key to directory and returns its path."""
+    path = os.path.join(directory, f"{name}.pub")
+    with open(path, "w") as f:
+        f.write(make_ssh_public_key() + "\n")
+    return path
+
+
+def write_certificate(path, public_key_path, principals, ttl_seconds):
+    """Writes a certificate for public_key_path valid from a minute ago for ttl_seconds (negative: already expired)."""
+    with open(public_key_path, "r") as f:
+        public_key_line = f.read()
+    now = int(time.time())
+    with open(path, "w") as f:
+        f.write(make_ssh_certificate(public_key_line, principals, now - 60, now + ttl_seconds) + "\n")
+    return path
+
+
+def _write_executable(path, content):
+    with open(path, "w") as f:
+        f.write(content)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return path
+
+
+def write_stub_tofu(bin_dir, show_json_path):
+    """Writes a 'tofu' that prints show_json_path for 'tofu show -json', like a real tofu with that state."""
+    return _write_executable(os.path.join(bin_dir, "tofu"), f"""#!/bin/sh
+if [ "$1" = "show" ]; then
+    exec cat '{show_json_path}'
+fi
+echo "stub tofu: unsupported command: $*" >&2
+exit 1
+""")
+
+
+def write_stub_vault(bin_dir, calls_log_path, delay_seconds=0.0, ttl_seconds=7200):
+    """Writes a 'vault' that answers 'vault write -field=signed_key <sign path> public_key=@<file> valid_principals=<p>'.
+
+    It sleeps delay_seconds to stand in for Vault's latency, issues a synthetic certificate valid for
+    ttl_seconds and appends one line per call to calls_log_path, so callers can count signing requests.
+    """
+    return _write_executable(os.path.join(bin_dir, "vault"), f"""#!{sys.executable}
+import os, sys, time
+sys.path.insert(0, {BENCHMARKS_DIR!r})
+from fixtures import make_ssh_certificate
+
+args = dict(arg.split("=", 1) for arg in sys.argv[1:] if "=" in arg and not arg.startswith("-"))
+with open(args["public_key"].lstrip("@")) as f:
+    public_key_line = f.read()
+time.sleep({float(delay_seconds)!r})
+with open({calls_log_path!r}, "a") as log:
+    log.write(f"{{os.getpid()}}\\n")
+now = int(time.time())
+print(make_ssh_certificate(public_key_line, args["valid_principals"].split(","), now - 60, now + {int(ttl_seconds)!r}))
+""")
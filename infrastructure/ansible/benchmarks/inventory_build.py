@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""Synthetic benchmark for the dynamic inventory builder.
+
+Generates 'tofu show -json' documents with N ansible_host resources spread over
+deeply nested child modules and a few large groups, times the inventory build and
+checks that the cost per host stays flat as N grows (i.e. the build is linear).
+
+Usage (from infrastructure/ansible):
+    python3 benchmarks/inventory_build.py
+    python3 benchmarks/inventory_build.py --sizes 10000 50000 --depth 12
+"""
+
+import argparse
+import gc
+import importlib.util
+import os
+import sys
+import time
+
+INVENTORY_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "inventories", "dynamic_inventory.py")
+
+
+def load_inventory_module():
+    """Imports inventories/dynamic_inventory.py, which is a script rather than a package module."""
+    spec = importlib.util.spec_from_file_location("dynamic_inventory", INVENTORY_SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def generate_tofu_state(host_count, depth, groups_per_host=2, group_count=4, hosts_per_module=50):
+    """Returns a synthetic 'tofu show -json' document with host_count ansible_host resources.
+
+    Hosts are packed hosts_per_module per module, and modules are chained depth levels
+    deep before a new branch is started from the root. A handful of groups are shared by
+    every host, so each group ends up with thousands of members.
+    """
+    root_module = {"resources": [], "child_modules": []}
+    branch_parent = root_module
+    level = 0
+    module_index = 0
+    for start in range(0, host_count, hosts_per_module):
+        if level == depth:
+            branch_parent, level = root_module, 0
+        module = {
+            "address": f"{branch_parent.get('address', '')}.module.vm{module_index}".lstrip("."),
+            "resources": [],
+            "child_modules": [],
+        }
+        for host_index in range(start, min(start + hosts_per_module, host_count)):
+            groups = [f"group{(host_index + offset) % group_count}" for offset in range(groups_per_host)]
+            module["resources"].append({
+                "address": f"{module['address']}.ansible_host.host[{host_index}]",
+                "mode": "managed",
+                "type": "ansible_host",
+                "name": "host",
+                "values": {
+                    "name": f"host-{host_index:06d}",
+                    "groups": groups,
+                    "variables": {
+                        "ansible_host": f"10.{host_index >> 16 & 255}.{host_index >> 8 & 255}.{host_index & 255}",
+                        "vault_ssh_ca_signing_role": "Monorepo-AI-Powered-prod/ssh/roles/default-role",
+                        "vault_ssh_ca_principal": "ansible",
+                        "ansible_ssh_jumphost": f"jumphost-{host_index % 3}",
+                    },
+                },
+            })
+        branch_parent["child_modules"].append(module)
+        branch_parent = module
+        level += 1
+        module_index += 1
+    return {"format_version": "1.0", "values": {"root_module": root_module}}
+
+
+def time_build(dynamic_inventory, tofu_state, repeat):
+    """Returns the best wall-clock time of repeat inventory builds.
+
+    Like timeit, the cyclic garbage collector is paused while timing: its full
+    collections scale with every object alive in the process (including the synthetic
+    state itself) and would otherwise mask the builder's own complexity.
+    """
+    best = None
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            started = time.perf_counter()
+            dynamic_inventory.build_inventory(tofu_state)
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the dynamic inventory build on synthetic states.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 50000], help="Host counts to benchmark.")
+    parser.add_argument("--depth", type=int, default=8, help="Module nesting depth.")
+    parser.add_argument("--repeat", type=int, default=3, help="Builds per size; the best time is reported.")
+    parser.add_argument("--max-ratio", type=float, default=2.0,
+                        help="Fail if the per-host cost of the largest size exceeds the smallest by this factor.")
+    args = parser.parse_args()
+
+    dynamic_inventory = load_inventory_module()
+    per_host = {}
+    for size in sorted(args.sizes):
+        tofu_state = generate_tofu_state(size, args.depth)
+        elapsed = time_build(dynamic_inventory, tofu_state, args.repeat)
+        per_host[size] = elapsed / size
+        print(f"{size:>7} hosts: {elapsed * 1000:9.1f} ms total, {per_host[size] * 1e6:6.2f} us/host")
+
+    smallest, largest = min(per_host), max(per_host)
+    ratio = per_host[largest] / per_host[smallest]
+    print(f"per-host cost ratio {largest}/{smallest}: {ratio:.2f} (limit {args.max_ratio})")
+    if ratio > args.max_ratio:
+        print("Error: inventory build does not scale linearly.", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
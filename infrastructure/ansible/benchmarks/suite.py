@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+"""Benchmark suite for the dynamic inventory script and the vault_ssh_signer connection plugin.
+
+Everything runs on synthetic fixtures (see fixtures.py): 'tofu show -json' documents with
+1k-50k ansible_host resources in several shapes, OpenSSH certificates, and stub 'tofu' and
+'vault' executables, so neither OpenTofu nor Vault is needed. Results are written as JSON;
+pass an earlier result file as --baseline to flag regressions.
+
+Benchmarks:
+    inventory_build   build_inventory() on an in-memory state, per size and shape
+    json_serialize    json.dumps() of the built inventory, as '--list' prints it
+    json_compact      the '--list --compact' rendering: shared-variable hoisting plus compact JSON
+    inventory_cli     'dynamic_inventory.py --list' end to end, reading the stub tofu's output
+    cert_freshness    Connection._is_cert_fresh() with a warm and a cold certificate cache
+    renewal_forks     N forks connecting with one expired certificate, through the stub vault
+
+Usage (from infrastructure/ansible):
+    python3 benchmarks/suite.py --output benchmark-results.json
+    python3 benchmarks/suite.py --only inventory_build json_serialize --sizes 1000 10000
+    python3 benchmarks/suite.py --baseline benchmark-results.json --max-regression 1.25
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fixtures  # noqa: E402
+from inventory_build import INVENTORY_SCRIPT, generate_tofu_state, load_inventory_module, time_build  # noqa: E402
+
+ANSIBLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+CONNECTION_PLUGINS_DIR = os.path.join(ANSIBLE_DIR, "plugins", "connection")
+
+BENCHMARKS = ("inventory_build", "json_serialize", "json_compact", "inventory_cli", "cert_freshness", "renewal_forks")
+
+# Inventory shapes: (module nesting depth, groups per host, distinct groups)
+SHAPES = {
+    "flat": (1, 1, 4),
+    "nested": (12, 2, 16),
+    "fanout": (4, 6, 256),
+}
+
+SIGNING_ROLE = "benchmark/ssh/roles/default-role"
+PRINCIPAL = "ansible"
+
+
+def best_of(repeat, func):
+    """Returns the best wall-clock time of repeat calls to func."""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_inventory(results, args, work_dir):
+    dynamic_inventory = load_inventory_module()
+    for shape in args.shapes:
+        depth, groups_per_host, group_count = SHAPES[shape]
+        for size in args.sizes:
+            tofu_state = generate_tofu_state(size, depth, groups_per_host=groups_per_host, group_count=group_count)
+            params = {"hosts": size, "shape": shape, "depth": depth, "groups_per_host": groups_per_host, "groups": group_count}
+
+            if "inventory_build" in args.only:
+                seconds = time_build(dynamic_inventory, tofu_state, args.repeat)
+                record(results, "inventory_build", params, seconds, per_item=size)
+
+            if "json_serialize" in args.only or "json_compact" in args.only:
+                inventory = dynamic_inventory.build_inventory(tofu_state)
+            if "json_serialize" in args.only:
+                seconds = best_of(args.repeat, lambda: json.dumps(inventory, indent=2))
+                record(results, "json_serialize", params, seconds, per_item=size)
+            if "json_compact" in args.only:
+                seconds = best_of(args.repeat, lambda: dynamic_inventory.render_inventory(inventory, compact=True))
+                record(results, "json_compact", params, seconds, per_item=size,
+                       bytes=len(dynamic_inventory.render_inventory(inventory, compact=True)),
+                       indented_bytes=len(json.dumps(inventory, indent=2)))
+
+            if "inventory_cli" in args.only:
+                seconds = time_inventory_cli(tofu_state, args.repeat, work_dir)
+                record(results, "inventory_cli", params, seconds, per_item=size)
+
+
+def time_inventory_cli(tofu_state, repeat, work_dir):
+    """Times 'dynamic_inventory.py --list' with the state served by a stub tofu and the cache disabled."""
+    run_dir = tempfile.mkdtemp(dir=work_dir)
+    bin_dir = os.path.join(run_dir, "bin")
+    tofu_dir = os.path.join(run_dir, "tofu")
+    os.makedirs(bin_dir)
+    os.makedirs(tofu_dir)
+    show_json_path = os.path.join(run_dir, "show.json")
+    with open(show_json_path, "w") as f:
+        json.dump(tofu_state, f)
+    fixtures.write_stub_tofu(bin_dir, show_json_path)
+
+    env = dict(os.environ,
+               PATH=bin_dir + os.pathsep + os.environ.get("PATH", ""),
+               TOFU_INVENTORY_DIR=tofu_dir,
+               TOFU_INVENTORY_STATE_SOURCE="tofu",
+               TOFU_INVENTORY_CACHE_TTL="0")
+    env.pop("TOFU_INVENTORY_SOURCES", None)
+
+    def run():
+        subprocess.run([sys.executable, INVENTORY_SCRIPT, "--list"], env=env, check=True,
+                       stdout=subprocess.DEVNULL, stdin=subprocess.DEVNULL)
+
+    seconds = best_of(repeat, run)
+    shutil.rmtree(run_dir)
+    return seconds
+
+
+def load_connection_plugin():
+    """Returns a function creating configured vault_ssh_signer Connections, or None without Ansible."""
+    try:
+        from ansible.playbook.play_context import PlayContext
+        from ansible.plugins.loader import connection_loader
+    except ImportError:
+        return None
+    connection_loader.add_directory(CONNECTION_PLUGINS_DIR)
+
+    def make_connection(**options):
+        play_context = PlayContext()
+        play_context.remote_addr = "10.0.0.1"
+        connection = connection_loader.get("vault_ssh_signer", play_context, None)
+        connection.set_options(direct=dict({
+            "host": "10.0.0.1",
+            "vault_ssh_ca_signing_role": SIGNING_ROLE,
+            "vault_ssh_ca_principal": PRINCIPAL,
+            "counters_file": "",
+            "timings_file": "",
+        }, **options))
+        connection._load_config()
+        return connection
+
+    return make_connection
+
+
+def bench_cert_freshness(results, args, work_dir, make_connection):
+    key_dir = tempfile.mkdtemp(dir=work_dir)
+    public_key_path = fixtures.write_key_pair(key_dir)
+    cert_path = fixtures.write_certificate(os.path.join(key_dir, "id_ed25519-cert.pub"), public_key_path, [PRINCIPAL], 7200)
+    connection = make_connection(public_key_path=public_key_path, signed_key_path=cert_path)
+    connection_class = type(connection)
+    checks = args.freshness_checks
+
+    def warm():
+        for _ in range(checks):
+            connection._is_cert_fresh()
+
+    def cold():
+        # A new worker process: nothing parsed yet, the status sidecar is still on disk
+        for _ in range(checks):
+            connection_class._cert_status_cache.clear()
+            connection._is_cert_fresh()
+
+    is_fresh, reason = connection._is_cert_fresh()
+    if not is_fresh:
+        raise RuntimeError(f"synthetic certificate is not fresh: {reason}")
+    record(results, "cert_freshness", {"cache": "warm", "checks": checks}, best_of(args.repeat, warm), per_item=checks)
+    record(results, "cert_freshness", {"cache": "cold", "checks": checks}, best_of(args.repeat, cold), per_item=checks)
+
+
+def _connect_in_fork(make_connection, options, start_event):
+    # The plugin reports renewals on stdout, which carries the JSON report
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    start_event.wait()
+    make_connection(**options)._connect()
+
+
+def bench_renewal_forks(results, args, work_dir, make_connection):
+    for forks in args.forks:
+        run_dir = tempfile.mkdtemp(dir=work_dir)
+        bin_dir = os.path.join(run_dir, "bin")
+        os.makedirs(bin_dir)
+        calls_log_path = os.path.join(run_dir, "vault-calls.log")
+        fixtures.write_stub_vault(bin_dir, calls_log_path, delay_seconds=args.vault_delay)
+        public_key_path = fixtures.write_key_pair(run_dir)
+        cert_path = fixtures.write_certificate(os.path.join(run_dir, "id_ed25519-cert.pub"), public_key_path, [PRINCIPAL], -3600)
+        options = {
+            "public_key_path": public_key_path,
+            "signed_key_path": cert_path,
+            "vault_client": "cli",
+            "control_path_dir": os.path.join(run_dir, "cp"),
+        }
+
+        saved_env = dict(os.environ)
+        os.environ["PATH"] = bin_dir + os.pathsep + os.environ.get("PATH", "")
+        # Only the stub is called ('vault_client: cli'); the address just keeps the plugin from warning
+        os.environ.setdefault("VAULT_ADDR", "http://127.0.0.1:8200")
+        try:
+            # Forked like Ansible's workers, all released at once to race for the renewal
+            context = multiprocessing.get_context("fork")
+            start_event = context.Event()
+            processes = [context.Process(target=_connect_in_fork, args=(make_connection, options, start_event))
+                         for _ in range(forks)]
+            for process in processes:
+                process.start()
+            started = time.perf_counter()
+            start_event.set()
+            for process in processes:
+                process.join()
+            seconds = time.perf_counter() - started
+        finally:
+            os.environ.clear()
+            os.environ.update(saved_env)
+
+        failed = sum(1 for process in processes if process.exitcode != 0)
+        vault_calls = 0
+        if os.path.exists(calls_log_path):
+            with open(calls_log_path, "r") as f:
+                vault_calls = sum(1 for _ in f)
+        record(results, "renewal_forks", {"forks": forks, "vault_delay": args.vault_delay}, seconds,
+               vault_calls=vault_calls, failed_forks=failed)
+        shutil.rmtree(run_dir)
+
+
+def record(results, name, params, seconds, per_item=None, **extra):
+    """Adds a result under a key naming the benchmark and its parameters, and prints it."""
+    key = f"{name}[{','.join(f'{k}={v}' for k, v in params.items())}]"
+    entry = {"benchmark": name, "params": params, "seconds": round(seconds, 6)}
+    if per_item:
+        entry["us_per_item"] = round(seconds / per_item * 1e6, 3)
+    entry.update(extra)
+    results[key] = entry
+    details = "".join(f", {k}={v}" for k, v in extra.items())
+    per_item_text = f", {entry['us_per_item']:.2f} us/item" if per_item else ""
+    print(f"{key:<72} {seconds * 1000:10.1f} ms{per_item_text}{details}", file=sys.stderr)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ANSIBLE_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path, max_regression):
+    """Prints the ratio to a baseline result file per benchmark; returns the keys slower than max_regression."""
+    with open(baseline_path, "r") as f:
+        baseline = json.load(f).get("results", {})
+    regressions = []
+    for key, entry in results.items():
+        previous = baseline.get(key)
+        if not previous or not previous.get("seconds"):
+            continue
+        ratio = entry["seconds"] / previous["seconds"]
+        marker = "  REGRESSION" if ratio > max_regression else ""
+        print(f"{key:<72} {ratio:6.2f}x baseline{marker}", file=sys.stderr)
+        if ratio > max_regression:
+            regressions.append(key)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the inventory script and the vault_ssh_signer plugin on synthetic fixtures.")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, default=list(BENCHMARKS), help="Benchmarks to run (default: all).")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000], help="Host counts of the synthetic states.")
+    parser.add_argument("--shapes", nargs="+", choices=sorted(SHAPES), default=sorted(SHAPES),
+                        help="State shapes: 'flat' (1 level, 4 groups), 'nested' (12 levels), 'fanout' (6 of 256 groups per host).")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per benchmark; the best time is reported.")
+    parser.add_argument("--freshness-checks", type=int, default=1000, help="Freshness checks per cert_freshness run.")
+    parser.add_argument("--forks", type=int, nargs="+", default=[1, 8, 32], help="Concurrent forks for renewal_forks.")
+    parser.add_argument("--vault-delay", type=float, default=0.2, help="Seconds the stub vault takes per signing request.")
+    parser.add_argument("--output", help="Write the results to this JSON file (default: stdout).")
+    parser.add_argument("--baseline", help="Earlier result file to compare against.")
+    parser.add_argument("--max-regression", type=float, default=1.25,
+                        help="With --baseline, fail if a benchmark is slower than the baseline by more than this factor.")
+    args = parser.parse_args()
+
+    results = {}
+    work_dir = tempfile.mkdtemp(prefix="ansible-benchmarks-")
+    try:
+        if {"inventory_build", "json_serialize", "json_compact", "inventory_cli"} & set(args.only):
+            bench_inventory(results, args, work_dir)
+
+        if {"cert_freshness", "renewal_forks"} & set(args.only):
+            make_connection = load_connection_plugin()
+            if make_connection is None:
+                print("Warning: Ansible is not importable; skipping the connection plugin benchmarks.", file=sys.stderr)
+            else:
+                if "cert_freshness" in args.only:
+                    bench_cert_freshness(results, args, work_dir, make_connection)
+                if "renewal_forks" in args.only:
+                    bench_renewal_forks(results, args, work_dir, make_connection)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.max_regression)
+        if regressions:
+            print(f"Error: {len(regressions)} benchmark(s) regressed by more than {args.max_regression}x.", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
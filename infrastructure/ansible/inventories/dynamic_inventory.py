@@ -1,10 +1,61 @@
 #!/usr/bin/env python3
 
+import argparse
+import codecs
+import concurrent.futures
+import fnmatch
+import functools
+import hashlib
+import ipaddress
 import json
 import sys
 import os
+import re
 import subprocess
-import time # Import time for potential future use (e.g., caching tofu state)
+import tempfile
+import time
+import urllib.parse
+from collections import namedtuple
+
+try:
+    import sqlite3
+except ImportError:
+    # Python built without SQLite: '--host' then reads the cached inventory instead of the host index
+    sqlite3 = None
+
+# Directory holding the OpenTofu root whose state is turned into an inventory.
+# Assuming the script lives in the ansible/inventories directory, we need to go
+# up two levels and then into opentofu.
+DEFAULT_TOFU_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "opentofu")
+
+# Rendered inventories are cached next to the other Ansible runtime files
+# (.ansible is git-ignored) so repeated invocations don't re-run 'tofu show -json'.
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".ansible", "inventory_cache")
+DEFAULT_CACHE_TTL_SECONDS = 300
+CACHE_FORMAT_VERSION = 1
+
+# Upper bound on concurrent state fetches when several sources are configured.
+DEFAULT_MAX_WORKERS = 4
+
+# Targets behind a jumphost reach it through one shared, multiplexed ssh master per jumphost
+# (TOFU_INVENTORY_JUMPHOST_PERSIST, TOFU_INVENTORY_JUMPHOST_CONTROL_DIR) instead of a ProxyJump hop each.
+DEFAULT_JUMPHOST_CONTROL_PERSIST = "60s"
+DEFAULT_JUMPHOST_CONTROL_DIR = "~/.ansible/cp"
+JUMPHOST_WARMUP_MAX_WORKERS = 16
+JUMPHOST_WARMUP_TIMEOUT_SECONDS = 30
+
+# Only the head of a state file is read to identify it; 'serial' and 'lineage'
+# are written near the top of every v4 state document.
+STATE_HEAD_BYTES = 4096
+STATE_SERIAL_REGEX = re.compile(r'"serial"\s*:\s*(\d+)')
+STATE_LINEAGE_REGEX = re.compile(r'"lineage"\s*:\s*"([^"]*)"')
+
+# One ansible_host resource, as yielded by the state walkers.
+HostRecord = namedtuple("HostRecord", ["module_address", "host_name", "groups", "variables"])
+
+# One OpenTofu root/workspace of a multi-source inventory (TOFU_INVENTORY_SOURCES).
+TofuSource = namedtuple("TofuSource", ["label", "tofu_dir", "workspace"])
+
 
 def find_executable(name):
     """Searches for the executable in the directories listed in the PATH."""
@@ -15,56 +66,308 @@ def find_executable(name):
             return executable_path
     return None
 
-def find_ansible_hosts(module_data, inventory):
-    """Recursively finds ansible_host resources in module data and adds them to inventory."""
-    # Check resources directly in this module
-    for resource in module_data.get("resources", []):
-        if resource.get("type") == "ansible_host":
-            host_name = resource.get("values", {}).get("name")
-            groups = resource.get("values", {}).get("groups", [])
-            variables = resource.get("values", {}).get("variables", {})
-
-            if host_name:
-                # Add host-specific variables to _meta.hostvars
-                host_vars = {
-                    "ansible_host": host_name, # Ensure ansible_host is set
-                    "ansible_user": "ansible", # Default user based on cloud-init
-
-                    # Add other variables from the tofu resource
-                    **variables
-                }
-
-                # Check for ansible_ssh_jumphost and add ProxyJump if present
-                if "ansible_ssh_jumphost" in variables and variables["ansible_ssh_jumphost"]:
-                    # Construct the ProxyJump command using the jumphost variable and ansible_user
-                    # Assumes the local SSH agent is configured with the Vault-signed cert for the jumphost user
-                    host_vars["ansible_ssh_common_args"] = f'-J {host_vars["ansible_user"]}@{variables["ansible_ssh_jumphost"]}'
-
-                # Add host-specific variables to _meta.hostvars
-                inventory["_meta"]["hostvars"][host_name] = host_vars
-
-                # Add the host to its respective groups
-                if not groups:
-                    # Add to 'ungrouped' if no groups are specified
-                    if "ungrouped" not in inventory:
-                        inventory["ungrouped"] = {"hosts": []}
-                    if host_name not in inventory["ungrouped"]["hosts"]:
-                        inventory["ungrouped"]["hosts"].append(host_name)
-                else:
-                    for group in groups:
-                        if group not in inventory:
-                            inventory[group] = {
-                                "hosts": []
-                            }
-                        if host_name not in inventory[group]["hosts"]:
-                            inventory[group]["hosts"].append(host_name)
-
-    # Recursively check child modules
-    for child_module in module_data.get("child_modules", []):
-        find_ansible_hosts(child_module, inventory)
+class InventoryBuilder:
+    """Accumulates hosts and group memberships behind dict-backed indexes.
 
+    Each group's members are kept in an insertion-ordered dict used as an ordered set,
+    so adding a host costs O(groups of that host) instead of a scan of every group's
+    host list, and the rendered inventory keeps a deterministic first-seen order.
+    """
 
-def main():
+    def __init__(self):
+        self.hostvars = {}
+        # 'ungrouped' always exists and is always the first child of 'all'
+        self.groups = {"ungrouped": {}}
+
+    def add_host(self, host_name, host_vars, groups):
+        """Adds (or replaces) a host's variables and adds it to its groups (or 'ungrouped')."""
+        self.hostvars[host_name] = host_vars
+        for group in groups or ("ungrouped",):
+            members = self.groups.get(group)
+            if members is None:
+                members = self.groups[group] = {}
+            members[host_name] = None
+
+    def build(self):
+        """Renders the Ansible inventory dict."""
+        inventory = {
+            "_meta": {
+                "hostvars": self.hostvars
+            },
+            # Ensure all found groups are children of 'all'
+            "all": {
+                "children": [group for group in self.groups if group not in ("all", "_meta")]
+            },
+        }
+        for group_name, members in self.groups.items():
+            if group_name == "_meta":
+                continue
+            if group_name == "all":
+                inventory["all"]["hosts"] = list(members)
+                continue
+            inventory[group_name] = {"hosts": list(members)}
+        return inventory
+
+
+def make_host_vars(record, jumphost_multiplexing=None):
+    """Returns the _meta.hostvars entry for a HostRecord.
+
+    jumphost_multiplexing is get_jumphost_multiplexing()'s result; callers deriving many hosts
+    pass it in so the environment is read once per build rather than once per host.
+    """
+    host_vars = {
+        "ansible_host": record.host_name, # Ensure ansible_host is set
+        "ansible_user": "ansible", # Default user based on cloud-init
+
+        # Add other variables from the tofu resource
+        **record.variables
+    }
+
+    # Check for ansible_ssh_jumphost and add the jump hop if present
+    if "ansible_ssh_jumphost" in record.variables and record.variables["ansible_ssh_jumphost"]:
+        # Construct the hop using the jumphost variable and ansible_user
+        # Assumes the local SSH agent is configured with the Vault-signed cert for the jumphost user
+        jump_target = f'{host_vars["ansible_user"]}@{record.variables["ansible_ssh_jumphost"]}'
+        host_vars["ansible_ssh_common_args"] = jumphost_ssh_args(jump_target, *(jumphost_multiplexing or get_jumphost_multiplexing()))
+
+    return host_vars
+
+
+def get_jumphost_multiplexing():
+    """Returns (control_dir, control_persist) for the shared jumphost masters; control_persist is None when disabled.
+
+    TOFU_INVENTORY_JUMPHOST_PERSIST sets ControlPersist (default 60s); '0', 'no', 'false' or 'off'
+    falls back to a plain '-J' hop per target.
+    """
+    control_persist = os.environ.get("TOFU_INVENTORY_JUMPHOST_PERSIST") or DEFAULT_JUMPHOST_CONTROL_PERSIST
+    if control_persist.lower() in ("0", "no", "false", "off"):
+        control_persist = None
+    return os.environ.get("TOFU_INVENTORY_JUMPHOST_CONTROL_DIR") or DEFAULT_JUMPHOST_CONTROL_DIR, control_persist
+
+
+def jumphost_control_path(control_dir, jump_target):
+    """Returns the ControlPath of the master shared by every target behind jump_target ('user@jumphost').
+
+    The name is a digest, like Ansible's own control paths, so it stays within the socket path length limit.
+    """
+    return f"{control_dir.rstrip('/')}/jump-{hashlib.sha1(jump_target.encode('utf-8')).hexdigest()[:10]}"
+
+
+@functools.lru_cache(maxsize=None)
+def jumphost_ssh_args(jump_target, control_dir, control_persist):
+    """Returns the ansible_ssh_common_args reaching a target through jump_target.
+
+    ssh does not pass command line options on to a '-J' hop, so the hop is spelled out as a
+    ProxyCommand whose ssh joins (or starts) the jumphost's multiplexed master; every target behind
+    the jumphost then opens a channel on one authenticated connection instead of its own handshake.
+    """
+    if control_persist is None:
+        return f"-J {jump_target}"
+    control_path = jumphost_control_path(control_dir, jump_target)
+    return (f'-o ProxyCommand="ssh -o ControlMaster=auto -o ControlPersist={control_persist} '
+            f'-o ControlPath={control_path} -W %h:%p {jump_target}"')
+
+
+def make_host_record(module_address, resource_values):
+    """Returns a HostRecord for an ansible_host resource's values/attributes, or None if it has no name."""
+    host_name = resource_values.get("name")
+    if not host_name:
+        return None
+    return HostRecord(module_address, host_name, resource_values.get("groups") or [], resource_values.get("variables") or {})
+
+
+def find_ansible_hosts(module_data):
+    """Yields a HostRecord for every ansible_host resource in module data and its child modules.
+
+    The module tree is walked depth-first with an explicit stack (same order as a
+    recursive walk), so arbitrarily deep nesting can't hit the recursion limit and
+    consumers can stop early without walking the rest of the state.
+    """
+    pending_modules = [module_data]
+    while pending_modules:
+        module = pending_modules.pop()
+        module_address = module.get("address", "")
+        # Check resources directly in this module
+        for resource in module.get("resources", []):
+            if resource.get("type") == "ansible_host":
+                record = make_host_record(module_address, resource.get("values") or {})
+                if record is not None:
+                    yield record
+        # Children are pushed in reverse so they are visited in document order
+        pending_modules.extend(reversed(module.get("child_modules", [])))
+
+
+def find_ansible_hosts_in_state_file(raw_state):
+    """Yields a HostRecord for every ansible_host resource in a raw v4 state document.
+
+    Unlike 'tofu show -json', the raw state is flat: every resource lists its module
+    address and its instances, whose 'attributes' hold what 'show' calls 'values'.
+    """
+    for resource in raw_state.get("resources", []):
+        if resource.get("type") != "ansible_host" or resource.get("mode", "managed") != "managed":
+            continue
+        for instance in resource.get("instances", []):
+            record = make_host_record(resource.get("module", ""), instance.get("attributes") or {})
+            if record is not None:
+                yield record
+
+
+def module_matches(module_address, module_filter):
+    """Returns True if module_address is module_filter or one of its descendants/instances."""
+    if not module_filter or module_address == module_filter:
+        return True
+    return module_address.startswith(module_filter) and module_address[len(module_filter)] in ".["
+
+
+# One ':'-separated term: characters other than whitespace and ':[]', or whole bracketed expressions
+# (so 'web[1:3]' stays one term), as Ansible's own split_host_pattern reads them
+HOST_PATTERN_TERM_REGEX = re.compile(r"(?:[^\s:\[\]]|\[[^\]]*\])+")
+
+
+def split_host_pattern(pattern):
+    """Splits an Ansible host pattern into its terms, as ansible.inventory.manager.split_host_pattern does.
+
+    Terms are separated by commas, or by colons when there is no comma. A colon inside a
+    subscript ('web[1:3]') or an IPv6 address separates nothing.
+    """
+    pattern = pattern.strip()
+    if "," in pattern:
+        terms = pattern.split(",")
+    else:
+        try:
+            ipaddress.ip_address(pattern)
+            terms = [pattern]
+        except ValueError:
+            terms = HOST_PATTERN_TERM_REGEX.findall(pattern)
+    return [term.strip() for term in terms if term.strip()]
+
+
+class HostPattern:
+    """Evaluates an Ansible host pattern (e.g. 'web-eu-*,&prod,!web-eu-03') against host names and groups.
+
+    Supports what --limit does: fnmatch wildcards, '~regex', '&' intersections, '!' exclusions,
+    'all' and '@file' host lists. A term matches a host whose name, or one of whose groups
+    (including 'all' and 'ungrouped'), it matches. Subscripts ('web[0]', 'web[1:3]') depend on
+    the order of the whole group, which only Ansible sees, so they select the whole group and an
+    excluding subscript is ignored: the selection is never smaller than Ansible's own.
+    """
+
+    # Ansible's subscripts: '[n]', '[a:b]', '[a:]' and the removed '[a-b]' form it still parses
+    SUBSCRIPT_REGEX = re.compile(r"^(.+)\[(-?[0-9]+|[0-9]+[:-][0-9]*)\]$")
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.included, self.required, self.excluded = [], [], []
+        terms = []
+        for term in split_host_pattern(pattern):
+            if term.startswith("@"):
+                try:
+                    with open(os.path.expanduser(term[1:]), "r") as f:
+                        terms.extend(line.strip() for line in f if line.strip())
+                except OSError as e:
+                    raise ValueError(f"cannot read the host list '{term[1:]}': {e}")
+            else:
+                terms.append(term)
+        # The expanded terms identify the selection, e.g. in cache keys, even when an @file changes
+        self.key = ",".join(terms)
+
+        for term in terms:
+            target = self.included
+            if term[0] in "!&":
+                target = self.excluded if term[0] == "!" else self.required
+                term = term[1:]
+            subscript = self.SUBSCRIPT_REGEX.match(term)
+            if subscript and not term.startswith("~"):
+                if target is self.excluded:
+                    continue
+                term = subscript.group(1)
+            target.append(self._compile_term(term))
+
+    @staticmethod
+    def _compile_term(term):
+        """Returns a predicate telling whether any of a host's labels (name and groups) matches term."""
+        if term in ("all", "*"):
+            return lambda labels: True
+        try:
+            regex = re.compile(term[1:] if term.startswith("~") else fnmatch.translate(term))
+        except re.error as e:
+            raise ValueError(f"invalid host pattern '{term}': {e}")
+        # A literal name is also matched as is, as Ansible does before trying it as a pattern
+        return lambda labels: any(label == term or regex.match(label) for label in labels)
+
+    def matches(self, host_name, groups):
+        """Returns True if the pattern selects the host host_name with the given groups."""
+        labels = (host_name, "all", *(groups or ("ungrouped",)))
+        if self.included and not any(term(labels) for term in self.included):
+            return False
+        return all(term(labels) for term in self.required) and not any(term(labels) for term in self.excluded)
+
+
+def parse_host_pattern(pattern):
+    """Returns a HostPattern for pattern, or None (every host) for an empty pattern or one that can't be parsed.
+
+    An unparseable pattern selects every host rather than fewer than Ansible would, which
+    then reports the pattern itself.
+    """
+    if not pattern or not pattern.strip():
+        return None
+    try:
+        return HostPattern(pattern)
+    except ValueError as e:
+        print(f"Warning: Ignoring host pattern '{pattern}' ({e}); every host is returned.", file=sys.stderr)
+        return None
+
+
+def select_records(records, module_filter, host_pattern=None):
+    """Yields only the records whose module lies under module_filter (all records if it is empty) and that host_pattern selects.
+
+    Both are checked on each record as the state walker yields it, so nothing is built for hosts outside the selection.
+    """
+    if not module_filter and host_pattern is None:
+        yield from records
+        return
+    for record in records:
+        if module_matches(record.module_address, module_filter) and (host_pattern is None or host_pattern.matches(record.host_name, record.groups)):
+            yield record
+
+
+def build_inventory_from_records(records):
+    """Builds the Ansible inventory dict from a stream of HostRecords."""
+    builder = InventoryBuilder()
+    jumphost_multiplexing = get_jumphost_multiplexing()
+    for record in records:
+        # Add the host to _meta.hostvars and to its respective groups ('ungrouped' if none)
+        builder.add_host(record.host_name, make_host_vars(record, jumphost_multiplexing), record.groups)
+    return builder.build()
+
+
+def collect_statistics(records):
+    """Counts hosts overall, per module and per group from a stream of HostRecords."""
+    statistics = {"hosts": 0, "modules": {}, "groups": {}}
+    for record in records:
+        statistics["hosts"] += 1
+        statistics["modules"][record.module_address] = statistics["modules"].get(record.module_address, 0) + 1
+        for group in record.groups or ("ungrouped",):
+            statistics["groups"][group] = statistics["groups"].get(group, 0) + 1
+    return statistics
+
+
+def build_inventory(tofu_state):
+    """Builds the Ansible inventory dict from parsed 'tofu show -json' output."""
+    # Start the search from the root module
+    root_module_data = tofu_state.get("values", {}).get("root_module", {})
+    return build_inventory_from_records(find_ansible_hosts(root_module_data))
+
+
+def get_tofu_env(workspace):
+    """Returns the environment for tofu subprocesses, selecting workspace through TF_WORKSPACE."""
+    if workspace is None:
+        return None
+    return dict(os.environ, TF_WORKSPACE=workspace)
+
+
+def run_tofu_show(tofu_dir, workspace=None):
+    """Runs 'tofu show -json' in tofu_dir (for workspace, if given) and returns its stdout."""
     # Find the tofu executable in the PATH
     tofu_executable = find_executable("tofu")
     if not tofu_executable:
@@ -73,21 +376,18 @@ def main():
 
     # Execute 'tofu show -json' using the found executable path
     try:
-        # Ensure the command is run from the directory containing the tofu state
-        # Assuming the script is run from the ansible directory,
-        # we need to go up one level and then into opentofu
-        tofu_dir = os.path.join(os.path.dirname(__file__), "..", "..", "opentofu")
         result = subprocess.run(
             [tofu_executable, "show", "-json"], # Use the full executable path
             cwd=tofu_dir, # Run the command in the opentofu directory
+            env=get_tofu_env(workspace),
             capture_output=True,
             text=True,
             check=True # Raise an exception if the command fails
         )
-        tofu_state_json = result.stdout
         if result.stderr:
              # Keep stderr print for actual errors from tofu command
              print(f"Tofu stderr:\n{result.stderr}", file=sys.stderr)
+        return result.stdout
 
     except subprocess.CalledProcessError as e:
         print(f"Error executing '{tofu_executable} show -json': {e}", file=sys.stderr)
@@ -98,42 +398,1091 @@ def main():
         sys.exit(1)
 
 
+class AnsibleHostStreamParser:
+    """Incrementally extracts ansible_host resources from a 'tofu show -json' text stream.
+
+    The parser only tracks the JSON container structure and jumps over string
+    contents with str.find, so it never materializes the state tree. Resource objects
+    of module 'resources' arrays are buffered only until their 'type' is known; anything
+    other than ansible_host is dropped on the spot, which bounds peak memory by the
+    largest ansible_host resource plus one read chunk.
+    """
+
+    STRUCTURE_REGEX = re.compile(r'[{}\[\]:,"]')
+    # Keys and the 'type' value are short; longer strings are skipped without being copied
+    MAX_KEY_LENGTH = 256
+
+    def __init__(self):
+        self._buffer = ""
+        self._scan_pos = 0
+        # Each frame is [container, role, last_key]; container is '{' or '[' and role
+        # tells what the container is: 'root', 'values', 'module', 'modules',
+        # 'resources', 'resource' or None for anything we don't care about.
+        self._stack = []
+        self._pending_string = None
+        self._capture_start = None
+        self._seen_root = False
+
+    def feed(self, text):
+        """Consumes the next chunk of text and returns the ansible_host resources completed by it."""
+        self._buffer += text
+        buffer = self._buffer
+        search = self.STRUCTURE_REGEX.search
+        found = []
+        pos = self._scan_pos
+        while True:
+            match = search(buffer, pos)
+            if match is None:
+                pos = len(buffer)
+                break
+            start = match.start()
+            if buffer[start] == '"':
+                end = self._string_end(buffer, start)
+                if end == -1:
+                    # Incomplete string at the end of the buffer: wait for more data
+                    pos = start
+                    break
+                self._handle_string(buffer[start:end] if end - start <= self.MAX_KEY_LENGTH else None)
+            else:
+                end = start + 1
+                self._handle_token(buffer[start], start, end, found)
+            pos = end
+
+        # Drop everything already processed unless it belongs to a resource being captured
+        keep_from = pos if self._capture_start is None else self._capture_start
+        self._buffer = buffer[keep_from:]
+        self._scan_pos = pos - keep_from
+        if self._capture_start is not None:
+            self._capture_start -= keep_from
+        return found
+
+    def close(self):
+        """Checks that the stream held exactly one complete JSON document."""
+        if not self._seen_root or self._stack or self._buffer[self._scan_pos:].strip():
+            raise ValueError("truncated or malformed JSON document")
+
+    @staticmethod
+    def _string_end(buffer, start):
+        """Returns the index just past the string opening at buffer[start], or -1 if it is cut off."""
+        pos = start + 1
+        while True:
+            pos = buffer.find('"', pos)
+            if pos == -1:
+                return -1
+            # A quote preceded by an odd number of backslashes is escaped
+            backslash = pos - 1
+            while buffer[backslash] == "\\":
+                backslash -= 1
+            if (pos - 1 - backslash) % 2 == 0:
+                return pos + 1
+            pos += 1
+
+    def _handle_string(self, token):
+        frame = self._stack[-1] if self._stack else None
+        if frame is not None and frame[1] == "resource" and frame[2] == "type":
+            # The resource type is known: stop buffering anything that isn't an ansible_host
+            if token != '"ansible_host"':
+                self._capture_start = None
+                frame[1] = "skipped_resource"
+        self._pending_string = token
+
+    def _handle_token(self, token, start, end, found):
+        if token == ":":
+            if self._stack:
+                self._stack[-1][2] = json.loads(self._pending_string) if self._pending_string is not None else None
+            self._pending_string = None
+            return
+
+        if token == ",":
+            if self._stack and self._stack[-1][0] == "{":
+                self._stack[-1][2] = None
+            self._pending_string = None
+            return
+
+        if token in "{[":
+            role = self._child_role(token)
+            if role == "resource":
+                self._capture_start = start
+            self._stack.append([token, role, None])
+            self._pending_string = None
+            return
+
+        # '}' or ']'
+        if not self._stack:
+            raise ValueError("unbalanced JSON document")
+        frame = self._stack.pop()
+        self._pending_string = None
+        if frame[1] == "resource" and self._capture_start is not None:
+            resource = json.loads(self._buffer[self._capture_start:end])
+            self._capture_start = None
+            if resource.get("type") == "ansible_host":
+                found.append(resource)
+        if not self._stack:
+            self._seen_root = True
+
+    def _child_role(self, token):
+        """Returns the role of a container opened at the current position."""
+        if not self._stack:
+            if self._seen_root:
+                raise ValueError("extra data after JSON document")
+            return "root" if token == "{" else None
+        container, role, key = self._stack[-1]
+        if container == "{":
+            if role == "root" and key == "values" and token == "{":
+                return "values"
+            if role == "values" and key == "root_module" and token == "{":
+                return "module"
+            if role == "module" and key == "child_modules" and token == "[":
+                return "modules"
+            if role == "module" and key == "resources" and token == "[":
+                return "resources"
+            return None
+        if role == "modules" and token == "{":
+            return "module"
+        if role == "resources" and token == "{":
+            return "resource"
+        return None
+
+
+def resource_module_address(resource):
+    """Returns the module address of a 'tofu show -json' resource, derived from its own address."""
+    address = resource.get("address", "")
+    suffix_start = address.rfind(f"{resource.get('type')}.{resource.get('name')}")
+    return address[:suffix_start].rstrip(".") if suffix_start > 0 else ""
+
+
+def stream_tofu_show(tofu_dir, state_key, workspace=None, chunk_size=65536):
+    """Runs 'tofu show -json' and yields a HostRecord per ansible_host resource as it is read.
+
+    Only ansible_host resources are decoded; the state itself is never held in memory.
+    Once the output is exhausted, state_key['sha256'] is set to its digest. Closing
+    the generator early terminates tofu.
+    """
+    # Find the tofu executable in the PATH
+    tofu_executable = find_executable("tofu")
+    if not tofu_executable:
+        print("Error: 'tofu' executable not found in PATH. Please ensure OpenTofu is installed and accessible.", file=sys.stderr)
+        sys.exit(1)
+
+    parser = AnsibleHostStreamParser()
+    digest = hashlib.sha256()
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    try:
+        # stderr goes to a temporary file so a chatty tofu can't block on a full pipe while we read stdout
+        with tempfile.TemporaryFile() as stderr_file:
+            process = subprocess.Popen(
+                [tofu_executable, "show", "-json"], # Use the full executable path
+                cwd=tofu_dir, # Run the command in the opentofu directory
+                env=get_tofu_env(workspace),
+                stdout=subprocess.PIPE,
+                stderr=stderr_file,
+            )
+            try:
+                with process.stdout:
+                    while True:
+                        chunk = process.stdout.read(chunk_size)
+                        if not chunk:
+                            break
+                        digest.update(chunk)
+                        for resource in parser.feed(decoder.decode(chunk)):
+                            record = make_host_record(resource_module_address(resource), resource.get("values") or {})
+                            if record is not None:
+                                yield record
+            except GeneratorExit:
+                # The consumer found what it needed: don't wait for tofu to print the rest
+                process.kill()
+                process.wait()
+                raise
+            returncode = process.wait()
+            stderr_file.seek(0)
+            stderr = stderr_file.read().decode("utf-8", errors="replace")
+
+        if returncode != 0:
+            print(f"Error executing '{tofu_executable} show -json': exit status {returncode}", file=sys.stderr)
+            print(f"Stderr: {stderr}", file=sys.stderr)
+            sys.exit(1)
+        if stderr:
+             # Keep stderr print for actual errors from tofu command
+             print(f"Tofu stderr:\n{stderr}", file=sys.stderr)
+
+        parser.feed(decoder.decode(b"", final=True))
+        parser.close()
+    except ValueError:
+        print("Error: Invalid JSON received from 'tofu show -json'.", file=sys.stderr)
+        sys.exit(1)
+    except OSError as e:
+        print(f"An unexpected error occurred while running '{tofu_executable} show -json': {e}", file=sys.stderr)
+        sys.exit(1)
+
+    state_key["sha256"] = digest.hexdigest()
+
+
+def get_local_backend_config(tofu_dir):
+    """Returns the local backend's settings for tofu_dir, or None when state lives in another backend.
+
+    'tofu init' records the configured backend in .terraform/terraform.tfstate (under
+    TF_DATA_DIR if set). No such file means no backend block, i.e. the local backend with
+    its defaults ({}); a file that can't be read is treated as a non-local backend, since
+    a leftover terraform.tfstate next to a remote backend is stale.
+    """
+    backend_path = os.path.join(tofu_dir, os.environ.get("TF_DATA_DIR") or ".terraform", "terraform.tfstate")
+    try:
+        with open(backend_path, "r", encoding="utf-8") as f:
+            backend_state = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError):
+        return None
+
+    backend = backend_state.get("backend") if isinstance(backend_state, dict) else None
+    if not isinstance(backend, dict) or not backend.get("type"):
+        return {}
+    if backend["type"] != "local":
+        return None
+    return backend.get("config") or {}
+
+
+def get_state_file_path(tofu_dir, workspace=None):
+    """Returns the path of the local state file for tofu_dir and workspace, or None for a remote backend.
+
+    TOFU_INVENTORY_STATE_FILE overrides it in single-root mode (workspace None); named
+    workspaces of the local backend live under terraform.tfstate.d/<workspace>/, or
+    under the backend's 'path'/'workspace_dir' settings when they are configured.
+    """
+    if workspace is None and os.environ.get("TOFU_INVENTORY_STATE_FILE"):
+        return os.environ["TOFU_INVENTORY_STATE_FILE"]
+    backend_config = get_local_backend_config(tofu_dir)
+    if backend_config is None:
+        return None
+    if workspace is None or workspace == "default":
+        return os.path.join(tofu_dir, backend_config.get("path") or "terraform.tfstate")
+    return os.path.join(tofu_dir, backend_config.get("workspace_dir") or "terraform.tfstate.d", workspace, "terraform.tfstate")
+
+
+def read_state_identity(tofu_dir, workspace=None):
+    """Returns {'lineage', 'serial'} of the local state file, or None if there is no readable one.
+
+    Remote backends (e.g. the 'pg' backend) keep no state on disk; in that case the
+    cache falls back to its TTL and to a digest of the 'tofu show -json' output.
+    """
+    state_path = get_state_file_path(tofu_dir, workspace)
+    if state_path is None:
+        return None
+    try:
+        with open(state_path, "r", encoding="utf-8") as f:
+            head = f.read(STATE_HEAD_BYTES)
+    except OSError:
+        return None
+
+    serial_match = STATE_SERIAL_REGEX.search(head)
+    lineage_match = STATE_LINEAGE_REGEX.search(head)
+    if not serial_match or not lineage_match:
+        return None
+    return {"lineage": lineage_match.group(1), "serial": int(serial_match.group(1))}
+
+
+def get_state_source():
+    """Returns how state is read: 'auto' (native reader, falling back to tofu) or 'tofu'."""
+    source = (os.environ.get("TOFU_INVENTORY_STATE_SOURCE") or "auto").lower()
+    if source not in ("auto", "tofu"):
+        print(f"Warning: Ignoring invalid TOFU_INVENTORY_STATE_SOURCE '{source}', using 'auto'.", file=sys.stderr)
+        return "auto"
+    return source
+
+
+def use_stream_parser():
+    """Returns False when TOFU_INVENTORY_STREAM_PARSE disables streaming of 'tofu show -json' output."""
+    return (os.environ.get("TOFU_INVENTORY_STREAM_PARSE") or "true").lower() not in ("0", "false", "no", "off")
+
+
+def load_state_file(tofu_dir, workspace=None):
+    """Parses the local v4 state file natively.
+
+    Returns None when the state has to be read through 'tofu show -json' instead:
+    a backend other than 'local' (any terraform.tfstate left beside it is stale), no
+    local state file, unreadable JSON, an unsupported format version, or OpenTofu
+    client-side state encryption.
+    """
+    state_path = get_state_file_path(tofu_dir, workspace)
+    if state_path is None:
+        return None
+    try:
+        with open(state_path, "r", encoding="utf-8") as f:
+            raw_state = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        print(f"Warning: Could not read state file '{state_path}' natively ({e}). Falling back to 'tofu show -json'.", file=sys.stderr)
+        return None
+
+    if not isinstance(raw_state, dict):
+        return None
+    if "encrypted_data" in raw_state:
+        # Encrypted states can only be decrypted by tofu itself (key providers live in the configuration)
+        return None
+    if raw_state.get("version") != 4:
+        print(f"Warning: Unsupported state format version {raw_state.get('version')!r} in '{state_path}'. Falling back to 'tofu show -json'.", file=sys.stderr)
+        return None
+    return raw_state
+
+
+def get_cache_ttl():
+    """Returns the cache TTL in seconds from TOFU_INVENTORY_CACHE_TTL (0 disables the cache)."""
+    raw_ttl = os.environ.get("TOFU_INVENTORY_CACHE_TTL")
+    if raw_ttl is None or raw_ttl == "":
+        return DEFAULT_CACHE_TTL_SECONDS
+    try:
+        return max(0, int(raw_ttl))
+    except ValueError:
+        print(f"Warning: Ignoring invalid TOFU_INVENTORY_CACHE_TTL '{raw_ttl}', using {DEFAULT_CACHE_TTL_SECONDS}s.", file=sys.stderr)
+        return DEFAULT_CACHE_TTL_SECONDS
+
+
+def get_cache_path(tofu_dir, module_filter="", workspace=None, host_pattern=None):
+    """Returns the cache file path for tofu_dir, so different roots, workspaces, module filters or host patterns never share an entry."""
+    cache_dir = os.environ.get("TOFU_INVENTORY_CACHE_DIR") or DEFAULT_CACHE_DIR
+    # The jumphost settings end up in hostvars, so changing them must not reuse an entry built with others
+    control_dir, control_persist = get_jumphost_multiplexing()
+    root_id = hashlib.sha256(
+        f"{os.path.realpath(tofu_dir)}\0{workspace or ''}\0{module_filter}\0{control_dir}\0{control_persist}"
+        f"\0{host_pattern.key if host_pattern else ''}".encode("utf-8")
+    ).hexdigest()[:16]
+    return os.path.join(cache_dir, f"inventory-{root_id}.json")
+
+
+def get_host_index_path(cache_path):
+    """Returns the path of the entry pointing at the hostname -> hostvars index of the cached inventory."""
+    return cache_path[:-len(".json")] + ".hosts.json"
+
+
+def build_host_index(cache_path, hostvars):
+    """Writes hostvars to a new SQLite table keyed by host name next to cache_path; returns its file name or None.
+
+    The file is complete before it appears under its final name and is never modified afterwards,
+    so readers can open it immutable.
+    """
+    cache_dir = os.path.dirname(cache_path)
+    index_name = f"{os.path.basename(cache_path)[:-len('.json')]}.hosts.{os.urandom(8).hex()}.sqlite"
+    try:
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=".inventory-", suffix=".tmp", dir=cache_dir)
+        os.close(fd)
+        try:
+            connection = sqlite3.connect(tmp_path)
+            try:
+                # A half-written file is discarded anyway, so no rollback journal is needed
+                connection.execute("PRAGMA journal_mode=OFF")
+                connection.execute("CREATE TABLE hostvars (host_name TEXT PRIMARY KEY, host_vars TEXT NOT NULL) WITHOUT ROWID")
+                connection.executemany("INSERT INTO hostvars VALUES (?, ?)",
+                                       ((host_name, json.dumps(host_vars, separators=(",", ":"))) for host_name, host_vars in hostvars.items()))
+                connection.commit()
+            finally:
+                connection.close()
+            os.replace(tmp_path, os.path.join(cache_dir, index_name))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    except (OSError, sqlite3.Error) as e:
+        print(f"Warning: Could not write host index for '{cache_path}': {e}", file=sys.stderr)
+        return None
+    return index_name
+
+
+def write_host_index(cache_path, created_at, state_key, hostvars):
+    """Persists the hostname -> hostvars index of the inventory cached at cache_path.
+
+    Each host is one row, so a lookup reads one host's variables however large the fleet is.
+    The entry at get_host_index_path() carries the index's freshness and names its file; when
+    the TTL is re-armed for an unchanged state only that entry is rewritten.
+    """
+    if sqlite3 is None:
+        return
+    entry_path = get_host_index_path(cache_path)
+    cache_dir = os.path.dirname(cache_path)
+    previous_entry = load_cache(entry_path, payload_key="index")
+    if (previous_entry is not None and state_key and previous_entry.get("state_key") == state_key
+            and os.path.exists(os.path.join(cache_dir, previous_entry["index"]))):
+        index_name = previous_entry["index"]
+    else:
+        index_name = build_host_index(cache_path, hostvars)
+        if index_name is None:
+            return
+    write_cache(entry_path, {
+        "version": CACHE_FORMAT_VERSION,
+        "created_at": created_at,
+        "state_key": state_key,
+        "index": index_name,
+    })
+
+    # Indexes of earlier states are no longer referenced
+    prefix = os.path.basename(cache_path)[:-len(".json")] + ".hosts."
+    for name in os.listdir(cache_dir):
+        if name.startswith(prefix) and name.endswith(".sqlite") and name != index_name:
+            try:
+                os.remove(os.path.join(cache_dir, name))
+            except OSError:
+                pass
+
+
+def read_host_index(index_path, host_name):
+    """Returns host_name's hostvars from the index at index_path ({} for an unknown host), or None if it can't be read."""
+    if sqlite3 is None:
+        return None
+    try:
+        connection = sqlite3.connect(f"file:{urllib.parse.quote(os.path.abspath(index_path))}?mode=ro&immutable=1", uri=True)
+        try:
+            row = connection.execute("SELECT host_vars FROM hostvars WHERE host_name = ?", (host_name,)).fetchone()
+        finally:
+            connection.close()
+    except sqlite3.Error:
+        return None
+    return json.loads(row[0]) if row else {}
+
+
+def load_cache(cache_path, payload_key="inventory"):
+    """Loads a cache entry, returning None if it is missing, unreadable or from another format version."""
+    try:
+        with open(cache_path, "r", encoding="utf-8") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(entry, dict) or entry.get("version") != CACHE_FORMAT_VERSION or payload_key not in entry:
+        return None
+    return entry
+
+
+def write_cache(cache_path, entry):
+    """Atomically writes a cache entry (temp file in the same directory + rename)."""
+    cache_dir = os.path.dirname(cache_path)
+    try:
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=".inventory-", suffix=".tmp", dir=cache_dir)
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(entry, f, separators=(",", ":"))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, cache_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    except OSError as e:
+        # A failed cache write must never break inventory generation
+        print(f"Warning: Could not write inventory cache '{cache_path}': {e}", file=sys.stderr)
+
+
+def is_cache_fresh(entry, ttl, state_identity):
+    """Returns True if entry is younger than ttl and still matches the local state's lineage/serial."""
+    if ttl <= 0:
+        return False
+    age = time.time() - entry.get("created_at", 0)
+    if age < 0 or age >= ttl:
+        return False
+    # A local state whose serial/lineage moved on invalidates the entry before the TTL runs out
+    if state_identity is not None and entry.get("state_key") != state_identity:
+        return False
+    return True
+
+
+def host_fingerprint(record):
+    """Returns the per-host fingerprint stored in the cache: a digest of everything its inventory entry derives from.
+
+    The digest is taken over repr(), which is stable for the JSON-decoded values a record holds
+    and about twice as fast as re-encoding them as JSON.
+    """
+    return hashlib.sha1(repr((record.module_address, record.groups, record.variables)).encode("utf-8")).hexdigest()
+
+
+def patch_inventory(inventory, fingerprints, records):
+    """Patches a cached inventory in place so it matches records; returns the new fingerprints or None.
+
+    Hosts whose fingerprint is unchanged are not re-derived at all; only added, removed or
+    changed hosts have their hostvars and group memberships updated, so one new VM in a
+    large fleet costs one host's worth of derivation (plus the comparison pass). The groups
+    a host leaves are read off the cached inventory itself. Hosts, groups and group members
+    then end up in the same order as in a full rebuild. Returns None when the inventory
+    can't be patched safely (a host name declared twice, hosts in the reserved 'all'/'_meta'
+    groups, or a cached inventory whose hosts differ from its fingerprints), in which case
+    the caller rebuilds it. Nothing is modified then.
+    """
+    new_fingerprints = {}
+    changed_records = []
+    for record in records:
+        if record.host_name in new_fingerprints:
+            return None
+        fingerprint = host_fingerprint(record)
+        if fingerprints.get(record.host_name) != fingerprint:
+            changed_records.append(record)
+        new_fingerprints[record.host_name] = fingerprint
+    removed_hosts = [host_name for host_name in fingerprints if host_name not in new_fingerprints]
+
+    def groups_of(groups):
+        # A group listed twice is joined once, as in a full rebuild
+        return list(dict.fromkeys(groups)) or ["ungrouped"]
+
+    try:
+        hostvars = inventory["_meta"]["hostvars"]
+        if hostvars.keys() != fingerprints.keys():
+            return None
+        # Only the hosts that leave or change need their previous groups
+        leaving_hosts = set(removed_hosts).union(record.host_name for record in changed_records)
+        previous_groups = {}
+        if leaving_hosts:
+            for group, body in inventory.items():
+                if group != "_meta":
+                    for host_name in leaving_hosts.intersection(body.get("hosts", ())):
+                        previous_groups.setdefault(host_name, []).append(group)
+    except (AttributeError, KeyError, TypeError):
+        return None
+
+    touched_groups = set()
+    for host_name in removed_hosts:
+        touched_groups.update(previous_groups.get(host_name, ()))
+    for record in changed_records:
+        touched_groups.update(groups_of(record.groups))
+        touched_groups.update(previous_groups.get(record.host_name, ()))
+    if touched_groups & {"all", "_meta"}:
+        return None
+
+    # Drop removed hosts, and changed hosts from the groups they left
+    for host_name in removed_hosts:
+        del hostvars[host_name]
+        for group in previous_groups.get(host_name, ()):
+            inventory[group]["hosts"].remove(host_name)
+    for record in changed_records:
+        for group in set(previous_groups.get(record.host_name, ())) - set(groups_of(record.groups)):
+            inventory[group]["hosts"].remove(record.host_name)
+
+    # Re-derive added/changed hosts and join any groups they weren't in yet
+    jumphost_multiplexing = get_jumphost_multiplexing()
+    for record in changed_records:
+        hostvars[record.host_name] = make_host_vars(record, jumphost_multiplexing)
+        joined_groups = previous_groups.get(record.host_name, ())
+        for group in groups_of(record.groups):
+            if group in joined_groups:
+                continue
+            if group not in inventory:
+                inventory[group] = {"hosts": []}
+            inventory[group]["hosts"].append(record.host_name)
+
+    # Restore a full rebuild's first-seen order, which host subscripts (web[0]) and serial
+    # batches depend on. Patched lists are nearly sorted already, so sorting them is cheap.
+    # Groups left without members disappear, as they would in a full rebuild.
+    position = {record.host_name: index for index, record in enumerate(records)}
+    group_order = {"ungrouped": None}
+    for record in records:
+        group_order.update(dict.fromkeys(record.groups))
+    inventory["_meta"]["hostvars"] = {host_name: hostvars[host_name] for host_name in position}
+    inventory["all"]["children"] = [group for group in group_order if group not in ("all", "_meta")]
+    ordered = {"_meta": inventory["_meta"], "all": inventory["all"]}
+    for group in group_order:
+        if group == "_meta":
+            continue
+        body = ordered[group] = inventory.get(group, {"hosts": []})
+        if "hosts" in body:
+            body["hosts"].sort(key=position.__getitem__)
+    inventory.clear()
+    inventory.update(ordered)
+
+    return new_fingerprints
+
+
+def open_state_records(tofu_dir, workspace=None):
+    """Opens the best available state source for tofu_dir and returns (records, state_key).
+
+    records is a lazy stream of HostRecords. state_key identifies the state: the raw
+    state file's lineage/serial, or the digest of the 'tofu show -json' output. With the
+    streaming reader the digest is only known (and state_key only filled in) once records
+    has been exhausted, and tofu is not started until records is first iterated.
+    """
+    raw_state = load_state_file(tofu_dir, workspace) if get_state_source() == "auto" else None
+    if raw_state is not None:
+        return find_ansible_hosts_in_state_file(raw_state), {"lineage": raw_state.get("lineage"), "serial": raw_state.get("serial")}
+
+    if use_stream_parser():
+        state_key = {}
+        return stream_tofu_show(tofu_dir, state_key, workspace), state_key
+
+    tofu_state_json = run_tofu_show(tofu_dir, workspace)
     # Load the JSON output
     try:
         tofu_state = json.loads(tofu_state_json)
     except json.JSONDecodeError:
         print("Error: Invalid JSON received from 'tofu show -json'.", file=sys.stderr)
         sys.exit(1)
+    root_module_data = tofu_state.get("values", {}).get("root_module", {})
+    return find_ansible_hosts(root_module_data), {"sha256": hashlib.sha256(tofu_state_json.encode("utf-8")).hexdigest()}
 
-    # Initialize the Ansible inventory structure
-    inventory = {
-        "_meta": {
-            "hostvars": {}
-        },
-        # Initialize 'all' group with 'ungrouped' as a child
-        "all": {
-            "children": ["ungrouped"]
-        },
-        "ungrouped": {
-            "hosts": []
-        }
-    }
 
-    # Start the recursive search from the root module
-    root_module_data = tofu_state.get("values", {}).get("root_module", {})
-    find_ansible_hosts(root_module_data, inventory)
+def get_inventory(tofu_dir, refresh_cache=False, module_filter="", workspace=None, host_pattern=None):
+    """Returns the inventory for tofu_dir, served from the on-disk cache when it is still valid."""
+    ttl = get_cache_ttl()
+    cache_path = get_cache_path(tofu_dir, module_filter, workspace, host_pattern)
+    state_identity = read_state_identity(tofu_dir, workspace)
+
+    cached_entry = None if refresh_cache else load_cache(cache_path)
+    if cached_entry is not None and is_cache_fresh(cached_entry, ttl, state_identity):
+        return cached_entry["inventory"]
+
+    # Key the entry on the state's lineage/serial, peeked from the head of the state file, so
+    # an unchanged local state is never parsed; without a local state file the digest of the
+    # tofu output identifies the state instead, and that means reading it.
+    state_key = state_identity
+    if not (state_key and cached_entry is not None and cached_entry.get("state_key") == state_key):
+        records, source_key = open_state_records(tofu_dir, workspace)
+        state_key = state_identity or source_key
+    if state_key and cached_entry is not None and cached_entry.get("state_key") == state_key:
+        # TTL ran out but the state is unchanged: keep the rendered inventory and just re-arm the TTL
+        inventory = cached_entry["inventory"]
+        fingerprints = cached_entry.get("fingerprints")
+    else:
+        # Reading the records exhausts them, which completes a streamed source_key
+        selected_records = list(select_records(records, module_filter, host_pattern))
+        inventory = fingerprints = None
+        if cached_entry is not None and isinstance(cached_entry.get("fingerprints"), dict):
+            # The state moved on: patch the previous inventory with just the hosts that changed
+            fingerprints = patch_inventory(cached_entry["inventory"], cached_entry["fingerprints"], selected_records)
+            if fingerprints is not None:
+                inventory = cached_entry["inventory"]
+        if inventory is None:
+            inventory = build_inventory_from_records(selected_records)
+            fingerprints = {record.host_name: host_fingerprint(record) for record in selected_records}
+
+    if ttl > 0:
+        created_at = time.time()
+        # The host index is written first so a fresh inventory entry never points at a stale index
+        write_host_index(cache_path, created_at, state_key, inventory["_meta"]["hostvars"])
+        write_cache(cache_path, {
+            "version": CACHE_FORMAT_VERSION,
+            "created_at": created_at,
+            "state_key": state_key,
+            "inventory": inventory,
+            "fingerprints": fingerprints,
+        })
+    return inventory
+
+
+def get_host_vars(tofu_dir, host_name, refresh_cache=False, module_filter="", workspace=None, host_pattern=None):
+    """Returns the hostvars of a single host, looked up in the persisted host index when it is valid.
+
+    A warm lookup reads the index entry and that host's row of the index, and never touches
+    tofu, the state or the other hosts; an unknown host yields an empty dict, as Ansible
+    expects from '--host'. With the cache disabled the state is walked only up to the
+    (first) matching host.
+    """
+    ttl = get_cache_ttl()
+    if ttl <= 0:
+        records, _ = open_state_records(tofu_dir, workspace)
+        for record in select_records(records, module_filter, host_pattern):
+            if record.host_name == host_name:
+                records.close()
+                return make_host_vars(record)
+        return {}
+
+    if not refresh_cache:
+        index_entry_path = get_host_index_path(get_cache_path(tofu_dir, module_filter, workspace, host_pattern))
+        index_entry = load_cache(index_entry_path, payload_key="index")
+        if index_entry is not None and is_cache_fresh(index_entry, ttl, read_state_identity(tofu_dir, workspace)):
+            host_vars = read_host_index(os.path.join(os.path.dirname(index_entry_path), index_entry["index"]), host_name)
+            if host_vars is not None:
+                return host_vars
+
+    inventory = get_inventory(tofu_dir, refresh_cache=refresh_cache, module_filter=module_filter, workspace=workspace, host_pattern=host_pattern)
+    return inventory["_meta"]["hostvars"].get(host_name, {})
+
+
+def parse_sources(specs):
+    """Parses '[label=]dir[@workspace]' specs into TofuSources with unique, group-safe labels."""
+    sources = []
+    used_labels = set()
+    for spec in specs:
+        spec = spec.strip()
+        if not spec:
+            continue
+        label, separator, location = spec.partition("=")
+        if not separator:
+            label, location = "", spec
+        tofu_dir, _, workspace = location.partition("@")
+        workspace = workspace or "default"
+        if not label:
+            label = workspace if workspace != "default" else os.path.basename(os.path.normpath(tofu_dir))
+        # Labels become group names and host name prefixes, so keep them to word characters
+        label = re.sub(r"\W", "_", label) or "tofu"
+        unique_label, suffix = label, 2
+        while unique_label in used_labels:
+            unique_label, suffix = f"{label}_{suffix}", suffix + 1
+        used_labels.add(unique_label)
+        sources.append(TofuSource(unique_label, tofu_dir, workspace))
+    return sources
+
+
+def get_max_workers(source_count):
+    """Returns the size of the state fetch pool from TOFU_INVENTORY_MAX_WORKERS (default 4)."""
+    raw_workers = os.environ.get("TOFU_INVENTORY_MAX_WORKERS")
+    try:
+        max_workers = int(raw_workers) if raw_workers else DEFAULT_MAX_WORKERS
+    except ValueError:
+        print(f"Warning: Ignoring invalid TOFU_INVENTORY_MAX_WORKERS '{raw_workers}', using {DEFAULT_MAX_WORKERS}.", file=sys.stderr)
+        max_workers = DEFAULT_MAX_WORKERS
+    return max(1, min(max_workers, source_count))
+
+
+def build_source_inventory(tofu_dir, module_filter="", workspace=None, host_pattern=None):
+    """Builds the inventory for tofu_dir straight from its state, bypassing the on-disk cache."""
+    records, _ = open_state_records(tofu_dir, workspace)
+    return build_inventory_from_records(select_records(records, module_filter, host_pattern))
+
+
+def fetch_inventories(sources, refresh_cache=False, module_filter="", use_cache=True):
+    """Fetches the inventory of every source concurrently and returns [(source, inventory)] in source order.
+
+    Each source keeps its own cache entry, so only stale sources pay for a state read;
+    with a bounded pool the wall-clock time is close to the slowest single state.
+    With use_cache False (callers with their own cache) the states are always read.
+    A source that can't be read fails the whole fetch (never a partial inventory), but
+    only once every other source has been read, and cached.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=get_max_workers(len(sources))) as executor:
+        if use_cache:
+            futures = [
+                executor.submit(get_inventory, source.tofu_dir, refresh_cache, module_filter, source.workspace)
+                for source in sources
+            ]
+        else:
+            futures = [
+                executor.submit(build_source_inventory, source.tofu_dir, module_filter, source.workspace)
+                for source in sources
+            ]
+        labelled_inventories = []
+        failed_sources = []
+        for source, future in zip(sources, futures):
+            try:
+                labelled_inventories.append((source, future.result()))
+            except SystemExit:
+                # The state reader has already printed why
+                failed_sources.append(source)
+    if failed_sources:
+        failed_list = ", ".join(f"{source.label} ({source.tofu_dir}@{source.workspace})" for source in failed_sources)
+        print(f"Error: Could not read OpenTofu sources: {failed_list}", file=sys.stderr)
+        sys.exit(1)
+    return labelled_inventories
+
+
+def merge_inventories(labelled_inventories, conflict_policy="namespace", host_pattern=None):
+    """Merges per-source inventories into one.
+
+    Every host is also added to a group named after its source's label. A host name that
+    appears in several sources with identical hostvars is treated as one shared host
+    (e.g. a common jumphost); with differing hostvars it is a conflict, which either
+    aborts ('error') or is resolved by renaming each copy to '<label>.<host>'
+    ('namespace', the default). Renamed hosts keep their ansible_host address.
+
+    host_pattern is matched against the merged names and groups (including the source labels),
+    so only the hosts it selects are added.
+    """
+    hostvars_by_name = {}
+    conflicts = set()
+    for _, inventory in labelled_inventories:
+        for host_name, host_vars in inventory["_meta"]["hostvars"].items():
+            seen_vars = hostvars_by_name.setdefault(host_name, host_vars)
+            if seen_vars != host_vars:
+                conflicts.add(host_name)
+
+    if conflicts:
+        conflict_list = ", ".join(sorted(conflicts))
+        if conflict_policy == "error":
+            print(f"Error: Hosts defined differently in several OpenTofu sources: {conflict_list}", file=sys.stderr)
+            sys.exit(1)
+        print(f"Warning: Namespacing hosts defined differently in several OpenTofu sources: {conflict_list}", file=sys.stderr)
+
+    builder = InventoryBuilder()
+    for source, inventory in labelled_inventories:
+        # Invert the per-source group lists once so each host's groups are known in O(1)
+        groups_by_host = {}
+        for group_name, group in inventory.items():
+            if group_name in ("_meta", "all", "ungrouped"):
+                continue
+            for host_name in group.get("hosts", []):
+                groups_by_host.setdefault(host_name, []).append(group_name)
+
+        for host_name, host_vars in inventory["_meta"]["hostvars"].items():
+            merged_name = f"{source.label}.{host_name}" if host_name in conflicts else host_name
+            groups = groups_by_host.get(host_name, []) + [source.label]
+            if host_pattern is None or host_pattern.matches(merged_name, groups):
+                builder.add_host(merged_name, host_vars, groups)
+    return builder.build()
+
+
+def get_merged_inventory(sources, refresh_cache=False, module_filter="", use_cache=True, conflict_policy=None, host_pattern=None):
+    """Returns the aggregated inventory of several OpenTofu roots/workspaces."""
+    conflict_policy = (conflict_policy or os.environ.get("TOFU_INVENTORY_CONFLICTS") or "namespace").lower()
+    if conflict_policy not in ("namespace", "error"):
+        print(f"Warning: Ignoring invalid TOFU_INVENTORY_CONFLICTS '{conflict_policy}', using 'namespace'.", file=sys.stderr)
+        conflict_policy = "namespace"
+    return merge_inventories(fetch_inventories(sources, refresh_cache, module_filter, use_cache), conflict_policy, host_pattern)
+
+
+def parse_shard(spec):
+    """Parses a 'K/N' shard spec (shard K of N, counting from 1) into (K, N); returns None for an empty spec.
+
+    Raises ValueError for anything else.
+    """
+    if not spec:
+        return None
+    index, separator, count = spec.partition("/")
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        raise ValueError(f"invalid shard '{spec}', expected K/N (e.g. 2/3)")
+    if not separator or not 1 <= index <= count:
+        raise ValueError(f"invalid shard '{spec}', expected K/N with 1 <= K <= N")
+    return index, count
+
+
+def shard_key(host_name, host_vars):
+    """Returns what a host is sharded by: its jumphost, so all hosts behind one share a shard (and its ssh master)."""
+    return host_vars.get("ansible_ssh_jumphost") or host_name
+
+
+def shard_of(key, shard_count):
+    """Returns the shard (1..shard_count) of key by rendezvous hashing.
+
+    Every shard scores the key and the highest score wins. Going from N to N+1 shards only moves
+    the keys the new shard now wins, about 1/(N+1) of them, and nothing moves between the old shards.
+    """
+    encoded_key = key.encode("utf-8")
+    return max(range(1, shard_count + 1),
+               key=lambda shard: hashlib.blake2b(encoded_key, digest_size=8, salt=shard.to_bytes(8, "big")).digest())
+
+
+def shard_inventory(inventory, shard_index, shard_count):
+    """Returns a copy of inventory with only the hosts of shard shard_index of shard_count.
+
+    Groups are all kept (possibly empty), so plays targeting a group without hosts in this shard still parse.
+    """
+    hostvars = inventory["_meta"]["hostvars"]
+    shard_by_key = {}
+    selected = set()
+    for host_name, host_vars in hostvars.items():
+        key = shard_key(host_name, host_vars)
+        shard = shard_by_key.get(key)
+        if shard is None:
+            shard = shard_by_key[key] = shard_of(key, shard_count)
+        if shard == shard_index:
+            selected.add(host_name)
+
+    sharded = {}
+    for group_name, group in inventory.items():
+        if group_name == "_meta":
+            continue
+        sharded[group_name] = dict(group)
+        if "hosts" in group:
+            sharded[group_name]["hosts"] = [host_name for host_name in group["hosts"] if host_name in selected]
+    sharded["_meta"] = {"hostvars": {host_name: host_vars for host_name, host_vars in hostvars.items() if host_name in selected}}
+    return sharded
+
+
+def common_vars(host_vars_list):
+    """Returns the variables every hostvars dict in host_vars_list has, with the same value in all of them."""
+    iterator = iter(host_vars_list)
+    common = dict(next(iterator, {}))
+    for host_vars in iterator:
+        if not common:
+            break
+        for name in [name for name, value in common.items() if name not in host_vars or host_vars[name] != value]:
+            del common[name]
+    return common
+
+
+# Group the compact '--list' output hoists shared variables into. It holds exactly this script's hosts, so the
+# variables never reach hosts that other inventory sources of the same run put in 'all' or in same-named groups.
+HOIST_GROUP = "tofu_inventory"
+# Ansible merges groups of the same depth in (priority, name) order; the highest priority keeps the hoisted
+# variables ahead of the other top-level groups, as they were while they were host variables.
+HOIST_GROUP_PRIORITY = 1000
+
+
+def hoist_group_vars(inventory):
+    """Returns a copy of inventory with the variables shared by all its hosts moved into the HOIST_GROUP group.
+
+    HOIST_GROUP is added as a child of 'all' with every host of the inventory, and hostvars keep only the rest.
+    Only variables every host has with the same value are hoisted, so each host's effective variables stay
+    the same. Returns the inventory unchanged if nothing is shared or it already has a group named HOIST_GROUP.
+    The input inventory is not modified.
+    """
+    hostvars = inventory["_meta"]["hostvars"]
+    shared = common_vars(hostvars.values())
+    shared.pop("ansible_group_priority", None)
+    if not shared or HOIST_GROUP in inventory:
+        return inventory
+
+    hoisted = {group_name: group for group_name, group in inventory.items() if group_name != "_meta"}
+    hoisted["all"] = dict(inventory["all"], children=[*inventory["all"].get("children", []), HOIST_GROUP])
+    hoisted[HOIST_GROUP] = {"hosts": list(hostvars), "vars": dict(shared, ansible_group_priority=HOIST_GROUP_PRIORITY)}
+    hoisted["_meta"] = {"hostvars": {
+        host_name: {name: value for name, value in host_vars.items() if name not in shared}
+        for host_name, host_vars in hostvars.items()
+    }}
+    return hoisted
+
+
+def render_inventory(inventory, compact=False):
+    """Returns the '--list' JSON: indented as is, or with shared variables hoisted and no whitespace."""
+    if compact:
+        return json.dumps(hoist_group_vars(inventory), separators=(",", ":"))
+    return json.dumps(inventory, indent=2)
+
+
+def use_compact_output():
+    """Returns True when TOFU_INVENTORY_COMPACT enables the compact '--list' output."""
+    return (os.environ.get("TOFU_INVENTORY_COMPACT") or "false").lower() in ("1", "true", "yes", "on")
+
+
+def jumphost_targets(inventory):
+    """Returns the distinct 'user@jumphost' hops used by an inventory's hosts, in first-seen order."""
+    targets = {}
+    for host_vars in inventory["_meta"]["hostvars"].values():
+        jumphost = host_vars.get("ansible_ssh_jumphost")
+        if jumphost:
+            targets[f'{host_vars.get("ansible_user", "ansible")}@{jumphost}'] = None
+    return list(targets)
+
+
+def open_jumphost_master(jump_target, control_dir, control_persist):
+    """Starts (or reuses) the multiplexed master for jump_target. Returns None on success, else an error message."""
+    control_path = os.path.expanduser(jumphost_control_path(control_dir, jump_target))
+    os.makedirs(os.path.dirname(control_path), mode=0o700, exist_ok=True)
+    # The master forks into the background and keeps the output streams open, so stderr goes to a file, not a pipe
+    with tempfile.TemporaryFile(mode="w+") as stderr_file:
+        try:
+            subprocess.run(
+                ["ssh", "-o", "ControlMaster=auto", "-o", f"ControlPersist={control_persist}", "-o", f"ControlPath={control_path}",
+                 "-o", "BatchMode=yes", "-o", f"ConnectTimeout={JUMPHOST_WARMUP_TIMEOUT_SECONDS}", jump_target, "true"],
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=stderr_file,
+                timeout=JUMPHOST_WARMUP_TIMEOUT_SECONDS * 2)
+        except subprocess.TimeoutExpired:
+            return f"timed out after {JUMPHOST_WARMUP_TIMEOUT_SECONDS * 2}s"
+        check = subprocess.run(["ssh", "-o", f"ControlPath={control_path}", "-O", "check", jump_target],
+                               stdin=subprocess.DEVNULL, capture_output=True, text=True)
+        if check.returncode == 0:
+            return None
+        stderr_file.seek(0)
+        return stderr_file.read().strip() or check.stderr.strip() or "master is not running"
+
+
+def warmup_jumphosts(inventory):
+    """Opens the shared master of every jumphost in inventory in parallel; returns {jump_target: error or None}.
+
+    Run before a play, so its first tasks on every target behind a jumphost find the hop already authenticated.
+    """
+    control_dir, control_persist = get_jumphost_multiplexing()
+    if control_persist is None:
+        print("Warning: Jumphost multiplexing is disabled by TOFU_INVENTORY_JUMPHOST_PERSIST; nothing to warm up.", file=sys.stderr)
+        return {}
+    targets = jumphost_targets(inventory)
+    if not targets:
+        return {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(targets), JUMPHOST_WARMUP_MAX_WORKERS)) as executor:
+        futures = [executor.submit(open_jumphost_master, target, control_dir, control_persist) for target in targets]
+        return {target: future.result() for target, future in zip(targets, futures)}
+
+
+def parse_args(argv=None):
+    """Parses the dynamic inventory command line."""
+    parser = argparse.ArgumentParser(description="Ansible dynamic inventory generated from OpenTofu state.")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--list", action="store_true", help="Output the full inventory (default).")
+    mode.add_argument("--host", metavar="HOSTNAME", help="Output the variables of a single host.")
+    mode.add_argument("--stats", action="store_true", help="Output host counts per module and per group.")
+    mode.add_argument("--warmup-jumphosts", action="store_true",
+                      help="Open the shared ssh master of every jumphost in parallel (run before a play).")
+    parser.add_argument("--refresh-cache", action="store_true",
+                        help="Ignore the cached inventory and rebuild it from the OpenTofu state.")
+    parser.add_argument("--source", metavar="[LABEL=]DIR[@WORKSPACE]", action="append",
+                        help="OpenTofu root (and workspace) to include; repeat to merge several. "
+                             "Defaults to the comma-separated TOFU_INVENTORY_SOURCES, else TOFU_INVENTORY_DIR.")
+    parser.add_argument("--compact", action="store_true", default=use_compact_output(),
+                        help=f"Hoist variables shared by all hosts into the '{HOIST_GROUP}' group and print compact JSON (or TOFU_INVENTORY_COMPACT).")
+    parser.add_argument("--limit", metavar="PATTERN", default=os.environ.get("TOFU_INVENTORY_LIMIT", ""),
+                        help="Only include the hosts this Ansible host pattern selects (e.g. 'web-eu-*,!web-eu-03'), "
+                             "evaluated while the state is read. Defaults to TOFU_INVENTORY_LIMIT.")
+    parser.add_argument("--shard", metavar="K/N", default=os.environ.get("TOFU_INVENTORY_SHARD", ""),
+                        help="Only output shard K of N (1 <= K <= N), for running one fleet from N controllers. "
+                             "Hosts behind the same jumphost stay in one shard. Defaults to TOFU_INVENTORY_SHARD.")
+    parser.add_argument("--module", metavar="ADDRESS", default=os.environ.get("TOFU_INVENTORY_MODULE_FILTER", ""),
+                        help="Only include hosts declared in this module (e.g. 'module.web') or its child modules.")
+    return parser.parse_args(argv)
+
+
+def report_jumphost_warmup(results):
+    """Prints the warmup outcome per jumphost and exits non-zero if any master could not be opened."""
+    print(json.dumps({target: error or "ok" for target, error in results.items()}, indent=2))
+    failed = [target for target, error in results.items() if error]
+    if failed:
+        print(f"Error: Could not open the ssh master of {len(failed)} jumphost(s): {', '.join(failed)}", file=sys.stderr)
+        sys.exit(1)
+
+
+def main():
+    args = parse_args()
+    try:
+        shard = parse_shard(args.shard)
+        host_pattern = parse_host_pattern(args.limit)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    source_specs = args.source or (os.environ.get("TOFU_INVENTORY_SOURCES") or "").split(",")
+    sources = parse_sources(source_specs)
+    if sources:
+        if args.stats:
+            statistics = {}
+            for source in sources:
+                records, _ = open_state_records(source.tofu_dir, source.workspace)
+                statistics[source.label] = collect_statistics(select_records(records, args.module, host_pattern))
+            print(json.dumps(statistics, indent=2))
+            return
+
+        inventory = get_merged_inventory(sources, refresh_cache=args.refresh_cache, module_filter=args.module, host_pattern=host_pattern)
+        if shard:
+            inventory = shard_inventory(inventory, *shard)
+        if args.warmup_jumphosts:
+            report_jumphost_warmup(warmup_jumphosts(inventory))
+        elif args.host is not None:
+            print(json.dumps(inventory["_meta"]["hostvars"].get(args.host, {}), indent=2))
+        else:
+            print(render_inventory(inventory, compact=args.compact))
+        return
+
+    tofu_dir = os.environ.get("TOFU_INVENTORY_DIR") or DEFAULT_TOFU_DIR
+    # The workspace tofu itself would select, so the native reader and the cache agree with it
+    workspace = os.environ.get("TF_WORKSPACE") or None
+
+    if args.host is not None:
+        host_vars = get_host_vars(tofu_dir, args.host, refresh_cache=args.refresh_cache, module_filter=args.module,
+                                  workspace=workspace, host_pattern=host_pattern)
+        # A host of another shard is unknown here, as it is to '--list'
+        if shard and host_vars and shard_of(shard_key(args.host, host_vars), shard[1]) != shard[0]:
+            host_vars = {}
+        print(json.dumps(host_vars, indent=2))
+        return
+
+    if args.stats:
+        records, _ = open_state_records(tofu_dir, workspace)
+        print(json.dumps(collect_statistics(select_records(records, args.module, host_pattern)), indent=2))
+        return
 
-    # Ensure all found groups are children of 'all'
-    for group_name in inventory.keys():
-        if group_name != "_meta" and group_name != "all" and group_name != "ungrouped":
-             if group_name not in inventory["all"]["children"]:
-                 inventory["all"]["children"].append(group_name)
+    inventory = get_inventory(tofu_dir, refresh_cache=args.refresh_cache, module_filter=args.module, workspace=workspace, host_pattern=host_pattern)
+    if shard:
+        inventory = shard_inventory(inventory, *shard)
 
+    if args.warmup_jumphosts:
+        report_jumphost_warmup(warmup_jumphosts(inventory))
+        return
 
     # Output the inventory in JSON format
-    print(json.dumps(inventory, indent=2))
-    # Removed explicit flush, revert to standard print behavior
-    # sys.stdout.flush()
+    print(render_inventory(inventory, compact=args.compact))
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
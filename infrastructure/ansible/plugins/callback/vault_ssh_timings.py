@@ -0,0 +1,127 @@
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import json
+import math
+import os
+import tempfile
+
+from ansible.plugins.callback import CallbackBase
+
+DOCUMENTATION = '''
+    name: vault_ssh_timings
+    type: aggregate
+    short_description: Summarises the vault_ssh_signer connection timings at the end of the playbook.
+    description:
+        - Reads the per-connection timings written by the C(vault_ssh_signer) connection plugin and prints, per phase
+          (config load, ControlMaster check, freshness check, lock wait, Vault request, certificate write, parent connect,
+          first command), how many connections went through it, the total time and the p50, p95 and maximum.
+        - Also prints how many connections renewed the certificate, timed out waiting for the renewal lock or reused a
+          ControlMaster.
+        - When O(timings_file) is not set, the timings are collected in a temporary file for this run only.
+          Only timings in the C(jsonl) format can be summarised.
+    author: "Your Name (Vault SSH Signer timings)"
+    requirements:
+      - enable in configuration, e.g. C(ANSIBLE_CALLBACKS_ENABLED=vault_ssh_timings)
+    options:
+      timings_file:
+          description: JSON lines file the connection plugin writes its timings to (its O(timings_file) option).
+          type: path
+          env: [{name: ANSIBLE_VAULT_SSH_TIMINGS_FILE}]
+          ini: [{section: callback_vault_ssh_timings, key: timings_file}]
+'''
+
+TIMINGS_FILE_ENV = 'ANSIBLE_VAULT_SSH_TIMINGS_FILE'
+TIMINGS_FORMAT_ENV = 'ANSIBLE_VAULT_SSH_TIMINGS_FORMAT'
+
+# Same order as the connection plugin's TIMING_PHASES, i.e. the order the phases happen in
+PHASE_ORDER = ('config_load', 'controlmaster_check', 'freshness_check', 'lock_wait', 'vault_request',
+               'cert_write', 'parent_connect', 'first_command')
+
+
+def percentile(sorted_values, percent):
+    """Returns the nearest-rank percentile of an ascending list of values."""
+    rank = max(1, int(math.ceil(percent / 100.0 * len(sorted_values))))
+    return sorted_values[rank - 1]
+
+
+def summarise_timings(records):
+    """Returns ({phase: (count, total, p50, p95, max)}, {counter: total}) for timing records."""
+    durations = {}
+    counters = {'connections': 0, 'renewed': 0, 'lock_timeout': 0, 'controlmaster_reuse': 0}
+    for record in records:
+        counters['connections'] += 1
+        for flag in ('renewed', 'lock_timeout', 'controlmaster_reuse'):
+            counters[flag] += int(bool(record.get(flag)))
+        for phase, seconds in (record.get('phases') or {}).items():
+            durations.setdefault(phase, []).append(seconds)
+
+    phases = {}
+    for phase, values in durations.items():
+        values.sort()
+        phases[phase] = (len(values), sum(values), percentile(values, 50), percentile(values, 95), values[-1])
+    return phases, counters
+
+
+class CallbackModule(CallbackBase):
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'aggregate'
+    CALLBACK_NAME = 'vault_ssh_timings'
+    CALLBACK_NEEDS_ENABLED = True
+
+    def __init__(self, *args, **kwargs):
+        super(CallbackModule, self).__init__(*args, **kwargs)
+        self._timings_file = None
+        self._owns_timings_file = False
+
+    def set_options(self, task_keys=None, var_options=None, direct=None):
+        super(CallbackModule, self).set_options(task_keys=task_keys, var_options=var_options, direct=direct)
+        if (os.environ.get(TIMINGS_FORMAT_ENV) or 'jsonl') != 'jsonl':
+            self._display.warning(f"vault_ssh_timings: {TIMINGS_FORMAT_ENV} is not 'jsonl'; there are no timings to summarise.")
+            return
+        timings_file = self.get_option('timings_file')
+        if timings_file:
+            self._timings_file = os.path.expanduser(timings_file)
+        else:
+            # Workers inherit the environment, so the connection plugin picks this file up as its timings_file
+            fd, self._timings_file = tempfile.mkstemp(prefix='vault-ssh-timings-', suffix='.jsonl')
+            os.close(fd)
+            self._owns_timings_file = True
+        os.environ[TIMINGS_FILE_ENV] = self._timings_file
+
+    def _read_records(self):
+        """Returns the timing records written by this run's workers, which are children of this process."""
+        records = []
+        try:
+            with open(self._timings_file, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if record.get('ppid') == os.getpid():
+                        records.append(record)
+        except OSError:
+            pass
+        return records
+
+    def v2_playbook_on_stats(self, stats):
+        if not self._timings_file:
+            return
+
+        phases, counters = summarise_timings(self._read_records())
+        if self._owns_timings_file:
+            try:
+                os.remove(self._timings_file)
+            except OSError:
+                pass
+        if not counters['connections']:
+            return
+
+        self._display.banner("VAULT SSH SIGNER TIMINGS")
+        self._display.display(f"{'phase':<20} {'count':>6} {'total':>10} {'p50':>10} {'p95':>10} {'max':>10}")
+        for phase in sorted(phases, key=lambda name: (PHASE_ORDER.index(name) if name in PHASE_ORDER else len(PHASE_ORDER), name)):
+            count, total, p50, p95, maximum = phases[phase]
+            self._display.display(f"{phase:<20} {count:>6} {total:>9.3f}s {p50:>9.4f}s {p95:>9.4f}s {maximum:>9.4f}s")
+        self._display.display(f"connections: {counters['connections']}, renewals: {counters['renewed']}, "
+                              f"lock timeouts: {counters['lock_timeout']}, ControlMaster reuse: {counters['controlmaster_reuse']}")
@@ -1,15 +1,36 @@
 from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
+import argparse
+import base64
+import contextlib
+import binascii
+import concurrent.futures
+import errno
+import fcntl
+import hashlib
+import http.client
+import json
 import os
 import re
+import shutil
+import socket
+import ssl
+import struct
 import subprocess
+import sys
+import tempfile
+import threading
 import time
+from collections import namedtuple
 from datetime import datetime, timezone, timedelta
+from urllib.parse import urlsplit
 
 from ansible.errors import AnsibleError, AnsibleConnectionFailure
+from ansible.module_utils.common.text.converters import to_bytes
 from ansible.plugins.connection.ssh import Connection as SSHConnection
 from ansible.utils.display import Display
+from ansible.utils.path import unfrackpath
 from ansible import constants as C
 
 display = Display()
@@ -26,8 +47,12 @@ DOCUMENTATION = '''
           SSH certificate signed by HashiCorp Vault. If the certificate is missing, expired, or
           nearing expiry (based on key_min_ttl_seconds), it requests a new one from Vault
           using the 'vault' CLI.
-        - The Ansible controller must have the 'vault' and 'ssh-keygen' CLIs installed and configured
-          for non-interactive authentication to Vault.
+        - Certificates are requested with a built-in HTTP client that keeps connections to Vault open, using
+          VAULT_ADDR, VAULT_TOKEN (or ~/.vault-token), VAULT_NAMESPACE, VAULT_CACERT/VAULT_CAPATH and
+          VAULT_SKIP_VERIFY. The 'vault' CLI is used as a fallback (see O(vault_client)).
+        - With O(approle_role_id) and O(approle_secret_id) the plugin logs in to Vault with AppRole itself and caches the
+          client token in memory and in O(token_cache_file), shared by all forks. It is renewed before it expires.
+        - Certificates are parsed in-process (OpenSSH wire format); 'ssh-keygen' is not needed.
         - The Vault signing path is derived by transforming the 'vault_ssh_ca_signing_role' variable
           (e.g., 'ssh-engine/roles/my-role' becomes 'ssh-engine/sign/my-role').
         - The principal for the certificate is sourced directly from the 'vault_ssh_ca_principal'
@@ -321,7 +346,8 @@ DOCUMENTATION = '''
           vars: [{name: vault_ssh_ca_signing_role}]
 
       vault_ssh_ca_principal:
-          description: "The principal name to request for the SSH certificate (e.g., 'ansible'). This variable is REQUIRED and sourced from inventory."
+          description: "The principal name to request for the SSH certificate (e.g., 'ansible'), or a comma-separated list of them
+                        (e.g., 'ansible,deploy'); a certificate is only reused if it lists all of them. This variable is REQUIRED and sourced from inventory."
           type: string
           env: [{name: ANSIBLE_VAULT_SSH_CA_PRINCIPAL}]
           vars: [{name: vault_ssh_ca_principal}]
@@ -334,12 +360,31 @@ DOCUMENTATION = '''
           vars: [{name: vault_ssh_public_key_path}]
 
       signed_key_path:
-          description: "Path to store the signed SSH certificate (e.g., '~/.ssh/id_rsa-cert.pub')."
+          description:
+              - "Path to store the signed SSH certificate (e.g., '~/.ssh/id_rsa-cert.pub'). Hosts sharing this path share one
+                 certificate, which is re-signed whenever a host needs a different principal. Ignored if O(cert_store_dir) is set."
           default: "~/.ssh/id_rsa-cert.pub"
           type: path
           env: [{name: ANSIBLE_VAULT_SSH_SIGNED_KEY_PATH}]
           vars: [{name: vault_ssh_signed_key_path}]
 
+      cert_store_dir:
+          description:
+              - "Directory holding one certificate per (signing role, principal, public key fingerprint) instead of the single
+                 O(signed_key_path). The certificate is passed to ssh with '-o CertificateFile'."
+              - "Use this when hosts need different roles or principals, so they no longer overwrite each other's certificate."
+              - "Command line options do not apply to ProxyJump (-J) hops; a jump host keeps using the certificate ssh finds by default."
+          type: path
+          env: [{name: ANSIBLE_VAULT_SSH_CERT_STORE_DIR}]
+          vars: [{name: vault_ssh_cert_store_dir}]
+
+      cert_store_max_entries:
+          description: "Maximum number of certificates kept in O(cert_store_dir); the least recently used ones are removed first."
+          type: int
+          default: 16
+          env: [{name: ANSIBLE_VAULT_SSH_CERT_STORE_MAX_ENTRIES}]
+          vars: [{name: vault_ssh_cert_store_max_entries}]
+
       key_min_ttl_seconds:
           description: "Minimum seconds the certificate should be valid for. If TTL is less, a new one is requested."
           type: int
@@ -353,13 +398,948 @@ DOCUMENTATION = '''
           default: false
           env: [{name: ANSIBLE_VAULT_SSH_FORCE_KEY_REFRESH}]
           vars: [{name: vault_ssh_force_key_refresh}]
+
+      renewal_lock_timeout_seconds:
+          description:
+              - "Maximum seconds to wait for another fork or process that is renewing the same certificate.
+                 Waiters reuse the certificate it wrote instead of requesting their own."
+          type: int
+          default: 60
+          env: [{name: ANSIBLE_VAULT_SSH_LOCK_TIMEOUT_SECONDS}]
+          vars: [{name: vault_ssh_lock_timeout_seconds}]
+
+      ssh_agent:
+          description:
+              - "Where the signed certificate is put for ssh. 'none' writes it to O(signed_key_path) (or O(cert_store_dir))."
+              - "'managed' starts a dedicated ssh-agent on O(ssh_agent_socket), shared by all forks and runs. The private key and
+                 certificate are loaded into it with a lifetime that ends when the certificate expires. The agent keeps running
+                 after the play; its PID is written to '<ssh_agent_socket>.pid'. 'external' uses the agent in SSH_AUTH_SOCK the
+                 same way."
+              - "In the agent modes no certificate file is written, and freshness is checked against the certificates the agent holds.
+                 ssh, including ProxyJump hops, takes its identities from the agent."
+          type: string
+          choices: ['none', 'managed', 'external']
+          default: none
+          env: [{name: ANSIBLE_VAULT_SSH_AGENT}]
+          vars: [{name: vault_ssh_agent}]
+
+      ssh_agent_socket:
+          description: "Socket of the ssh-agent started when O(ssh_agent=managed)."
+          type: path
+          default: "~/.ansible/vault_ssh_agent/agent.sock"
+          env: [{name: ANSIBLE_VAULT_SSH_AGENT_SOCKET}]
+          vars: [{name: vault_ssh_agent_socket}]
+
+      renewal_agent:
+          description:
+              - "Start a background renewal agent for the certificate. It is a detached helper process that renews
+                 the certificate before its TTL drops below key_min_ttl_seconds, so connections rarely wait for Vault.
+                 One agent runs per signed_key_path, and it exits when the ansible-playbook process that started it exits."
+              - "The agent can also be started by hand: C(python3 plugins/connection/vault_ssh_signer.py --help)."
+          type: bool
+          default: false
+          env: [{name: ANSIBLE_VAULT_SSH_RENEWAL_AGENT}]
+          vars: [{name: vault_ssh_renewal_agent}]
+
+      vault_client:
+          description:
+              - "How certificates are requested from Vault. 'http' uses the built-in client, 'cli' runs 'vault write'."
+              - "'auto' uses the built-in client when VAULT_ADDR and a token are available and falls back to the CLI
+                 if Vault cannot be reached or no token is found."
+          type: string
+          choices: ['auto', 'http', 'cli']
+          default: auto
+          env: [{name: ANSIBLE_VAULT_SSH_CLIENT}]
+          vars: [{name: vault_ssh_client}]
+
+      approle_role_id:
+          description:
+              - "RoleID of the Vault AppRole to log in with (e.g. the 'ansible-automation' role's 'ansible_approle_role_id' output).
+                 Together with O(approle_secret_id) it replaces VAULT_TOKEN/~/.vault-token for signing requests."
+          type: string
+          env: [{name: ANSIBLE_VAULT_SSH_APPROLE_ROLE_ID}]
+          vars: [{name: vault_ssh_approle_role_id}]
+
+      approle_secret_id:
+          description: "SecretID of the Vault AppRole to log in with (see O(approle_role_id))."
+          type: string
+          env: [{name: ANSIBLE_VAULT_SSH_APPROLE_SECRET_ID}]
+          vars: [{name: vault_ssh_approle_secret_id}]
+
+      approle_mount:
+          description: "Mount path of the AppRole auth method."
+          type: string
+          default: approle
+          env: [{name: ANSIBLE_VAULT_SSH_APPROLE_MOUNT}]
+          vars: [{name: vault_ssh_approle_mount}]
+
+      token_cache_file:
+          description:
+              - "File (mode 0600) caching the client token of the AppRole login with its expiry, shared by all forks and runs.
+                 A cached token is renewed once half of its TTL has passed, and a new login only happens when it can't be
+                 renewed any more. An empty value keeps the token in memory only, i.e. one login per worker process."
+          type: string
+          default: "~/.ansible/vault_ssh_signer/token.json"
+          env: [{name: ANSIBLE_VAULT_SSH_TOKEN_CACHE_FILE}]
+          vars: [{name: vault_ssh_token_cache_file}]
+
+      counters_file:
+          description:
+              - "JSON file counting, across forks and runs, how often connections reused a live ControlMaster socket
+                 (and so skipped all certificate work), evaluated the certificate, and renewed it. Unset disables the file;
+                 it is opt-in because every connection, including the ControlMaster fast path, locks and rewrites it."
+              - "A typical location is C(~/.ansible/vault_ssh_signer/counters.json)."
+          type: string
+          env: [{name: ANSIBLE_VAULT_SSH_COUNTERS_FILE}]
+          vars: [{name: vault_ssh_counters_file}]
+
+      timings_file:
+          description:
+              - "File receiving per-connection timings of the plugin's phases (config load, ControlMaster check, freshness
+                 check, lock wait, Vault request, certificate write, parent connect and first command), plus whether the
+                 connection renewed the certificate, timed out on the lock or reused a ControlMaster. Unset disables timings."
+              - "The C(vault_ssh_timings) callback plugin summarises them at the end of the play."
+          type: string
+          env: [{name: ANSIBLE_VAULT_SSH_TIMINGS_FILE}]
+          vars: [{name: vault_ssh_timings_file}]
+
+      timings_format:
+          description:
+              - "'jsonl' appends one JSON object per connection to O(timings_file)."
+              - "'prometheus' keeps O(timings_file) as a node_exporter textfile with a histogram per phase and counters
+                 (name it '*.prom' inside the textfile collector directory)."
+          type: string
+          choices: ['jsonl', 'prometheus']
+          default: jsonl
+          env: [{name: ANSIBLE_VAULT_SSH_TIMINGS_FORMAT}]
+          vars: [{name: vault_ssh_timings_format}]
 '''
 
 PLUGIN_NAME = "Vault SSH Signer"
 
+# Parsed OpenSSH certificate (see PROTOCOL.certkeys). valid_after/valid_before are aware UTC datetimes.
+# public_key_fingerprint is the 'SHA256:...' fingerprint of the certified public key, as 'ssh-keygen -l' prints it for the .pub file.
+SSHCertificate = namedtuple("SSHCertificate", ["key_type", "serial", "cert_type", "key_id", "principals", "valid_after", "valid_before",
+                                               "public_key_fingerprint"])
+
+# Number of length-prefixed public key fields between the nonce and the serial, per certificate key type.
+# Every field (mpint or string) is encoded as uint32 length + bytes, so they can be skipped without decoding.
+SSH_CERT_PUBLIC_KEY_FIELDS = {
+    "ssh-rsa-cert-v01@openssh.com": 2,                      # e, n
+    "ssh-dss-cert-v01@openssh.com": 4,                      # p, q, g, y
+    "ecdsa-sha2-nistp256-cert-v01@openssh.com": 2,          # curve, public key
+    "ecdsa-sha2-nistp384-cert-v01@openssh.com": 2,
+    "ecdsa-sha2-nistp521-cert-v01@openssh.com": 2,
+    "ssh-ed25519-cert-v01@openssh.com": 1,                  # public key
+    "sk-ecdsa-sha2-nistp256-cert-v01@openssh.com": 3,       # curve, public key, application
+    "sk-ssh-ed25519-cert-v01@openssh.com": 2,               # public key, application
+}
+SSH_CERT_VALID_FOREVER = 0xFFFFFFFFFFFFFFFF
+
+
+# Parsed certificates are also written next to the certificate ('<signed_key_path><suffix>'), so sibling
+# forks can reuse them without re-reading the certificate. Entries are only trusted for the same file identity.
+CERT_STATUS_SIDECAR_SUFFIX = ".status.json"
+
+
+VAULT_HTTP_TIMEOUT_SECONDS = 30
+
+
+class VaultRequestError(Exception):
+    """Vault answered with an error status; errors holds the messages from its JSON body."""
+
+    def __init__(self, status, errors):
+        super().__init__(f"HTTP {status}: {'; '.join(errors) if errors else '(no error message)'}")
+        self.status = status
+        self.errors = errors
+
+
+class VaultHTTPClient:
+    """Minimal Vault API client over keep-alive connections.
+
+    Clients are shared per Vault address and TLS settings (see from_env), and each keeps a pool of idle
+    connections, so repeated requests from one process skip the TCP and TLS handshakes.
+    """
+
+    _clients = {}
+    _clients_lock = threading.Lock()
+
+    def __init__(self, addr, token, namespace=None, cacert=None, capath=None, skip_verify=False,
+                 timeout=VAULT_HTTP_TIMEOUT_SECONDS):
+        url = urlsplit(addr)
+        if url.scheme not in ('http', 'https') or not url.hostname:
+            raise ValueError(f"unsupported Vault address '{addr}'")
+        self.addr = addr
+        self.token = token
+        self.namespace = namespace
+        self.timeout = timeout
+        self._scheme = url.scheme
+        self._host = url.hostname
+        self._port = url.port
+        self._base_path = url.path.rstrip('/')
+        self._ssl_context = None
+        if url.scheme == 'https':
+            self._ssl_context = ssl.create_default_context(cafile=cacert, capath=capath)
+            if skip_verify:
+                self._ssl_context.check_hostname = False
+                self._ssl_context.verify_mode = ssl.CERT_NONE
+        self._idle_connections = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, token=None):
+        """Returns the shared client for the Vault CLI environment variables, or None if VAULT_ADDR or a token is missing.
+
+        token (e.g. from an AppRole login) takes the place of VAULT_TOKEN and ~/.vault-token. An empty string
+        gives a client without a token, which can only log in.
+        """
+        addr = os.getenv('VAULT_ADDR')
+        if token is None:
+            token = os.getenv('VAULT_TOKEN')
+            if not token:
+                try:
+                    with open(os.path.expanduser('~/.vault-token'), 'r') as f:
+                        token = f.read().strip()
+                except OSError:
+                    token = None
+            if not token:
+                return None
+        if not addr:
+            return None
+
+        settings = (addr, token, os.getenv('VAULT_NAMESPACE') or None, os.getenv('VAULT_CACERT') or None,
+                    os.getenv('VAULT_CAPATH') or None,
+                    os.getenv('VAULT_SKIP_VERIFY', '').lower() in ('1', 'true', 'yes'))
+        with cls._clients_lock:
+            client = cls._clients.get(settings)
+            if client is None:
+                client = cls(*settings)
+                cls._clients[settings] = client
+            return client
+
+    def _new_connection(self):
+        if self._scheme == 'https':
+            return http.client.HTTPSConnection(self._host, self._port, timeout=self.timeout, context=self._ssl_context)
+        return http.client.HTTPConnection(self._host, self._port, timeout=self.timeout)
+
+    def _checkout(self):
+        with self._lock:
+            if self._idle_connections:
+                return self._idle_connections.pop(), True
+        return self._new_connection(), False
+
+    def _checkin(self, conn):
+        with self._lock:
+            self._idle_connections.append(conn)
+
+    def request(self, method, path, payload=None):
+        """Sends a request to /v1/<path> and returns the decoded JSON response (None for empty bodies)."""
+        headers = {'X-Vault-Request': 'true', 'Content-Type': 'application/json'}
+        if self.token:
+            headers['X-Vault-Token'] = self.token
+        if self.namespace:
+            headers['X-Vault-Namespace'] = self.namespace
+        body = json.dumps(payload) if payload is not None else None
+        url = f"{self._base_path}/v1/{path.lstrip('/')}"
+
+        conn, reused = self._checkout()
+        try:
+            try:
+                conn.request(method, url, body=body, headers=headers)
+                response = conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                if not reused:
+                    raise
+                # The server closed an idle keep-alive connection; retry once on a fresh one
+                conn.close()
+                conn = self._new_connection()
+                conn.request(method, url, body=body, headers=headers)
+                response = conn.getresponse()
+            data = response.read()
+        except Exception:
+            conn.close()
+            raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            self._checkin(conn)
+
+        try:
+            decoded = json.loads(data) if data else None
+        except ValueError:
+            decoded = None
+        if response.status >= 400:
+            errors = decoded.get('errors', []) if isinstance(decoded, dict) else [data.decode('utf-8', 'replace').strip()]
+            raise VaultRequestError(response.status, errors)
+        return decoded
+
+    def sign_ssh_key(self, sign_path, public_key, valid_principals):
+        """Signs public_key at <mount>/sign/<role> (sign_path) and returns the signed certificate."""
+        response = self.request('POST', sign_path, {'public_key': public_key, 'valid_principals': valid_principals})
+        signed_key = ((response or {}).get('data') or {}).get('signed_key')
+        return signed_key.strip() if signed_key else ''
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _flock_blocking(fd, timeout):
+    """Takes an exclusive flock on fd, waiting at most timeout seconds. Returns True once it is held.
+
+    flock(2) itself has no timeout, so the blocking call runs on a daemon thread. fd is closed unless
+    the lock is held: on timeout the thread drops the lock as soon as it gets it and closes fd.
+    """
+    state = {'locked': False, 'abandoned': False, 'error': None}
+    done = threading.Condition()
+
+    def wait_for_lock():
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        except OSError as e:
+            with done:
+                if not state['abandoned']:
+                    state['error'] = e
+                    done.notify()
+                    return
+            os.close(fd)
+            return
+        with done:
+            if not state['abandoned']:
+                state['locked'] = True
+                done.notify()
+                return
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    with done:
+        threading.Thread(target=wait_for_lock, name='certificate-lock-waiter', daemon=True).start()
+        done.wait_for(lambda: state['locked'] or state['error'] is not None, timeout=max(timeout, 0))
+        if state['locked']:
+            return True
+        if state['error'] is not None:
+            os.close(fd)
+            raise state['error']
+        state['abandoned'] = True
+        return False
+
+
+class CertificateLock:
+    """Exclusive lock serialising certificate renewals across forks, processes and threads.
+
+    Uses flock(2), which the kernel releases when the holder exits, so a crashed fork cannot leave a stale
+    lock behind. A waiter blocks in flock on a helper thread, bounded by the timeout, and so wakes up as
+    soon as the holder is done. The holder's PID is written to the lock file. On filesystems without flock
+    support, an O_EXCL lock file is polled for instead and removed when its PID is no longer running.
+    """
+
+    POLL_INITIAL_SECONDS = 0.01
+    POLL_MAX_SECONDS = 0.1
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+        self._exclusive_file = False
+
+    def holder_pid(self):
+        try:
+            with open(self.path, 'r') as f:
+                return int(f.read().strip() or 0) or None
+        except (OSError, ValueError):
+            return None
+
+    def acquire(self, timeout):
+        """Waits up to timeout seconds for the lock. Returns True once it is held, False on timeout."""
+        lock_dir = os.path.dirname(self.path)
+        if lock_dir:
+            os.makedirs(lock_dir, mode=0o700, exist_ok=True)
+        deadline = time.monotonic() + timeout
+
+        fd = os.open(self.path, os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # The descriptor is handed over: the helper thread closes it if we stop waiting
+            if not _flock_blocking(fd, deadline - time.monotonic()):
+                return False
+        except OSError as e:
+            os.close(fd)
+            if e.errno in (errno.ENOLCK, errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL):
+                return self._acquire_exclusive_file(deadline)
+            raise
+
+        os.ftruncate(fd, 0)
+        os.write(fd, f"{os.getpid()}\n".encode())
+        self._fd = fd
+        return True
+
+    def _acquire_exclusive_file(self, deadline):
+        delay = self.POLL_INITIAL_SECONDS
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600)
+            except FileExistsError:
+                pid = self.holder_pid()
+                if pid is not None and not _pid_alive(pid):
+                    # The holder died without cleaning up
+                    try:
+                        os.remove(self.path)
+                    except FileNotFoundError:
+                        pass
+                    continue
+                if time.monotonic() >= deadline:
+                    return False
+                time.sleep(delay)
+                delay = min(delay * 2, self.POLL_MAX_SECONDS)
+                continue
+            os.write(fd, f"{os.getpid()}\n".encode())
+            os.close(fd)
+            self._exclusive_file = True
+            return True
+
+    def release(self):
+        """Releases the lock. Returns False if it was not held."""
+        if self._fd is not None:
+            # The lock file itself is kept: unlinking it would let a waiter lock an orphaned inode
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+            return True
+        if self._exclusive_file:
+            self._exclusive_file = False
+            os.remove(self.path)
+            return True
+        return False
+
+
+# AppRole logins: cached client tokens are renewed once less than this share of their TTL is left, and never
+# handed out with less than APPROLE_TOKEN_MIN_REMAINING_SECONDS to go.
+APPROLE_TOKEN_RENEW_FRACTION = 0.5
+APPROLE_TOKEN_MIN_REMAINING_SECONDS = 60
+APPROLE_TOKEN_LOCK_TIMEOUT_SECONDS = 30
+TOKEN_CACHE_FORMAT_VERSION = 1
+
+
+class AppRoleTokenCache:
+    """Client tokens from Vault AppRole logins, kept per process in memory and in a file shared by all forks and runs.
+
+    A cached token is used as is until it is due for renewal. It is then renewed (auth/token/renew-self),
+    and only a token that is gone or can't be renewed far enough leads to a new login. Renewals and
+    logins update the file under a CertificateLock: when many forks find the token due at once, one of
+    them renews it and the others use its result. Tokens are cached per Vault address, namespace, auth
+    mount and RoleID.
+    """
+
+    _tokens = {}
+    _tokens_lock = threading.Lock()
+
+    def __init__(self, addr, role_id, secret_id, mount='approle', cache_path=None, namespace=None):
+        self.addr = addr
+        self.role_id = role_id
+        self.secret_id = secret_id
+        self.mount = mount.strip('/')
+        self.cache_path = cache_path
+        self.key = hashlib.sha256(f"{addr}\0{namespace or ''}\0{self.mount}\0{role_id}".encode('utf-8')).hexdigest()[:16]
+
+    @staticmethod
+    def _entry_from_auth(auth):
+        """Returns the cache entry for the 'auth' block of a login or renewal response (expires_at None: no expiry)."""
+        ttl = int(auth.get('lease_duration') or 0)
+        return {
+            'token': auth['client_token'],
+            'accessor': auth.get('accessor'),
+            'ttl': ttl,
+            'renewable': bool(auth.get('renewable')),
+            'expires_at': time.time() + ttl if ttl else None,
+        }
+
+    @staticmethod
+    def _remaining(entry):
+        return float('inf') if entry['expires_at'] is None else entry['expires_at'] - time.time()
+
+    def _is_current(self, entry, rejected_token=None):
+        """Returns True if entry's token can be used without renewing it first."""
+        if not entry or entry.get('token') == rejected_token:
+            return False
+        return self._remaining(entry) > max(APPROLE_TOKEN_MIN_REMAINING_SECONDS, entry['ttl'] * APPROLE_TOKEN_RENEW_FRACTION)
+
+    def _read_cache_file(self):
+        if not self.cache_path:
+            return None
+        try:
+            with open(self.cache_path, 'r') as f:
+                data = json.load(f)
+            entry = data['tokens'][self.key] if data.get('version') == TOKEN_CACHE_FORMAT_VERSION else None
+            return entry if entry and entry.get('token') else None
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return None
+
+    def _write_cache_file(self, entry):
+        if not self.cache_path:
+            return
+        cache_dir = os.path.dirname(self.cache_path)
+        try:
+            with open(self.cache_path, 'r') as f:
+                data = json.load(f)
+            if data.get('version') != TOKEN_CACHE_FORMAT_VERSION or not isinstance(data.get('tokens'), dict):
+                raise ValueError
+        except (OSError, ValueError, AttributeError):
+            data = {'version': TOKEN_CACHE_FORMAT_VERSION, 'tokens': {}}
+        data['tokens'][self.key] = entry
+
+        if cache_dir:
+            os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=".token-", dir=cache_dir or ".")
+        try:
+            # mkstemp creates the file with mode 0600, so the token is never readable by others
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.cache_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _remember(self, entry):
+        with self._tokens_lock:
+            AppRoleTokenCache._tokens[self.key] = entry
+
+    def _client(self, token):
+        client = VaultHTTPClient.from_env(token=token)
+        if client is None:
+            raise AnsibleError(f"{PLUGIN_NAME}: VAULT_ADDR must be set to log in with AppRole at auth/{self.mount}.")
+        return client
+
+    def _login(self):
+        client = self._client('')
+        response = client.request('POST', f'auth/{self.mount}/login', {'role_id': self.role_id, 'secret_id': self.secret_id})
+        return self._entry_from_auth(response['auth'])
+
+    def _renew(self, entry):
+        client = self._client(entry['token'])
+        response = client.request('POST', 'auth/token/renew-self', {})
+        return self._entry_from_auth(response['auth'])
+
+    def token(self, rejected_token=None):
+        """Returns a client token that is not due for renewal, renewing or logging in only when needed.
+
+        rejected_token is a token Vault just refused (e.g. revoked); it is never returned again.
+        Raises VaultRequestError, OSError or http.client.HTTPException when Vault can't be reached or refuses the login,
+        and AnsibleError when VAULT_ADDR is not set.
+        """
+        entry = self._tokens.get(self.key)
+        if self._is_current(entry, rejected_token):
+            return entry['token']
+        entry = self._read_cache_file()
+        if self._is_current(entry, rejected_token):
+            self._remember(entry)
+            return entry['token']
+
+        lock = CertificateLock(self.cache_path + ".lock") if self.cache_path else None
+        locked = lock is not None and lock.acquire(APPROLE_TOKEN_LOCK_TIMEOUT_SECONDS)
+        try:
+            # Another fork may have renewed the token or logged in while we waited
+            entry = self._read_cache_file() or self._tokens.get(self.key)
+            if self._is_current(entry, rejected_token):
+                self._remember(entry)
+                return entry['token']
+
+            renewed = None
+            if entry and entry.get('renewable') and entry['token'] != rejected_token and self._remaining(entry) > 0:
+                try:
+                    renewed = self._renew(entry)
+                except (VaultRequestError, OSError, http.client.HTTPException, KeyError, TypeError) as e:
+                    display.vv(f"{PLUGIN_NAME}: Could not renew the cached AppRole token ({e}); logging in again.")
+                # A token at its max TTL is renewed for less than asked; log in for a full TTL instead. The renewal
+                # is measured against the TTL the token had, as its own shortened TTL would always look current.
+                if renewed is not None and not self._is_current(dict(renewed, ttl=max(renewed['ttl'], entry['ttl']))):
+                    renewed = None
+            entry = renewed or self._login()
+            try:
+                self._write_cache_file(entry)
+            except OSError as e:
+                display.vv(f"{PLUGIN_NAME}: Could not write the token cache '{self.cache_path}': {e}")
+            self._remember(entry)
+            return entry['token']
+        finally:
+            if locked:
+                lock.release()
+
+
+# Renewal agent: renews this many seconds before connections would consider the certificate stale,
+# re-checking at least every RENEWAL_AGENT_POLL_SECONDS (and after a failed renewal).
+RENEWAL_AGENT_MARGIN_SECONDS = 300
+RENEWAL_AGENT_POLL_SECONDS = 30
+RENEWAL_AGENT_LOCK_SUFFIX = ".agent.lock"
+RENEWAL_AGENT_LOG_SUFFIX = ".agent.log"
+
+
+# Certificate store: '<cert_store_dir>/<identity digest><suffix>'. Last use is tracked in the certificate's
+# atime (refreshed at most every CERT_STORE_TOUCH_INTERVAL_SECONDS), which leaves its mtime-based identity intact.
+CERT_STORE_SUFFIX = "-cert.pub"
+CERT_STORE_TOUCH_INTERVAL_SECONDS = 60
+
+
+def _ssh_key_blob_fingerprint(blob):
+    return "SHA256:" + base64.b64encode(hashlib.sha256(blob).digest()).decode('ascii').rstrip('=')
+
+
+def _decode_ssh_public_key_line(key_text):
+    fields = key_text.split()
+    if len(fields) < 2:
+        raise ValueError("not an OpenSSH public key line")
+    try:
+        return fields[0], base64.b64decode(fields[1], validate=True)
+    except (binascii.Error, ValueError) as e:
+        raise ValueError(f"invalid base64 data: {e}")
+
+
+def ssh_public_key_fingerprint(public_key_text):
+    """Returns the 'SHA256:...' fingerprint of an OpenSSH public key line, as printed by 'ssh-keygen -l'."""
+    return _ssh_key_blob_fingerprint(_decode_ssh_public_key_line(public_key_text)[1])
+
+
+def cert_store_path(store_dir, sign_path, principal, public_key_fingerprint):
+    """Returns the store location of the certificate for one (sign path, principal, public key) identity."""
+    identity = "\0".join((sign_path, principal, public_key_fingerprint))
+    return os.path.join(store_dir, hashlib.sha256(identity.encode('utf-8')).hexdigest()[:24] + CERT_STORE_SUFFIX)
+
+
+def _ssh_timestamp(value):
+    if value >= SSH_CERT_VALID_FOREVER:
+        return datetime.max.replace(tzinfo=timezone.utc)
+    try:
+        return datetime.fromtimestamp(value, timezone.utc)
+    except (OverflowError, OSError, ValueError):
+        # Past what datetime can hold (year 9999) without being ssh's 'forever': a corrupt certificate
+        raise ValueError(f"invalid certificate timestamp {value}")
+
+
+def _ssh_timestamp_value(dt):
+    if dt == datetime.max.replace(tzinfo=timezone.utc):
+        return SSH_CERT_VALID_FOREVER
+    return int(dt.timestamp())
+
+
+def parse_ssh_certificate(cert_text):
+    """Parses an OpenSSH certificate ('<key type> <base64> [comment]') without calling ssh-keygen.
+
+    Raises ValueError if the text is not a supported, well-formed certificate.
+    """
+    line_key_type, blob = _decode_ssh_public_key_line(cert_text)
+    cert = parse_ssh_certificate_blob(blob)
+    if line_key_type != cert.key_type:
+        raise ValueError(f"key type mismatch ('{line_key_type}' vs '{cert.key_type}')")
+    return cert
+
+
+def parse_ssh_certificate_blob(blob):
+    """Parses the binary form of an OpenSSH certificate, as found base64-encoded in -cert.pub files and in ssh-agent replies."""
+    offset = 0
+
+    def read_string():
+        nonlocal offset
+        if offset + 4 > len(blob):
+            raise ValueError("truncated certificate")
+        (length,) = struct.unpack_from(">I", blob, offset)
+        offset += 4
+        if offset + length > len(blob):
+            raise ValueError("truncated certificate")
+        value = blob[offset:offset + length]
+        offset += length
+        return value
+
+    def read_uint(fmt, size):
+        nonlocal offset
+        if offset + size > len(blob):
+            raise ValueError("truncated certificate")
+        (value,) = struct.unpack_from(fmt, blob, offset)
+        offset += size
+        return value
+
+    key_type = read_string().decode("ascii", "replace")
+    if key_type not in SSH_CERT_PUBLIC_KEY_FIELDS:
+        raise ValueError(f"unsupported certificate type '{key_type}'")
+
+    read_string()  # nonce
+    public_key_start = offset
+    for _ in range(SSH_CERT_PUBLIC_KEY_FIELDS[key_type]):
+        read_string()
+    # The plain public key is its type name followed by the same fields, e.g. 'ssh-ed25519' + key
+    plain_key_type = key_type.replace("-cert-v01@openssh.com", "") + ("@openssh.com" if key_type.startswith("sk-") else "")
+    public_key_blob = struct.pack(">I", len(plain_key_type)) + plain_key_type.encode("ascii") + blob[public_key_start:offset]
+    serial = read_uint(">Q", 8)
+    cert_type = read_uint(">I", 4)
+    key_id = read_string().decode("utf-8", "replace")
+
+    principals_blob = read_string()
+    principals = []
+    principals_offset = 0
+    while principals_offset < len(principals_blob):
+        if principals_offset + 4 > len(principals_blob):
+            raise ValueError("truncated principals")
+        (length,) = struct.unpack_from(">I", principals_blob, principals_offset)
+        principals_offset += 4
+        if principals_offset + length > len(principals_blob):
+            raise ValueError("truncated principals")
+        principals.append(principals_blob[principals_offset:principals_offset + length].decode("utf-8", "replace"))
+        principals_offset += length
+
+    valid_after = _ssh_timestamp(read_uint(">Q", 8))
+    valid_before = _ssh_timestamp(read_uint(">Q", 8))
+    # critical options, extensions, reserved, signature key and signature follow; validity lives above
+
+    return SSHCertificate(key_type, serial, cert_type, key_id, tuple(principals), valid_after, valid_before,
+                          _ssh_key_blob_fingerprint(public_key_blob))
+
+
+SSH_AGENT_SUCCESS = 6
+SSH_AGENTC_REQUEST_IDENTITIES = 11
+SSH_AGENT_IDENTITIES_ANSWER = 12
+SSH_AGENTC_REMOVE_IDENTITY = 18
+
+
+def ssh_agent_request(socket_path, message, timeout=5):
+    """Sends one request to the ssh-agent listening on socket_path and returns its reply.
+
+    Speaks the agent protocol directly, so a request costs a socket round-trip instead of an 'ssh-add' process.
+    Raises OSError if the agent cannot be reached and ValueError if it hangs up without replying.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        sock.sendall(struct.pack(">I", len(message)) + message)
+
+        def recv_exactly(size):
+            data = b""
+            while len(data) < size:
+                chunk = sock.recv(size - len(data))
+                if not chunk:
+                    raise ValueError("ssh-agent closed the connection")
+                data += chunk
+            return data
+
+        (length,) = struct.unpack(">I", recv_exactly(4))
+        return recv_exactly(length)
+
+
+def ssh_agent_remove_identity(socket_path, key_blob, timeout=5):
+    """Removes the identity (a key or a certificate) with key_blob from the ssh-agent. Returns False if the agent refused."""
+    reply = ssh_agent_request(socket_path, struct.pack(">BI", SSH_AGENTC_REMOVE_IDENTITY, len(key_blob)) + key_blob, timeout)
+    return reply[:1] == bytes([SSH_AGENT_SUCCESS])
+
+
+def ssh_agent_identities(socket_path, timeout=5):
+    """Returns the (key blob, comment) pairs held by the ssh-agent listening on socket_path.
+
+    Raises OSError if the agent cannot be reached and ValueError on an unexpected reply.
+    """
+    reply = ssh_agent_request(socket_path, bytes([SSH_AGENTC_REQUEST_IDENTITIES]), timeout)
+    if not reply or reply[0] != SSH_AGENT_IDENTITIES_ANSWER:
+        raise ValueError(f"unexpected ssh-agent reply type {reply[0] if reply else None}")
+    (count,) = struct.unpack_from(">I", reply, 1)
+    offset = 5
+    identities = []
+    for _ in range(count):
+        fields = []
+        for _ in range(2):
+            (field_length,) = struct.unpack_from(">I", reply, offset)
+            offset += 4
+            fields.append(reply[offset:offset + field_length])
+            offset += field_length
+        identities.append((fields[0], fields[1].decode("utf-8", "replace")))
+    return identities
+
+
+# ControlPath tokens that can be expanded from the connection options alone (see ssh_config(5), TOKENS)
+SSH_CONTROL_PATH_TOKEN_RE = re.compile(r"%(.)")
+
+
+def expand_ssh_control_path(control_path, host, port, user):
+    """Expands the %h, %p, %r and %% tokens of an ssh ControlPath. Returns None if it uses any other token."""
+    values = {'h': str(host), 'p': str(port or 22), '%': '%'}
+    if user:
+        # Without remote_user, %r is whatever ssh_config or the local login name gives
+        values['r'] = str(user)
+    unknown = []
+
+    def replace(match):
+        token = match.group(1)
+        if token not in values:
+            unknown.append(token)
+            return match.group(0)
+        return values[token]
+
+    expanded = SSH_CONTROL_PATH_TOKEN_RE.sub(replace, control_path)
+    return None if unknown else os.path.expanduser(expanded)
+
+
+def control_socket_alive(socket_path, timeout=1):
+    """Returns True if an ssh ControlMaster accepts connections on socket_path.
+
+    A socket left behind by a master that died refuses connections, so it is not mistaken for a live one.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        try:
+            sock.connect(socket_path)
+        except OSError:
+            return False
+    return True
+
+
+# Usage counters, shared by all forks and runs through a JSON file (see the counters_file option)
+COUNTER_CONTROLMASTER_REUSE = "controlmaster_reuse"
+COUNTER_CERT_EVALUATIONS = "cert_evaluations"
+COUNTER_CERT_RENEWALS = "cert_renewals"
+COUNTER_LOCK_TIMEOUTS = "lock_timeouts"
+COUNTERS_LOCK_TIMEOUT_SECONDS = 2
+
+
+def record_counters(counters_path, increments):
+    """Adds increments ({name: amount}) to the counters stored in counters_path and returns the new totals.
+
+    Best effort: returns None, leaving the file untouched, if it cannot be locked or written.
+    """
+    counters_dir = os.path.dirname(counters_path)
+    lock = CertificateLock(counters_path + ".lock")
+    try:
+        if not lock.acquire(COUNTERS_LOCK_TIMEOUT_SECONDS):
+            return None
+    except OSError:
+        return None
+    tmp_path = None
+    try:
+        try:
+            with open(counters_path, 'r') as f:
+                counters = json.load(f)
+            if not isinstance(counters, dict):
+                counters = {}
+        except (OSError, ValueError):
+            counters = {}
+        for name, amount in increments.items():
+            counters[name] = int(counters.get(name, 0)) + amount
+        counters['updated_at'] = datetime.now(timezone.utc).isoformat()
+
+        fd, tmp_path = tempfile.mkstemp(prefix=".counters-", dir=counters_dir or ".")
+        with os.fdopen(fd, 'w') as f:
+            json.dump(counters, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, counters_path)
+        tmp_path = None
+        return counters
+    except (OSError, ValueError, TypeError):
+        return None
+    finally:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        lock.release()
+
+
+# Per-connection phase timings (see the timings_file option). The parent's _connect only prepares the
+# connection; the SSH handshake (or ControlMaster reuse) happens in the first command, timed as 'first_command'.
+TIMING_PHASES = ('config_load', 'controlmaster_check', 'freshness_check', 'lock_wait', 'vault_request',
+                 'cert_write', 'parent_connect', 'first_command')
+TIMING_HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+PROMETHEUS_METRIC_PREFIX = "vault_ssh_signer"
+
+
+def append_timing_record(timings_path, record):
+    """Appends record as one JSON line. A single O_APPEND write keeps lines from concurrent forks whole."""
+    timings_dir = os.path.dirname(timings_path)
+    if timings_dir:
+        os.makedirs(timings_dir, mode=0o700, exist_ok=True)
+    line = (json.dumps(record, sort_keys=True) + "\n").encode()
+    fd = os.open(timings_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def render_prometheus_textfile(state):
+    """Renders aggregated timings (as kept by update_prometheus_textfile) in the Prometheus text format."""
+    prefix = PROMETHEUS_METRIC_PREFIX
+    lines = [
+        f"# HELP {prefix}_phase_seconds Time spent per connection in each phase of the vault_ssh_signer connection plugin.",
+        f"# TYPE {prefix}_phase_seconds histogram",
+    ]
+    for phase in sorted(state['phases']):
+        histogram = state['phases'][phase]
+        for bound, count in zip(TIMING_HISTOGRAM_BUCKETS, histogram['buckets']):
+            lines.append(f'{prefix}_phase_seconds_bucket{{phase="{phase}",le="{bound}"}} {count}')
+        lines.append(f'{prefix}_phase_seconds_bucket{{phase="{phase}",le="+Inf"}} {histogram["count"]}')
+        lines.append(f'{prefix}_phase_seconds_sum{{phase="{phase}"}} {histogram["sum"]:.6f}')
+        lines.append(f'{prefix}_phase_seconds_count{{phase="{phase}"}} {histogram["count"]}')
+    for name in sorted(state['counters']):
+        lines.append(f"# TYPE {prefix}_{name}_total counter")
+        lines.append(f"{prefix}_{name}_total {state['counters'][name]}")
+    return "\n".join(lines) + "\n"
+
+
+def update_prometheus_textfile(textfile_path, record):
+    """Adds record to the histograms and counters of a node_exporter textfile, shared by all forks.
+
+    The running totals are kept in '<textfile_path>.state.json'; both files are replaced atomically under a lock.
+    Returns False if the lock could not be taken in time.
+    """
+    state_path = textfile_path + ".state.json"
+    lock = CertificateLock(textfile_path + ".lock")
+    if not lock.acquire(COUNTERS_LOCK_TIMEOUT_SECONDS):
+        return False
+    try:
+        try:
+            with open(state_path, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {}
+        phases = state.setdefault('phases', {})
+        counters = state.setdefault('counters', {})
+
+        for phase, seconds in record['phases'].items():
+            histogram = phases.setdefault(phase, {'buckets': [0] * len(TIMING_HISTOGRAM_BUCKETS), 'sum': 0.0, 'count': 0})
+            for index, bound in enumerate(TIMING_HISTOGRAM_BUCKETS):
+                if seconds <= bound:
+                    histogram['buckets'][index] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+        for name, amount in (('connections', 1),
+                             ('renewals', int(record['renewed'])),
+                             ('lock_timeouts', int(record['lock_timeout'])),
+                             ('controlmaster_reuse', int(record['controlmaster_reuse']))):
+            counters[name] = counters.get(name, 0) + amount
+
+        for path, content in ((state_path, json.dumps(state)), (textfile_path, render_prometheus_textfile(state))):
+            # node_exporter ignores files not ending in .prom, so the temporary file never gets scraped half-written
+            fd, tmp_path = tempfile.mkstemp(prefix=".timings-", suffix=".tmp", dir=os.path.dirname(path) or ".")
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    f.write(content)
+                os.chmod(tmp_path, 0o644)
+                os.replace(tmp_path, path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+        return True
+    finally:
+        lock.release()
+
+
 class Connection(SSHConnection):
     transport = 'vault_ssh_signer'
     _host_logged_initial_cert_status_this_process = {}
+    # Process-wide cache of parsed certificates: signed_key_path -> (file identity, SSHCertificate).
+    # Shared by every connection instance of this worker, so hosts sharing one certificate parse it once.
+    _cert_status_cache = {}
+    # Counts of this process, by counter name (see record_counters for the totals across processes)
+    _counters = {}
 
     def __init__(self, *args, **kwargs):
         super(Connection, self).__init__(*args, **kwargs)
@@ -367,8 +1347,30 @@ class Connection(SSHConnection):
         self._resolved_signed_key_path = None
         self._resolved_vault_sign_path = None
         self._resolved_vault_ssh_ca_principal = None
+        self._requested_principals = ()
         self._resolved_key_min_ttl_seconds = None
         self._resolved_force_key_refresh = None
+        self._resolved_vault_client = None
+        self._resolved_lock_timeout_seconds = None
+        self._resolved_renewal_agent = None
+        self._resolved_cert_store_max_entries = None
+        self._uses_cert_store = False
+        self._resolved_ssh_agent = None
+        self._resolved_ssh_agent_socket = None
+        self._public_key_fingerprint = None
+        self._resolved_approle_role_id = None
+        self._resolved_approle_secret_id = None
+        self._resolved_approle_mount = None
+        self._resolved_token_cache_file = None
+        self._resolved_counters_file = None
+        self._resolved_timings_file = None
+        self._resolved_timings_format = None
+        # Phase -> seconds spent by this connection instance, emitted on close() when timings_file is set
+        self._timings = {}
+        self._renewed = False
+        self._lock_timed_out = False
+        self._controlmaster_reused = False
+        self._first_command_done = False
         # self._resolved_hello_world = None # Removed
         self._config_loaded = False
         self._vault_cert_operations_done_this_instance = False
@@ -404,16 +1406,54 @@ class Connection(SSHConnection):
             display.error(msg)
             raise AnsibleError(msg)
         self._resolved_vault_ssh_ca_principal = ca_principal
+        # Sent to Vault as its comma-separated valid_principals list
+        self._requested_principals = tuple(principal.strip() for principal in ca_principal.split(',') if principal.strip())
         display.vv(f"{PLUGIN_NAME} ({current_host}): Using principal from 'vault_ssh_ca_principal': {self._resolved_vault_ssh_ca_principal}")
 
         pkp_opt = self.get_option('public_key_path')
         self._resolved_public_key_path = os.path.expanduser(pkp_opt) if pkp_opt is not None else None
 
+        self._resolved_ssh_agent = self.get_option('ssh_agent') or 'none'
+        agent_socket_opt = self.get_option('ssh_agent_socket')
+        self._resolved_ssh_agent_socket = os.path.expanduser(agent_socket_opt) if agent_socket_opt else None
+
         skp_opt = self.get_option('signed_key_path')
-        self._resolved_signed_key_path = os.path.expanduser(skp_opt) if skp_opt is not None else None
+        store_dir_opt = self.get_option('cert_store_dir')
+        self._resolved_cert_store_max_entries = self.get_option('cert_store_max_entries')
+        self._uses_cert_store = False
+        if (store_dir_opt or self._resolved_ssh_agent != 'none') and self._resolved_public_key_path:
+            try:
+                with open(self._resolved_public_key_path, 'r') as f:
+                    self._public_key_fingerprint = ssh_public_key_fingerprint(f.read())
+            except (OSError, ValueError) as e:
+                # Reported when a certificate is requested for the missing or invalid public key
+                display.vv(f"{PLUGIN_NAME} ({current_host}): Cannot fingerprint public key '{self._resolved_public_key_path}': {e}")
+
+        if store_dir_opt and self._resolved_public_key_path:
+            if self._public_key_fingerprint:
+                self._resolved_signed_key_path = cert_store_path(os.path.expanduser(store_dir_opt), self._resolved_vault_sign_path,
+                                                                 self._resolved_vault_ssh_ca_principal, self._public_key_fingerprint)
+                self._uses_cert_store = True
+            else:
+                self._resolved_signed_key_path = None
+        else:
+            self._resolved_signed_key_path = os.path.expanduser(skp_opt) if skp_opt is not None else None
 
         self._resolved_key_min_ttl_seconds = self.get_option('key_min_ttl_seconds')
         self._resolved_force_key_refresh = self.get_option('force_key_refresh')
+        self._resolved_vault_client = self.get_option('vault_client')
+        self._resolved_lock_timeout_seconds = self.get_option('renewal_lock_timeout_seconds')
+        self._resolved_renewal_agent = self.get_option('renewal_agent')
+        self._resolved_approle_role_id = self.get_option('approle_role_id') or None
+        self._resolved_approle_secret_id = self.get_option('approle_secret_id') or None
+        self._resolved_approle_mount = self.get_option('approle_mount') or 'approle'
+        token_cache_file_opt = self.get_option('token_cache_file')
+        self._resolved_token_cache_file = os.path.expanduser(token_cache_file_opt) if token_cache_file_opt else None
+        counters_file_opt = self.get_option('counters_file')
+        self._resolved_counters_file = os.path.expanduser(counters_file_opt) if counters_file_opt else None
+        timings_file_opt = self.get_option('timings_file')
+        self._resolved_timings_file = os.path.expanduser(timings_file_opt) if timings_file_opt else None
+        self._resolved_timings_format = self.get_option('timings_format') or 'jsonl'
         # self._resolved_hello_world = self.get_option('hello_world') # Removed
 
         self._config_loaded = True
@@ -422,9 +1462,14 @@ class Connection(SSHConnection):
         display.vv(f"  Vault Sign Path: {self._resolved_vault_sign_path}")
         display.vv(f"  Principal: {self._resolved_vault_ssh_ca_principal}")
         display.vv(f"  Public Key Path: {self._resolved_public_key_path}")
-        display.vv(f"  Signed Key Path: {self._resolved_signed_key_path}")
+        display.vv(f"  Signed Key Path: {self._resolved_signed_key_path}{' (cert store)' if self._uses_cert_store else ''}")
         display.vv(f"  Key Min TTL (s): {self._resolved_key_min_ttl_seconds}")
         display.vv(f"  Force Key Refresh: {self._resolved_force_key_refresh}")
+        display.vv(f"  Vault Client: {self._resolved_vault_client}")
+        if self._resolved_approle_role_id:
+            display.vv(f"  AppRole Login: auth/{self._resolved_approle_mount} (token cache: {self._resolved_token_cache_file or 'memory only'})")
+        display.vv(f"  Renewal Agent: {self._resolved_renewal_agent}")
+        display.vv(f"  SSH Agent: {self._resolved_ssh_agent}{f' ({self._agent_socket()})' if self._resolved_ssh_agent != 'none' else ''}")
         # display.vv(f"  Hello World Var: {self._resolved_hello_world}") # Removed
 
 
@@ -433,48 +1478,244 @@ class Connection(SSHConnection):
     #     display.display(f"{PLUGIN_NAME} ({host_for_msg}): Hello, {self._resolved_hello_world}!", color=C.COLOR_OK)
 
 
+    def _load_cert_status_sidecar(self, file_identity):
+        sidecar_path = self._resolved_signed_key_path + CERT_STATUS_SIDECAR_SUFFIX
+        try:
+            with open(sidecar_path, 'r') as f:
+                entry = json.load(f)
+            if not isinstance(entry, dict) or entry.get("file") != list(file_identity):
+                return None
+            return SSHCertificate(entry["key_type"], entry["serial"], entry["cert_type"], entry["key_id"],
+                                  tuple(entry["principals"]), _ssh_timestamp(entry["valid_after"]),
+                                  _ssh_timestamp(entry["valid_before"]), entry["public_key_fingerprint"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _write_cert_status_sidecar(self, file_identity, cert):
+        host_for_msg = self.get_option('host')
+        sidecar_path = self._resolved_signed_key_path + CERT_STATUS_SIDECAR_SUFFIX
+        entry = {
+            "file": list(file_identity),
+            "key_type": cert.key_type,
+            "serial": cert.serial,
+            "cert_type": cert.cert_type,
+            "key_id": cert.key_id,
+            "principals": list(cert.principals),
+            "valid_after": _ssh_timestamp_value(cert.valid_after),
+            "valid_before": _ssh_timestamp_value(cert.valid_before),
+            "public_key_fingerprint": cert.public_key_fingerprint,
+        }
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(prefix=".cert-status-", dir=os.path.dirname(sidecar_path) or ".")
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, sidecar_path)
+        except OSError as e:
+            display.vvv(f"{PLUGIN_NAME} ({host_for_msg}): Could not write certificate status {sidecar_path}: {e}")
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _signed_cert_identity(self):
+        """Returns (inode, mtime, size) of the certificate file, or None if it does not exist."""
+        try:
+            st = os.stat(self._resolved_signed_key_path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _read_signed_cert(self):
+        """Returns the parsed certificate at signed_key_path.
+
+        Looks in the process-wide cache, then the on-disk sidecar, and only parses the file when neither
+        matches its current identity (inode, mtime, size). Raises FileNotFoundError if the certificate is
+        missing and ValueError if it cannot be parsed.
+        """
+        cert_path = self._resolved_signed_key_path
+        file_identity = self._signed_cert_identity()
+        if file_identity is None:
+            raise FileNotFoundError(errno.ENOENT, "certificate not found", cert_path)
+
+        cached = Connection._cert_status_cache.get(cert_path)
+        if cached is not None and cached[0] == file_identity:
+            return cached[1]
+
+        cert = self._load_cert_status_sidecar(file_identity)
+        if cert is None:
+            with open(cert_path, 'r', errors='ignore') as f:
+                cert = parse_ssh_certificate(f.read())
+            self._write_cert_status_sidecar(file_identity, cert)
+        Connection._cert_status_cache[cert_path] = (file_identity, cert)
+        return cert
+
+
+    def _agent_socket(self):
+        if self._resolved_ssh_agent == 'managed':
+            return self._resolved_ssh_agent_socket
+        return os.environ.get('SSH_AUTH_SOCK')
+
+    def _ensure_ssh_agent(self):
+        """Makes sure the configured ssh-agent is reachable, starting the managed one if needed. Returns its socket.
+
+        The managed agent is left running when the play ends, so later runs reuse it and the certificates it holds
+        (each loaded with a lifetime ending at its expiry). Its PID is written to '<socket>.pid' for stopping it.
+        """
+        host_for_msg = self.get_option('host')
+        agent_socket = self._agent_socket()
+        if not agent_socket:
+            msg = f"{PLUGIN_NAME} ({host_for_msg}): 'ssh_agent' is 'external' but SSH_AUTH_SOCK is not set."
+            display.error(msg)
+            raise AnsibleError(msg)
+
+        if self._resolved_ssh_agent == 'managed':
+            try:
+                ssh_agent_identities(agent_socket)
+            except (OSError, ValueError):
+                # Not running (yet): start it, once across forks
+                lock = CertificateLock(agent_socket + ".lock")
+                lock_timeout = self._resolved_lock_timeout_seconds or 60
+                if not lock.acquire(lock_timeout):
+                    # Whoever holds the lock may have started the agent meanwhile; never start a second one
+                    try:
+                        ssh_agent_identities(agent_socket)
+                    except (OSError, ValueError):
+                        msg = (f"{PLUGIN_NAME} ({host_for_msg}): Timed out after {lock_timeout}s waiting for PID "
+                               f"{lock.holder_pid() or 'unknown'} to start the ssh-agent on {agent_socket}.")
+                        display.error(msg)
+                        raise AnsibleConnectionFailure(msg)
+                    return agent_socket
+                try:
+                    try:
+                        ssh_agent_identities(agent_socket)
+                    except (OSError, ValueError):
+                        if os.path.exists(agent_socket):
+                            os.remove(agent_socket)
+                        process = subprocess.run(['ssh-agent', '-a', agent_socket], capture_output=True, text=True,
+                                                 check=True, stdin=subprocess.DEVNULL, errors='ignore')
+                        agent_pid = re.search(r"SSH_AGENT_PID=(\d+)", process.stdout)
+                        if agent_pid:
+                            with open(agent_socket + ".pid", 'w') as f:
+                                f.write(agent_pid.group(1) + "\n")
+                        display.v(f"{PLUGIN_NAME} ({host_for_msg}): Started ssh-agent (PID {agent_pid.group(1) if agent_pid else 'unknown'}) on {agent_socket}.")
+                finally:
+                    lock.release()
+
+        return agent_socket
+
+    def _build_command(self, binary, subsystem, *other_args):
+        # Every ssh, scp and sftp command line is built here. The agent is set in the command's own environment
+        # ('env SSH_AUTH_SOCK=<socket> ssh ...') rather than passed as IdentityAgent, so that ProxyJump and
+        # ProxyCommand hops, which inherit it, use it too; the controller's environment is left alone.
+        b_command = super(Connection, self)._build_command(binary, subsystem, *other_args)
+        if self._config_loaded and self._resolved_ssh_agent != 'none' and self._agent_socket():
+            b_command = [b'env', to_bytes(f"SSH_AUTH_SOCK={self._agent_socket()}")] + b_command
+        return b_command
+
+    def _cert_has_principals(self, cert):
+        """Returns True if cert is valid for every requested principal."""
+        # An empty principal list means the certificate is valid for any principal
+        return not cert.principals or all(principal in cert.principals for principal in self._requested_principals)
+
+    def _read_agent_cert(self):
+        """Returns the best certificate for our public key held by the ssh-agent.
+
+        Certificates listing all requested principals are preferred, then the one expiring last.
+        Raises FileNotFoundError if the agent holds none.
+        """
+        best = None
+        for blob, _ in ssh_agent_identities(self._agent_socket()):
+            try:
+                cert = parse_ssh_certificate_blob(blob)
+            except ValueError:
+                continue  # plain keys, or certificates of other types
+            if cert.public_key_fingerprint != self._public_key_fingerprint:
+                continue
+            rank = (self._cert_has_principals(cert), cert.valid_before)
+            if best is None or rank > best[0]:
+                best = (rank, cert)
+        if best is None:
+            raise FileNotFoundError(errno.ENOENT, "no certificate in ssh-agent", self._agent_socket())
+        return best[1]
+
+    def _read_current_cert(self):
+        if self._resolved_ssh_agent != 'none':
+            return self._read_agent_cert()
+        return self._read_signed_cert()
+
+    def _current_cert_identity(self):
+        """Changes whenever a renewal replaced the certificate; None if there is none."""
+        if self._resolved_ssh_agent == 'none':
+            return self._signed_cert_identity()
+        try:
+            cert = self._read_agent_cert()
+        except (OSError, ValueError):
+            return None
+        return (cert.serial, cert.valid_before)
+
+    def _add_cert_to_agent(self, signed_key_content):
+        """Loads the private key and its new certificate into the ssh-agent, constrained to the certificate's lifetime."""
+        host_for_msg = self.get_option('host')
+        cert = parse_ssh_certificate(signed_key_content)
+        private_key_path = self.get_option('private_key_file')
+        private_key_path = os.path.expanduser(private_key_path) if private_key_path else re.sub(r"\.pub$", "", self._resolved_public_key_path)
+        lifetime = max(int((cert.valid_before - datetime.now(timezone.utc)).total_seconds()), 1)
+
+        # ssh-add picks up '<key>-cert.pub' next to the key it loads; pair them in a private directory
+        staging_dir = tempfile.mkdtemp(prefix="vault-ssh-agent-")
+        try:
+            staged_key = os.path.join(staging_dir, "id")
+            os.symlink(os.path.abspath(private_key_path), staged_key)
+            with open(staged_key + "-cert.pub", 'w') as f:
+                f.write(signed_key_content.strip() + "\n")
+            env = dict(os.environ, SSH_AUTH_SOCK=self._agent_socket(), SSH_ASKPASS_REQUIRE='never')
+            process = subprocess.run(['ssh-add', '-t', str(lifetime), staged_key], capture_output=True, text=True,
+                                     stdin=subprocess.DEVNULL, env=env, errors='ignore')
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+        if process.returncode != 0:
+            msg = (f"{PLUGIN_NAME} ({host_for_msg}): Failed to load '{private_key_path}' and its certificate into the ssh-agent "
+                   f"(a passphrase-protected key must already be unlocked): {process.stderr.strip()}")
+            display.error(msg)
+            raise AnsibleConnectionFailure(msg)
+        display.vv(f"{PLUGIN_NAME} ({host_for_msg}): Loaded certificate (serial {cert.serial}) into the ssh-agent for {lifetime}s.")
+
+        # The new certificate replaces the ones it renews. They are removed only once it is loaded, so ssh
+        # processes of other forks never find the agent without a certificate.
+        _, new_blob = _decode_ssh_public_key_line(signed_key_content)
+        now_utc = datetime.now(timezone.utc)
+        try:
+            for blob, _ in ssh_agent_identities(self._agent_socket()):
+                if blob == new_blob:
+                    continue
+                try:
+                    old_cert = parse_ssh_certificate_blob(blob)
+                except ValueError:
+                    continue
+                if old_cert.public_key_fingerprint == cert.public_key_fingerprint and (
+                        set(old_cert.principals) == set(cert.principals) or old_cert.valid_before <= now_utc):
+                    if ssh_agent_remove_identity(self._agent_socket(), blob):
+                        display.vvv(f"{PLUGIN_NAME} ({host_for_msg}): Removed replaced certificate (serial {old_cert.serial}) from the ssh-agent.")
+        except (OSError, ValueError) as e:
+            # The new certificate is in place; a leftover old one expires with its lifetime
+            display.warning(f"{PLUGIN_NAME} ({host_for_msg}): Could not remove replaced certificates from the ssh-agent: {e}")
+
+
     def _get_cert_expiry_for_display(self):
-        if not self._resolved_signed_key_path or not os.path.exists(self._resolved_signed_key_path):
+        if self._resolved_ssh_agent == 'none' and (not self._resolved_signed_key_path or not os.path.exists(self._resolved_signed_key_path)):
             return "unknown (cert not found)"
         try:
-            process = subprocess.run(['ssh-keygen', '-L', '-f', self._resolved_signed_key_path], capture_output=True, text=True, check=False, errors='ignore')
-            if process.returncode == 0:
-                valid_to_regex = re.compile(r"Valid:\s+.*?to\s+(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(?:Z|[+-]\d{2}:\d{2})?)")
-                not_after_regex = re.compile(r"Not\s+after:\s*(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(?:Z|[+-]\d{2}:\d{2})?)")
-                timestamp_str = None
-                for line in process.stdout.splitlines():
-                    line = line.strip()
-                    match_valid_to = valid_to_regex.search(line)
-                    if match_valid_to: timestamp_str = match_valid_to.group(1); break
-                    match_not_after = not_after_regex.search(line)
-                    if match_not_after: timestamp_str = match_not_after.group(1); break
-                if timestamp_str:
-                    dt_obj = datetime.fromisoformat(timestamp_str.replace('Z', '+00:00'))
-                    return dt_obj.isoformat()
+            return self._read_current_cert().valid_before.isoformat()
         except Exception: pass
         return "unknown (parse error)"
 
 
     def _get_cert_ttl_for_display(self):
-        if not self._resolved_signed_key_path or not os.path.exists(self._resolved_signed_key_path):
+        if self._resolved_ssh_agent == 'none' and (not self._resolved_signed_key_path or not os.path.exists(self._resolved_signed_key_path)):
             return "unknown"
         try:
-            process = subprocess.run(['ssh-keygen', '-L', '-f', self._resolved_signed_key_path], capture_output=True, text=True, check=False, errors='ignore')
-            if process.returncode == 0:
-                valid_to_regex = re.compile(r"Valid:\s+.*?to\s+(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(?:Z|[+-]\d{2}:\d{2})?)")
-                not_after_regex = re.compile(r"Not\s+after:\s*(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(?:Z|[+-]\d{2}:\d{2})?)")
-                timestamp_str = None
-                for line in process.stdout.splitlines():
-                    line = line.strip()
-                    match_valid_to = valid_to_regex.search(line)
-                    if match_valid_to: timestamp_str = match_valid_to.group(1); break
-                    match_not_after = not_after_regex.search(line)
-                    if match_not_after: timestamp_str = match_not_after.group(1); break
-                if timestamp_str:
-                    cert_valid_until = datetime.fromisoformat(timestamp_str.replace('Z', '+00:00'))
-                    if cert_valid_until.tzinfo is None: cert_valid_until = cert_valid_until.replace(tzinfo=timezone.utc)
-                    else: cert_valid_until = cert_valid_until.astimezone(timezone.utc)
-                    return f"{(cert_valid_until - datetime.now(timezone.utc)).total_seconds():.0f}"
+            cert_valid_until = self._read_current_cert().valid_before
+            return f"{(cert_valid_until - datetime.now(timezone.utc)).total_seconds():.0f}"
         except Exception: pass
         return "unknown"
 
@@ -482,54 +1723,29 @@ class Connection(SSHConnection):
     def _is_cert_fresh(self):
         host_for_msg = self.get_option('host')
         cert_path_for_msg = f"'{self._resolved_signed_key_path}'" if self._resolved_signed_key_path else "configured path"
-
-        if not self._resolved_signed_key_path or not os.path.exists(self._resolved_signed_key_path):
+        in_agent = self._resolved_ssh_agent != 'none'
+        if in_agent:
+            cert_path_for_msg = "in ssh-agent"
+        elif not self._resolved_signed_key_path or not os.path.exists(self._resolved_signed_key_path):
             return False, "not found"
 
         try:
-            cmd_check = ['ssh-keygen', '-L', '-f', self._resolved_signed_key_path]
-            process = subprocess.run(cmd_check, capture_output=True, text=True, check=False, errors='ignore')
-
-            if process.returncode != 0:
-                if "No such file or directory" in process.stderr:
-                    return False, "disappeared"
-                else:
-                    display.warning(f"{PLUGIN_NAME} ({host_for_msg}): 'ssh-keygen -L' failed for {cert_path_for_msg}. Stderr: {process.stderr.strip()}")
-                return False, "ssh-keygen failed"
-
-            cert_valid_until = None
-            output_lines = process.stdout.splitlines()
-            if not output_lines:
-                display.warning(f"{PLUGIN_NAME} ({host_for_msg}): 'ssh-keygen -L' produced no output for {cert_path_for_msg}.")
-                return False, "ssh-keygen no output"
-
-            valid_to_regex = re.compile(r"Valid:\s+.*?to\s+(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(?:Z|[+-]\d{2}:\d{2})?)")
-            not_after_regex = re.compile(r"Not\s+after:\s*(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(?:Z|[+-]\d{2}:\d{2})?)")
-            timestamp_str = None
-            for line_content in output_lines:
-                line_content = line_content.strip()
-                match_valid_to = valid_to_regex.search(line_content)
-                if match_valid_to: timestamp_str = match_valid_to.group(1); break
-                match_not_after = not_after_regex.search(line_content)
-                if match_not_after: timestamp_str = match_not_after.group(1); break
-
-            if timestamp_str:
-                try:
-                    cert_valid_until = datetime.fromisoformat(timestamp_str.replace('Z', '+00:00'))
-                    if cert_valid_until.tzinfo is None: cert_valid_until = cert_valid_until.replace(tzinfo=timezone.utc)
-                    else: cert_valid_until = cert_valid_until.astimezone(timezone.utc)
-                except ValueError as e:
-                    display.warning(f"{PLUGIN_NAME} ({host_for_msg}): Could not parse timestamp '{timestamp_str}' for {cert_path_for_msg}. Error: {e}.")
-                    return False, "timestamp parse error"
-            else:
-                display.warning(f"{PLUGIN_NAME} ({host_for_msg}): Could not find valid expiry timestamp in 'ssh-keygen -L' for {cert_path_for_msg}. Output:\n{process.stdout}")
-                return False, "no expiry timestamp found"
+            try:
+                cert = self._read_current_cert()
+            except FileNotFoundError:
+                return False, "not found" if in_agent else "disappeared"
+            except ValueError as e:
+                display.warning(f"{PLUGIN_NAME} ({host_for_msg}): Could not parse certificate {cert_path_for_msg}: {e}.")
+                return False, "certificate parse error"
 
-            if not cert_valid_until:
-                 display.warning(f"{PLUGIN_NAME} ({host_for_msg}): cert_valid_until is None after parsing for {cert_path_for_msg}.")
-                 return False, "cert_valid_until is None"
+            if not self._cert_has_principals(cert):
+                return False, f"principal mismatch (certificate is for {', '.join(cert.principals)})"
 
             now_utc = datetime.now(timezone.utc)
+            if cert.valid_after > now_utc:
+                return False, f"not valid yet (valid from {cert.valid_after.isoformat()})"
+
+            cert_valid_until = cert.valid_before
             remaining_ttl = (cert_valid_until - now_utc).total_seconds()
 
             if remaining_ttl < self._resolved_key_min_ttl_seconds:
@@ -543,6 +1759,141 @@ class Connection(SSHConnection):
             return False, "exception during check"
 
 
+    def _touch_cert_store_entry(self):
+        """Records that the stored certificate was used, for LRU eviction."""
+        try:
+            st = os.stat(self._resolved_signed_key_path)
+            now = time.time()
+            if now - st.st_atime >= CERT_STORE_TOUCH_INTERVAL_SECONDS:
+                os.utime(self._resolved_signed_key_path, ns=(int(now * 1e9), st.st_mtime_ns))
+        except OSError:
+            pass
+
+
+    def _evict_cert_store(self):
+        """Removes the least recently used certificates beyond cert_store_max_entries from the store."""
+        host_for_msg = self.get_option('host')
+        store_dir = os.path.dirname(self._resolved_signed_key_path)
+        max_entries = self._resolved_cert_store_max_entries
+        if not max_entries or max_entries < 1:
+            return
+        entries = []
+        try:
+            with os.scandir(store_dir) as it:
+                for entry in it:
+                    if entry.name.endswith(CERT_STORE_SUFFIX) and entry.path != self._resolved_signed_key_path:
+                        try:
+                            entries.append((entry.stat().st_atime, entry.path))
+                        except OSError:
+                            pass
+        except OSError as e:
+            display.vvv(f"{PLUGIN_NAME} ({host_for_msg}): Could not scan certificate store {store_dir}: {e}")
+            return
+
+        entries.sort()
+        for _, path in entries[:max(len(entries) - (max_entries - 1), 0)]:
+            for stale_path in (path, path + CERT_STATUS_SIDECAR_SUFFIX):
+                try:
+                    os.remove(stale_path)
+                except OSError:
+                    pass
+            Connection._cert_status_cache.pop(path, None)
+            display.vv(f"{PLUGIN_NAME} ({host_for_msg}): Evicted least recently used certificate {path} from the store.")
+
+
+    def _use_cert_store_certificate(self):
+        """Points ssh at the stored certificate, which is not next to the private key where ssh looks by default."""
+        cert_option = f'-o CertificateFile="{self._resolved_signed_key_path}"'
+        common_args = self.get_option('ssh_common_args') or ''
+        if cert_option not in common_args:
+            self.set_option('ssh_common_args', f"{common_args} {cert_option}".strip())
+
+
+    def _sign_with_vault_cli(self, token=None):
+        host_for_msg = self.get_option('host')
+        vault_command = [
+            'vault', 'write', '-field=signed_key',
+            self._resolved_vault_sign_path,
+            f'public_key=@{self._resolved_public_key_path}',
+            f'valid_principals={self._resolved_vault_ssh_ca_principal}'
+        ]
+
+        if not os.getenv('VAULT_ADDR'):
+            display.warning(f"{PLUGIN_NAME} ({host_for_msg}): VAULT_ADDR environment variable is not set. Vault command may fail.")
+
+        display.vv(f"{PLUGIN_NAME} ({host_for_msg}): Executing: {' '.join(vault_command)}")
+
+        env = dict(os.environ, VAULT_TOKEN=token) if token else None
+        process = subprocess.run(vault_command, capture_output=True, text=True, check=True, errors='ignore', env=env)
+        return process.stdout.strip()
+
+
+    def _sign_with_vault_http(self, client, approle_token=None):
+        host_for_msg = self.get_option('host')
+        with open(self._resolved_public_key_path, 'r') as f:
+            public_key = f.read().strip()
+
+        display.vv(f"{PLUGIN_NAME} ({host_for_msg}): POST {client.addr}/v1/{self._resolved_vault_sign_path}")
+        try:
+            return client.sign_ssh_key(self._resolved_vault_sign_path, public_key, self._resolved_vault_ssh_ca_principal)
+        except VaultRequestError as e:
+            if e.status == 403 and approle_token:
+                # The cached token was revoked or expired early: log in again, once
+                display.v(f"{PLUGIN_NAME} ({host_for_msg}): Vault refused the cached AppRole token ({e}); logging in again.")
+                return self._sign_with_vault_http(VaultHTTPClient.from_env(self._approle_token(rejected_token=approle_token)))
+            errmsg = f"{PLUGIN_NAME} ({host_for_msg}): Vault request failed for path '{self._resolved_vault_sign_path}': {e}"
+            display.error(errmsg)
+            raise AnsibleConnectionFailure(errmsg)
+
+
+    def _approle_token(self, rejected_token=None):
+        """Returns a client token from the AppRole login when approle_role_id and approle_secret_id are set, else None."""
+        if not (self._resolved_approle_role_id and self._resolved_approle_secret_id):
+            return None
+        host_for_msg = self.get_option('host')
+        addr = os.getenv('VAULT_ADDR')
+        if not addr:
+            raise AnsibleError(f"{PLUGIN_NAME} ({host_for_msg}): VAULT_ADDR must be set to log in with AppRole.")
+        tokens = AppRoleTokenCache(addr, self._resolved_approle_role_id, self._resolved_approle_secret_id,
+                                   self._resolved_approle_mount, self._resolved_token_cache_file, os.getenv('VAULT_NAMESPACE'))
+        try:
+            return tokens.token(rejected_token)
+        except (VaultRequestError, OSError, http.client.HTTPException, ValueError, KeyError, TypeError) as e:
+            errmsg = f"{PLUGIN_NAME} ({host_for_msg}): AppRole login at {addr}/v1/auth/{tokens.mount}/login failed: {type(e).__name__} - {e}"
+            display.error(errmsg)
+            raise AnsibleConnectionFailure(errmsg)
+
+    def _request_signed_key(self):
+        """Asks Vault to sign the public key, over HTTP when possible and through the 'vault' CLI otherwise."""
+        host_for_msg = self.get_option('host')
+        mode = self._resolved_vault_client or 'auto'
+        approle_token = self._approle_token()
+        if mode == 'cli':
+            return self._sign_with_vault_cli(approle_token)
+
+        try:
+            client = VaultHTTPClient.from_env(approle_token)
+        except (ValueError, OSError, ssl.SSLError) as e:
+            if mode == 'http':
+                raise AnsibleError(f"{PLUGIN_NAME} ({host_for_msg}): Cannot set up the Vault HTTP client: {e}")
+            display.warning(f"{PLUGIN_NAME} ({host_for_msg}): Cannot set up the Vault HTTP client ({e}). Falling back to the 'vault' CLI.")
+            return self._sign_with_vault_cli(approle_token)
+
+        if client is None:
+            if mode == 'http':
+                raise AnsibleError(f"{PLUGIN_NAME} ({host_for_msg}): 'vault_client' is 'http' but VAULT_ADDR or a Vault token (VAULT_TOKEN, ~/.vault-token) is missing.")
+            display.vv(f"{PLUGIN_NAME} ({host_for_msg}): VAULT_ADDR or Vault token not set; using the 'vault' CLI.")
+            return self._sign_with_vault_cli()
+
+        try:
+            return self._sign_with_vault_http(client, approle_token)
+        except (OSError, http.client.HTTPException) as e:
+            if mode == 'http':
+                raise AnsibleConnectionFailure(f"{PLUGIN_NAME} ({host_for_msg}): Could not reach Vault at {client.addr}: {type(e).__name__} - {e}")
+            display.warning(f"{PLUGIN_NAME} ({host_for_msg}): Could not reach Vault at {client.addr} ({type(e).__name__} - {e}). Falling back to the 'vault' CLI.")
+            return self._sign_with_vault_cli(approle_token)
+
+
     def _obtain_new_certificate(self):
         host_for_msg = self.get_option('host')
         cert_path_for_msg = f"'{self._resolved_signed_key_path}'" if self._resolved_signed_key_path else "configured path"
@@ -559,77 +1910,74 @@ class Connection(SSHConnection):
 
 
         lock_file_path = self._resolved_signed_key_path + ".lock"
-        attempts = 0
-        max_attempts = 10
+        lock = CertificateLock(lock_file_path)
+        lock_timeout = self._resolved_lock_timeout_seconds if self._resolved_lock_timeout_seconds is not None else 60
+        identity_before_lock = self._current_cert_identity()
         display.v(f"{PLUGIN_NAME} ({host_for_msg}): Attempting to acquire lock for certificate renewal: {lock_file_path}")
-        while attempts < max_attempts:
-            try:
-                lock_dir = os.path.dirname(lock_file_path)
-                if lock_dir and not os.path.exists(lock_dir):
-                    os.makedirs(lock_dir, mode=0o700)
-
-                fd = os.open(lock_file_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
-                os.close(fd)
+        try:
+            with self._timed('lock_wait'):
+                lock_acquired = lock.acquire(lock_timeout)
+            if lock_acquired:
                 display.v(f"{PLUGIN_NAME} ({host_for_msg}): Acquired lock: {lock_file_path}")
-                break
-            except FileExistsError:
-                attempts += 1
-                display.vvv(f"{PLUGIN_NAME} ({host_for_msg}): Lock file {lock_file_path} exists, attempt {attempts}/{max_attempts}, waiting...")
-                time.sleep(0.5)
-            except Exception as e:
-                display.warning(f"{PLUGIN_NAME} ({host_for_msg}): Error trying to acquire lock {lock_file_path}: {e}. Proceeding without lock.")
-                break
-        else:
-            display.warning(f"{PLUGIN_NAME} ({host_for_msg}): Could not acquire lock {lock_file_path} after {max_attempts} attempts. Proceeding without lock (risk of race condition).")
+            else:
+                self._lock_timed_out = True
+                display.warning(f"{PLUGIN_NAME} ({host_for_msg}): Could not acquire lock {lock_file_path} within {lock_timeout}s "
+                                f"(held by PID {lock.holder_pid() or 'unknown'}). Proceeding without lock (risk of race condition).")
+        except Exception as e:
+            display.warning(f"{PLUGIN_NAME} ({host_for_msg}): Error trying to acquire lock {lock_file_path}: {e}. Proceeding without lock.")
 
 
         try:
+            # Single-flight: if another fork renewed the certificate while we waited, use its result
             is_fresh_after_lock, _ = self._is_cert_fresh()
-            if is_fresh_after_lock and not self._resolved_force_key_refresh:
+            renewed_while_waiting = self._current_cert_identity() != identity_before_lock
+            if is_fresh_after_lock and (renewed_while_waiting or not self._resolved_force_key_refresh):
                  display.v(f"{PLUGIN_NAME} ({host_for_msg}): Certificate for {cert_path_for_msg} became fresh while waiting for lock. Skipping renewal.")
                  return True
 
-            if os.path.exists(self._resolved_signed_key_path):
-                try:
-                    os.remove(self._resolved_signed_key_path)
-                    display.vv(f"{PLUGIN_NAME} ({host_for_msg}): Removed old/stale signed key {cert_path_for_msg}.")
-                except OSError as e:
-                    display.warning(f"{PLUGIN_NAME} ({host_for_msg}): Failed to remove existing signed key {cert_path_for_msg}, possibly due to race or permissions: {e}")
-
             display.vv(f"{PLUGIN_NAME} ({host_for_msg}): Proceeding with Vault SSH key request for {cert_path_for_msg}.")
 
-            vault_command = [
-                'vault', 'write', '-field=signed_key',
-                self._resolved_vault_sign_path,
-                f'public_key=@{self._resolved_public_key_path}',
-                f'valid_principals={self._resolved_vault_ssh_ca_principal}'
-            ]
-
-            if not os.getenv('VAULT_ADDR'):
-                display.warning(f"{PLUGIN_NAME} ({host_for_msg}): VAULT_ADDR environment variable is not set. Vault command may fail.")
-
-            display.vv(f"{PLUGIN_NAME} ({host_for_msg}): Executing: {' '.join(vault_command)}")
-
-            env = os.environ.copy()
-            process = subprocess.run(vault_command, capture_output=True, text=True, check=True, env=env, errors='ignore')
-            signed_key_content = process.stdout.strip()
+            with self._timed('vault_request'):
+                signed_key_content = self._request_signed_key()
 
             if not signed_key_content:
                 display.error(f"{PLUGIN_NAME} ({host_for_msg}): Vault returned an empty signed key for path '{self._resolved_vault_sign_path}'.")
                 raise AnsibleError(f"Vault returned an empty signed key for {self._resolved_vault_sign_path}")
 
-            signed_key_dir = os.path.dirname(self._resolved_signed_key_path)
-            if signed_key_dir and not os.path.exists(signed_key_dir):
+            if self._resolved_ssh_agent != 'none':
+                with self._timed('cert_write'):
+                    self._add_cert_to_agent(signed_key_content)
+                self._renewed = True
+                return True
+
+            with self._timed('cert_write'):
+                signed_key_dir = os.path.dirname(self._resolved_signed_key_path)
+                if signed_key_dir and not os.path.exists(signed_key_dir):
+                    try:
+                        os.makedirs(signed_key_dir, mode=0o700)
+                        display.vv(f"{PLUGIN_NAME} ({host_for_msg}): Created directory for signed key: {signed_key_dir}")
+                    except Exception as e:
+                        raise AnsibleError(f"{PLUGIN_NAME} ({host_for_msg}): Failed to create directory '{signed_key_dir}': {e}")
+
+                # Replace the old certificate atomically: concurrent readers see either the old or the new one, never none
+                fd, tmp_path = tempfile.mkstemp(prefix=".signed-key-", dir=signed_key_dir or ".")
                 try:
-                    os.makedirs(signed_key_dir, mode=0o700)
-                    display.vv(f"{PLUGIN_NAME} ({host_for_msg}): Created directory for signed key: {signed_key_dir}")
-                except Exception as e:
-                    raise AnsibleError(f"{PLUGIN_NAME} ({host_for_msg}): Failed to create directory '{signed_key_dir}': {e}")
-
-            with open(self._resolved_signed_key_path, 'w') as f:
-                f.write(signed_key_content)
-            os.chmod(self._resolved_signed_key_path, 0o644)
-            display.vv(f"{PLUGIN_NAME} ({host_for_msg}): Set permissions to 0644 for {cert_path_for_msg}.")
+                    with os.fdopen(fd, 'w') as f:
+                        f.write(signed_key_content)
+                        if not signed_key_content.endswith("\n"):
+                            f.write("\n")
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.chmod(tmp_path, 0o644)
+                    os.replace(tmp_path, self._resolved_signed_key_path)
+                except BaseException:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                    raise
+            display.vv(f"{PLUGIN_NAME} ({host_for_msg}): Wrote {cert_path_for_msg} (mode 0644).")
+            self._renewed = True
+            if self._uses_cert_store:
+                self._evict_cert_store()
 
             return True
 
@@ -647,33 +1995,167 @@ class Connection(SSHConnection):
             msg = f"{PLUGIN_NAME} ({host_for_msg}): 'vault' command not found."
             display.error(msg)
             raise AnsibleError(msg)
+        except AnsibleError:
+            raise
         except Exception as e:
             msg = f"{PLUGIN_NAME} ({host_for_msg}): An unexpected error occurred while obtaining signed key: {type(e).__name__} - {e}"
             display.error(msg)
             raise AnsibleError(msg)
         finally:
-            if os.path.exists(lock_file_path):
-                try:
-                    os.remove(lock_file_path)
+            try:
+                if lock.release():
                     display.v(f"{PLUGIN_NAME} ({host_for_msg}): Released lock: {lock_file_path}")
-                except OSError as e:
-                    display.warning(f"{PLUGIN_NAME} ({host_for_msg}): Failed to remove lock file {lock_file_path}: {e}")
+            except OSError as e:
+                display.warning(f"{PLUGIN_NAME} ({host_for_msg}): Failed to release lock {lock_file_path}: {e}")
 
 
+    def _ensure_renewal_agent(self):
+        """Starts the renewal agent for signed_key_path unless one is already running."""
+        host_for_msg = self.get_option('host')
+        agent_lock = CertificateLock(self._resolved_signed_key_path + RENEWAL_AGENT_LOCK_SUFFIX)
+        if not agent_lock.acquire(0):
+            display.vvv(f"{PLUGIN_NAME} ({host_for_msg}): Renewal agent already running (PID {agent_lock.holder_pid() or 'unknown'}).")
+            return
+        agent_lock.release()
+
+        agent_command = [
+            sys.executable, os.path.abspath(__file__),
+            '--signing-role', self.get_option('vault_ssh_ca_signing_role'),
+            '--principal', self._resolved_vault_ssh_ca_principal,
+            '--public-key-path', self._resolved_public_key_path,
+            # May come from inventory vars (ansible_ssh_private_key_file), which the agent can't see
+            '--private-key-file', self.get_option('private_key_file') or '',
+            '--signed-key-path', self._resolved_signed_key_path,
+            '--min-ttl', str(self._resolved_key_min_ttl_seconds),
+            '--vault-client', self._resolved_vault_client or 'auto',
+            '--lock-timeout', str(self._resolved_lock_timeout_seconds),
+            '--ssh-agent', self._resolved_ssh_agent,
+            '--ssh-agent-socket', self._resolved_ssh_agent_socket or '',
+            # Worker processes are forked from the ansible-playbook process; the agent lives as long as it does
+            '--watch-pid', str(os.getppid()),
+        ]
+        # AppRole credentials may come from inventory vars; hand them over in the environment rather than on the command line
+        agent_env = dict(os.environ)
+        for env_name, value in (('ANSIBLE_VAULT_SSH_APPROLE_ROLE_ID', self._resolved_approle_role_id),
+                                ('ANSIBLE_VAULT_SSH_APPROLE_SECRET_ID', self._resolved_approle_secret_id),
+                                ('ANSIBLE_VAULT_SSH_APPROLE_MOUNT', self._resolved_approle_mount),
+                                ('ANSIBLE_VAULT_SSH_TOKEN_CACHE_FILE', self._resolved_token_cache_file or '')):
+            if value is not None:
+                agent_env[env_name] = value
+        with open(self._resolved_signed_key_path + RENEWAL_AGENT_LOG_SUFFIX, 'a') as log_file:
+            process = subprocess.Popen(agent_command, stdin=subprocess.DEVNULL, stdout=log_file, stderr=log_file,
+                                       start_new_session=True, close_fds=True, env=agent_env)
+        display.v(f"{PLUGIN_NAME} ({host_for_msg}): Started renewal agent (PID {process.pid}) for '{self._resolved_signed_key_path}'.")
+
+
+    @contextlib.contextmanager
+    def _timed(self, phase):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._timings[phase] = self._timings.get(phase, 0.0) + time.perf_counter() - started
+
+    def _emit_timings(self):
+        """Writes this connection's timings to timings_file, once per connection attempt."""
+        if not self._timings or not self._resolved_timings_file:
+            return
+        record = {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'pid': os.getpid(),
+            'ppid': os.getppid(),
+            'host': self.get_option('host'),
+            'phases': {phase: round(seconds, 6) for phase, seconds in self._timings.items()},
+            'renewed': self._renewed,
+            'lock_timeout': self._lock_timed_out,
+            'controlmaster_reuse': self._controlmaster_reused,
+        }
+        self._timings = {}
+        try:
+            if self._resolved_timings_format == 'prometheus':
+                if not update_prometheus_textfile(self._resolved_timings_file, record):
+                    display.vvv(f"{PLUGIN_NAME} ({record['host']}): Timed out locking '{self._resolved_timings_file}'; timings dropped.")
+            else:
+                append_timing_record(self._resolved_timings_file, record)
+        except OSError as e:
+            display.vvv(f"{PLUGIN_NAME} ({record['host']}): Could not write timings to '{self._resolved_timings_file}': {e}")
+
+    def _live_control_socket(self):
+        """Returns the ControlPath of a live ControlMaster for this host, or None.
+
+        The path is derived like SSHConnection._build_command does: only when ControlPersist is among the ssh
+        arguments, from an explicit ControlPath there or else from control_path and control_path_dir.
+        """
+        args = []
+        for opt in ('ssh_args', 'ssh_common_args', 'ssh_extra_args'):
+            value = self.get_option(opt)
+            if value:
+                args.extend(self._split_ssh_args(value))
+        controlpersist, controlpath = self._persistence_controls([to_bytes(a, errors='surrogate_or_strict') for a in args])
+        if not controlpersist:
+            return None
+
+        host = self.get_option('host') or self._play_context.remote_addr
+        port = self.get_option('port')
+        user = self.get_option('remote_user')
+        if controlpath:
+            control_path = None
+            for arg in args:
+                match = re.search(r"controlpath\s*[=\s]\s*(\S.*)$", arg, re.IGNORECASE)
+                if match:
+                    control_path = match.group(1).strip('"\'')
+            if not control_path:
+                return None
+        else:
+            cpdir = unfrackpath(self.get_option('control_path_dir'))
+            control_path = self.get_option('control_path') or self._create_control_path(host, port, user)
+            control_path = control_path % dict(directory=cpdir)
+
+        socket_path = expand_ssh_control_path(control_path, host, port, user)
+        if socket_path and control_socket_alive(socket_path):
+            return socket_path
+        return None
+
+    def _record_counters(self, **increments):
+        for name, amount in increments.items():
+            Connection._counters[name] = Connection._counters.get(name, 0) + amount
+        if self._resolved_counters_file and record_counters(self._resolved_counters_file, increments) is None:
+            display.vvv(f"{PLUGIN_NAME} ({self.get_option('host')}): Could not update counters file '{self._resolved_counters_file}'.")
+
     def _connect(self):
         if not self._config_loaded:
-            self._load_config()
+            with self._timed('config_load'):
+                self._load_config()
 
         # self._say_hello_world() # Removed
 
         host_for_msg = self.get_option('host')
         cert_path_for_msg = f"'{self._resolved_signed_key_path}'" if self._resolved_signed_key_path else "configured path"
 
-        if not self._vault_cert_operations_done_this_instance:
+        # A live ControlMaster is already authenticated: ssh multiplexes over it without presenting a certificate
+        control_socket = None
+        if not self._vault_cert_operations_done_this_instance and not self._resolved_force_key_refresh:
+            with self._timed('controlmaster_check'):
+                control_socket = self._live_control_socket()
+
+        if control_socket:
+            display.vvv(f"{PLUGIN_NAME} ({host_for_msg}): ControlMaster socket '{control_socket}' is live. Skipping certificate evaluation.")
+            # Keep ssh pointed at the certificate in case the master exits before ssh reaches it (the agent is
+            # passed to ssh by _build_command)
+            if self._resolved_ssh_agent == 'none' and self._uses_cert_store:
+                self._use_cert_store_certificate()
+            self._controlmaster_reused = True
+            self._record_counters(**{COUNTER_CONTROLMASTER_REUSE: 1})
+            self._vault_cert_operations_done_this_instance = True
+
+        elif not self._vault_cert_operations_done_this_instance:
             display.v(f"{PLUGIN_NAME} ({host_for_msg}): Evaluating Vault certificate status for this connection instance.")
 
             log_primary_status_for_this_host_by_this_process = not Connection._host_logged_initial_cert_status_this_process.get(host_for_msg)
 
+            if self._resolved_ssh_agent != 'none':
+                self._ensure_ssh_agent()
+
             needs_renewal = False
 
             if self._resolved_force_key_refresh:
@@ -681,7 +2163,8 @@ class Connection(SSHConnection):
                 if log_primary_status_for_this_host_by_this_process:
                     display.display(f"{PLUGIN_NAME} ({host_for_msg}): Force refresh enabled. Attempting certificate renewal.", color=C.COLOR_VERBOSE)
             else:
-                is_fresh, reason = self._is_cert_fresh()
+                with self._timed('freshness_check'):
+                    is_fresh, reason = self._is_cert_fresh()
                 if not is_fresh:
                     needs_renewal = True
                     if log_primary_status_for_this_host_by_this_process:
@@ -713,6 +2196,18 @@ class Connection(SSHConnection):
                         display.error(msg)
                         raise AnsibleConnectionFailure(msg)
 
+            if self._uses_cert_store and self._resolved_ssh_agent == 'none':
+                self._touch_cert_store_entry()
+                self._use_cert_store_certificate()
+
+            if self._resolved_renewal_agent:
+                try:
+                    self._ensure_renewal_agent()
+                except Exception as e:
+                    display.warning(f"{PLUGIN_NAME} ({host_for_msg}): Could not start the renewal agent: {type(e).__name__} - {e}")
+
+            self._record_counters(**{COUNTER_CERT_EVALUATIONS: 1, COUNTER_CERT_RENEWALS: int(self._renewed),
+                                     COUNTER_LOCK_TIMEOUTS: int(self._lock_timed_out)})
             self._vault_cert_operations_done_this_instance = True
 
         else:
@@ -720,7 +2215,8 @@ class Connection(SSHConnection):
 
         display.v(f"{PLUGIN_NAME} ({host_for_msg}): Proceeding with SSH connection to {host_for_msg}.")
         try:
-            return super(Connection, self)._connect()
+            with self._timed('parent_connect'):
+                return super(Connection, self)._connect()
         except AnsibleConnectionFailure as e:
             display.error(f"{PLUGIN_NAME} ({host_for_msg}): SSH connection failed (parent plugin error). Original error: {e}")
             raise
@@ -728,4 +2224,228 @@ class Connection(SSHConnection):
             display.error(f"{PLUGIN_NAME} ({host_for_msg}): An unexpected error occurred during SSH connection: {type(e).__name__} - {e}")
             if isinstance(e, KeyError):
                  display.error(f"{PLUGIN_NAME} ({host_for_msg}): This KeyError might indicate that a standard SSH option (like '{str(e)}') is not defined in plugin's DOCUMENTATION or is misconfigured.")
-            raise AnsibleConnectionFailure(f"Unexpected connection error to {host_for_msg}: {e}")
\ No newline at end of file
+            raise AnsibleConnectionFailure(f"Unexpected connection error to {host_for_msg}: {e}")
+
+    def warm_certificate(self):
+        """Makes sure this connection's certificate is fresh without connecting. Returns True if it was renewed.
+
+        This is what _connect does before ssh runs; the warmup (--warmup) calls it for many identities at once.
+        """
+        if not self._config_loaded:
+            self._load_config()
+        if self._resolved_ssh_agent != 'none':
+            self._ensure_ssh_agent()
+
+        is_fresh, reason = self._is_cert_fresh()
+        if not is_fresh or self._resolved_force_key_refresh:
+            display.v(f"{PLUGIN_NAME} ({self.get_option('host')}): Warming up certificate ({reason if not is_fresh else 'forced'}).")
+            self._obtain_new_certificate()
+            is_fresh, reason = self._is_cert_fresh()
+            if not is_fresh:
+                raise AnsibleError(f"{PLUGIN_NAME} ({self.get_option('host')}): Certificate is not fresh after renewal ({reason}).")
+        if self._uses_cert_store and self._resolved_ssh_agent == 'none':
+            self._touch_cert_store_entry()
+
+        self._record_counters(**{COUNTER_CERT_EVALUATIONS: 1, COUNTER_CERT_RENEWALS: int(self._renewed),
+                                 COUNTER_LOCK_TIMEOUTS: int(self._lock_timed_out)})
+        return self._renewed
+
+    def exec_command(self, *args, **kwargs):
+        if self._first_command_done:
+            return super(Connection, self).exec_command(*args, **kwargs)
+        self._first_command_done = True
+        # Connect first, so 'first_command' only covers ssh itself (handshake or ControlMaster reuse, and the command)
+        self._connect()
+        with self._timed('first_command'):
+            return super(Connection, self).exec_command(*args, **kwargs)
+
+    def close(self):
+        self._emit_timings()
+        return super(Connection, self).close()
+
+
+def run_renewal_agent(connection, watch_pid=None):
+    """Keeps the certificate of a configured Connection renewed ahead of expiry.
+
+    Runs until watch_pid exits (forever if None). Only one agent per signed_key_path runs at a time.
+    Renewals take the same lock as connections, so the two never sign concurrently.
+    """
+    host_for_msg = connection.get_option('host')
+    agent_lock = CertificateLock(connection._resolved_signed_key_path + RENEWAL_AGENT_LOCK_SUFFIX)
+    if not agent_lock.acquire(0):
+        display.v(f"{PLUGIN_NAME} ({host_for_msg}): Renewal agent already running (PID {agent_lock.holder_pid() or 'unknown'}). Exiting.")
+        return 0
+
+    # Renew before connections consider the certificate stale, so they never have to wait for Vault
+    connection._resolved_key_min_ttl_seconds += RENEWAL_AGENT_MARGIN_SECONDS
+    connection._resolved_force_key_refresh = False
+    if connection._resolved_ssh_agent != 'none':
+        connection._ensure_ssh_agent()
+    display.display(f"{PLUGIN_NAME} ({host_for_msg}): Renewal agent started for '{connection._resolved_signed_key_path}' (PID {os.getpid()}).")
+    try:
+        while watch_pid is None or _pid_alive(watch_pid):
+            delay = RENEWAL_AGENT_POLL_SECONDS
+            is_fresh, reason = connection._is_cert_fresh()
+            if not is_fresh:
+                display.display(f"{PLUGIN_NAME} ({host_for_msg}): Renewal agent renewing certificate ({reason}).")
+                try:
+                    connection._obtain_new_certificate()
+                    is_fresh, _ = connection._is_cert_fresh()
+                    if not is_fresh:
+                        display.warning(f"{PLUGIN_NAME} ({host_for_msg}): Renewed certificate expires within key_min_ttl_seconds + "
+                                        f"{RENEWAL_AGENT_MARGIN_SECONDS}s; check the Vault role's TTL.")
+                except AnsibleError as e:
+                    display.warning(f"{PLUGIN_NAME} ({host_for_msg}): Renewal agent failed to renew the certificate, retrying in {delay}s: {e}")
+            if is_fresh:
+                renew_at = connection._read_current_cert().valid_before - timedelta(seconds=connection._resolved_key_min_ttl_seconds)
+                delay = min(max((renew_at - datetime.now(timezone.utc)).total_seconds(), 1), RENEWAL_AGENT_POLL_SECONDS)
+            time.sleep(delay)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        agent_lock.release()
+    display.display(f"{PLUGIN_NAME} ({host_for_msg}): Renewal agent stopped.")
+    return 0
+
+
+WARMUP_MAX_WORKERS = 8
+
+
+def warmup_connections(connection_loader, inventory_sources=None, limit=None):
+    """Returns ([[Connection]], {host: error}) for the certificates the inventory's hosts need.
+
+    Every host is configured from its variables like Ansible configures a task's connection, and hosts needing the
+    same (signing role, principal, public key, storage) share one Connection. Connections whose certificates share
+    one storage location (the same signed_key_path, or agent) are grouped, since they can only be renewed in turn.
+    Hosts without vault_ssh_ca_signing_role or vault_ssh_ca_principal don't use this plugin and are skipped.
+    """
+    from ansible.inventory.manager import InventoryManager
+    from ansible.parsing.dataloader import DataLoader
+    from ansible.playbook.play_context import PlayContext
+    from ansible.template import Templar
+    from ansible.vars.manager import VariableManager
+
+    loader = DataLoader()
+    inventory = InventoryManager(loader=loader, sources=inventory_sources or C.DEFAULT_HOST_LIST)
+    if limit:
+        inventory.subset(limit)
+    variable_manager = VariableManager(loader=loader, inventory=inventory)
+    var_names = None
+
+    groups = {}
+    identities = set()
+    errors = {}
+    for host in inventory.get_hosts():
+        connection = connection_loader.get('vault_ssh_signer', PlayContext(), None)
+        if var_names is None:
+            var_names = C.config.get_plugin_vars('connection', connection._load_name)
+        host_vars = variable_manager.get_vars(host=host)
+        templar = Templar(loader=loader, variables=host_vars)
+        try:
+            connection.set_options(var_options={name: templar.template(host_vars[name]) for name in var_names if name in host_vars})
+            if not connection.get_option('vault_ssh_ca_signing_role') or not connection.get_option('vault_ssh_ca_principal'):
+                continue
+            connection._load_config()
+        except AnsibleError as e:
+            errors[host.name] = str(e)
+            continue
+
+        identity = (connection._resolved_vault_sign_path, connection._resolved_vault_ssh_ca_principal,
+                    connection._resolved_public_key_path, connection._resolved_signed_key_path, connection._resolved_ssh_agent,
+                    connection._agent_socket() if connection._resolved_ssh_agent != 'none' else None)
+        if identity in identities:
+            continue
+        identities.add(identity)
+        # An agent holds any number of certificates; a certificate file only one
+        storage = identity if connection._resolved_ssh_agent != 'none' else connection._resolved_signed_key_path
+        groups.setdefault(storage, []).append(connection)
+    return list(groups.values()), errors
+
+
+def warmup_certificates(connection_groups, max_workers=WARMUP_MAX_WORKERS):
+    """Renews the certificates of connection_groups concurrently, one worker per group.
+
+    Returns {'<sign path> <principal> <public key path>': 'fresh', 'renewed' or the error}.
+    """
+    def warm_group(connections):
+        outcomes = {}
+        if len(connections) > 1:
+            display.warning(f"{PLUGIN_NAME}: {len(connections)} identities share '{connections[0]._resolved_signed_key_path}', so only the "
+                            f"last one stays signed; set vault_ssh_cert_store_dir to keep one certificate per identity.")
+        for connection in connections:
+            label = f"{connection._resolved_vault_sign_path} {connection._resolved_vault_ssh_ca_principal} {connection._resolved_public_key_path}"
+            try:
+                outcomes[label] = "renewed" if connection.warm_certificate() else "fresh"
+            except AnsibleError as e:
+                outcomes[label] = str(e)
+        return outcomes
+
+    results = {}
+    if not connection_groups:
+        return results
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(connection_groups)))) as executor:
+        for outcomes in executor.map(warm_group, connection_groups):
+            results.update(outcomes)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Renewal agent for the vault_ssh_signer connection plugin: keeps a "
+                                                 "Vault-signed SSH certificate renewed ahead of expiry. With --warmup, "
+                                                 "signs every certificate the inventory needs before a play instead.")
+    parser.add_argument("--warmup", action="store_true",
+                        help="Renew the certificate of every distinct (signing role, principal, public key) in the inventory "
+                             "concurrently, then exit.")
+    parser.add_argument("-i", "--inventory", action="append", help="Inventory source for --warmup (default: the configured inventory).")
+    parser.add_argument("-l", "--limit", help="Host pattern restricting --warmup, as for ansible-playbook.")
+    parser.add_argument("--workers", type=int, default=WARMUP_MAX_WORKERS, help="Concurrent signings for --warmup.")
+    parser.add_argument("--signing-role", help="Vault SSH CA role, e.g. 'ssh-engine/roles/my-role' (vault_ssh_ca_signing_role).")
+    parser.add_argument("--principal", help="Principal to request (vault_ssh_ca_principal).")
+    parser.add_argument("--public-key-path", help="Public key to sign (public_key_path).")
+    parser.add_argument("--private-key-file", help="Private key loaded into the ssh-agent with the certificate (private_key_file).")
+    parser.add_argument("--signed-key-path", help="Where the certificate is stored (signed_key_path).")
+    parser.add_argument("--min-ttl", type=int, help="Connections' key_min_ttl_seconds.")
+    parser.add_argument("--vault-client", choices=['auto', 'http', 'cli'], help="How to reach Vault (vault_client).")
+    parser.add_argument("--lock-timeout", type=int, help="renewal_lock_timeout_seconds.")
+    parser.add_argument("--ssh-agent", choices=['none', 'managed', 'external'], help="Load certificates into an ssh-agent (ssh_agent).")
+    parser.add_argument("--ssh-agent-socket", help="Socket of the managed ssh-agent (ssh_agent_socket).")
+    parser.add_argument("--watch-pid", type=int, help="Exit once this process has exited.")
+    args = parser.parse_args()
+    if not args.warmup and not (args.signing_role and args.principal):
+        parser.error("--signing-role and --principal are required (unless --warmup)")
+
+    from ansible.playbook.play_context import PlayContext
+    from ansible.plugins.loader import connection_loader
+
+    connection_loader.add_directory(os.path.dirname(os.path.abspath(__file__)))
+    if args.warmup:
+        connection_groups, errors = warmup_connections(connection_loader, args.inventory, args.limit)
+        results = warmup_certificates(connection_groups, args.workers)
+        results.update({f"host {host}": error for host, error in errors.items()})
+        print(json.dumps(results, indent=2))
+        failed = [label for label, outcome in results.items() if outcome not in ("fresh", "renewed")]
+        if failed:
+            display.error(f"{PLUGIN_NAME}: Could not warm up {len(failed)} certificate(s).")
+        sys.exit(1 if failed else 0)
+
+    connection = connection_loader.get('vault_ssh_signer', PlayContext(), None)
+    options = {
+        'host': 'renewal-agent',
+        'vault_ssh_ca_signing_role': args.signing_role,
+        'vault_ssh_ca_principal': args.principal,
+        'public_key_path': args.public_key_path,
+        'private_key_file': args.private_key_file or None,
+        'signed_key_path': args.signed_key_path,
+        'key_min_ttl_seconds': args.min_ttl,
+        'vault_client': args.vault_client,
+        'renewal_lock_timeout_seconds': args.lock_timeout,
+        'ssh_agent': args.ssh_agent,
+        'ssh_agent_socket': args.ssh_agent_socket or None,
+    }
+    connection.set_options(direct={key: value for key, value in options.items() if value is not None})
+    connection._load_config()
+    sys.exit(run_renewal_agent(connection, args.watch_pid))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import hashlib
+import importlib.util
+import os
+
+from ansible.errors import AnsibleParserError
+from ansible.plugins.inventory import BaseInventoryPlugin, Cacheable, Constructable
+from ansible.utils.display import Display
+
+display = Display()
+
+DOCUMENTATION = '''
+    name: tofu_state
+    short_description: Builds the inventory in-process from OpenTofu 'ansible_host' resources.
+    description:
+        - Native replacement for C(inventories/dynamic_inventory.py). It reuses the script's state readers
+          (native v4 state file reader, streaming 'tofu show -json' parser) and host derivation, but populates
+          the inventory inside the Ansible process. That saves the extra interpreter start and the JSON round-trip.
+        - Results are stored in Ansible's inventory cache, so any cache plugin can be used
+          (V(ansible.builtin.jsonfile), V(community.general.memcached), V(community.general.redis), ...).
+        - Supports O(compose), O(groups) and O(keyed_groups) on top of the groups declared in OpenTofu.
+        - The inventory source file name must end with C(tofu_state.yml) or C(tofu_state.yaml).
+    author: "Your Name (OpenTofu state inventory)"
+    extends_documentation_fragment:
+        - constructed
+        - inventory_cache
+    options:
+      plugin:
+          description: Token that ensures this is a source file for the 'tofu_state' plugin.
+          required: true
+          choices: ['tofu_state']
+      tofu_dir:
+          description:
+              - OpenTofu root directory whose state is read. Relative paths are resolved against the directory of the
+                inventory source file. Defaults to C(infrastructure/opentofu).
+          type: path
+          env: [{name: TOFU_INVENTORY_DIR}]
+      workspace:
+          description: OpenTofu workspace of O(tofu_dir). The current workspace is used when unset.
+          type: string
+      sources:
+          description:
+              - List of C([label=]dir[@workspace]) entries to merge into one inventory, fetched concurrently.
+                Takes precedence over O(tofu_dir). Relative directories are resolved like O(tofu_dir).
+              - Every host is added to a group named after its source label.
+          type: list
+          elements: string
+          default: []
+      conflict_policy:
+          description: What to do with a host defined differently in several O(sources).
+          type: string
+          choices: ['namespace', 'error']
+          default: namespace
+      module_filter:
+          description: Only include hosts declared in this module address (e.g. C(module.web)) or its child modules.
+          type: string
+          default: ''
+      limit:
+          description:
+              - Only include the hosts this Ansible host pattern selects (e.g. C(web-eu-*,!web-eu-03)), evaluated while the
+                state is read, so a run against a few hosts does not build the whole fleet.
+              - Set it to the same pattern as C(--limit). Hosts outside it are not in the inventory at all, so plays can't
+                delegate to them or read their hostvars.
+          type: string
+          default: ''
+          env: [{name: TOFU_INVENTORY_LIMIT}]
+      shard:
+          description:
+              - Only include shard C(K/N) of the hosts (1 <= K <= N), so N controllers can each run part of one fleet.
+              - Hosts are assigned by rendezvous hashing of their jumphost (or their name without one), so hosts behind
+                one jumphost stay together and going from N to N+1 shards moves as few hosts as possible.
+              - Applied after the cache, so every shard can share one cached inventory.
+          type: string
+          default: ''
+          env: [{name: TOFU_INVENTORY_SHARD}]
+'''
+
+EXAMPLES = '''
+# inventories/tofu_state.yml
+plugin: tofu_state
+cache: true
+cache_plugin: ansible.builtin.jsonfile
+cache_connection: .ansible/inventory_cache/tofu_state
+cache_timeout: 300
+keyed_groups:
+  - key: vault_ssh_ca_principal
+    prefix: principal
+compose:
+  ansible_port: 22
+'''
+
+PLUGIN_NAME = "OpenTofu State Inventory"
+
+# The inventory script lives outside any Python package, so it is loaded from its path once per process.
+DYNAMIC_INVENTORY_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "inventories", "dynamic_inventory.py")
+_dynamic_inventory = None
+
+
+def load_dynamic_inventory():
+    """Imports inventories/dynamic_inventory.py, whose state readers and host derivation this plugin reuses."""
+    global _dynamic_inventory
+    if _dynamic_inventory is None:
+        spec = importlib.util.spec_from_file_location("tofu_state_dynamic_inventory", DYNAMIC_INVENTORY_SCRIPT)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _dynamic_inventory = module
+    return _dynamic_inventory
+
+
+class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
+    NAME = 'tofu_state'
+
+    def verify_file(self, path):
+        if super(InventoryModule, self).verify_file(path):
+            return path.endswith(('tofu_state.yml', 'tofu_state.yaml'))
+        return False
+
+    def _resolve_dir(self, path, base_dir):
+        path = os.path.expanduser(path)
+        return path if os.path.isabs(path) else os.path.normpath(os.path.join(base_dir, path))
+
+    def _fetch_inventory(self, path, host_pattern):
+        dynamic_inventory = load_dynamic_inventory()
+        base_dir = os.path.dirname(os.path.abspath(path))
+        module_filter = self.get_option('module_filter') or ""
+
+        # The script's helpers report their errors on stderr and exit; don't let that take Ansible down
+        try:
+            sources = dynamic_inventory.parse_sources(self.get_option('sources') or [])
+            if sources:
+                sources = [source._replace(tofu_dir=self._resolve_dir(source.tofu_dir, base_dir)) for source in sources]
+                display.vv(f"{PLUGIN_NAME}: Reading {len(sources)} OpenTofu sources: "
+                           f"{', '.join(f'{s.label}={s.tofu_dir}@{s.workspace}' for s in sources)}")
+                return dynamic_inventory.get_merged_inventory(
+                    sources, module_filter=module_filter, use_cache=False,
+                    conflict_policy=self.get_option('conflict_policy'), host_pattern=host_pattern)
+
+            tofu_dir_opt = self.get_option('tofu_dir')
+            tofu_dir = self._resolve_dir(tofu_dir_opt, base_dir) if tofu_dir_opt else dynamic_inventory.DEFAULT_TOFU_DIR
+            display.vv(f"{PLUGIN_NAME}: Reading OpenTofu state of {tofu_dir}")
+            return dynamic_inventory.build_source_inventory(tofu_dir, module_filter, self.get_option('workspace'), host_pattern)
+        except SystemExit:
+            raise AnsibleParserError(f"{PLUGIN_NAME}: Failed to read the OpenTofu state (see the error above).")
+
+    def _populate(self, inventory_data):
+        strict = self.get_option('strict')
+
+        for group_name, group in inventory_data.items():
+            if group_name in ('_meta', 'all'):
+                continue
+            self.inventory.add_group(group_name)
+            for host_name in group.get('hosts', []):
+                self.inventory.add_host(host_name, group=group_name)
+
+        for host_name, host_vars in inventory_data['_meta']['hostvars'].items():
+            self.inventory.add_host(host_name)
+            for var_name, value in host_vars.items():
+                self.inventory.set_variable(host_name, var_name, value)
+
+            # Constructed features: compose vars, conditional groups and keyed groups
+            self._set_composite_vars(self.get_option('compose'), host_vars, host_name, strict=strict)
+            self._add_host_to_composed_groups(self.get_option('groups'), host_vars, host_name, strict=strict)
+            self._add_host_to_keyed_groups(self.get_option('keyed_groups'), host_vars, host_name, strict=strict)
+
+    def parse(self, inventory, loader, path, cache=True):
+        super(InventoryModule, self).parse(inventory, loader, path, cache)
+        self._read_config_data(path)
+
+        dynamic_inventory = load_dynamic_inventory()
+        try:
+            host_pattern = dynamic_inventory.parse_host_pattern(self.get_option('limit'))
+            shard = dynamic_inventory.parse_shard(self.get_option('shard'))
+        except ValueError as e:
+            raise AnsibleParserError(f"{PLUGIN_NAME}: {e}")
+
+        cache_key = self.get_cache_key(path)
+        if host_pattern is not None:
+            # A limited inventory must not be served to runs with another (or no) limit
+            cache_key = f"{cache_key}_{hashlib.sha1(host_pattern.key.encode('utf-8')).hexdigest()[:10]}"
+        # cache is False when the user asked for a refresh (e.g. --flush-cache)
+        user_cache_setting = self.get_option('cache')
+        attempt_to_read_cache = user_cache_setting and cache
+        cache_needs_update = user_cache_setting and not cache
+
+        inventory_data = None
+        if attempt_to_read_cache:
+            try:
+                inventory_data = self._cache[cache_key]
+                display.vvv(f"{PLUGIN_NAME}: Using cached inventory for {path}")
+            except KeyError:
+                cache_needs_update = True
+
+        if inventory_data is None:
+            inventory_data = self._fetch_inventory(path, host_pattern)
+
+        if cache_needs_update:
+            self._cache[cache_key] = inventory_data
+
+        if shard:
+            inventory_data = dynamic_inventory.shard_inventory(inventory_data, *shard)
+
+        self._populate(inventory_data)
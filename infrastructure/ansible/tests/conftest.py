@@ -0,0 +1,100 @@
+"""Shared fixtures for the inventory script and plugin tests.
+
+Run from infrastructure/ansible:
+    python3 -m pytest -q tests
+"""
+
+import importlib.util
+import os
+import shutil
+import subprocess
+
+import pytest
+
+ANSIBLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def load_module(name, relative_path):
+    """Imports a script from the Ansible tree that isn't reachable as a package module."""
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ANSIBLE_DIR, relative_path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope="session")
+def dynamic_inventory():
+    return load_module("dynamic_inventory", os.path.join("inventories", "dynamic_inventory.py"))
+
+
+@pytest.fixture(scope="session")
+def vault_ssh_signer():
+    pytest.importorskip("ansible")
+    return load_module("vault_ssh_signer", os.path.join("plugins", "connection", "vault_ssh_signer.py"))
+
+
+@pytest.fixture(scope="session")
+def cert_fixtures():
+    """benchmarks/fixtures.py: synthetic keys and certificates, and the stub 'vault' CLI."""
+    return load_module("fixtures", os.path.join("benchmarks", "fixtures.py"))
+
+
+@pytest.fixture(scope="session")
+def make_connection():
+    """Returns a function creating vault_ssh_signer Connections configured with options, as Ansible's workers do."""
+    pytest.importorskip("ansible")
+    from ansible.playbook.play_context import PlayContext
+    from ansible.plugins.loader import connection_loader
+    connection_loader.add_directory(os.path.join(ANSIBLE_DIR, "plugins", "connection"))
+
+    def make(**options):
+        play_context = PlayContext()
+        play_context.remote_addr = "10.0.0.1"
+        connection = connection_loader.get("vault_ssh_signer", play_context, None)
+        connection.set_options(direct=dict({
+            "host": "10.0.0.1",
+            "vault_ssh_ca_signing_role": "test/ssh/roles/default-role",
+            "vault_ssh_ca_principal": "ansible",
+            "timings_file": "",
+        }, **options))
+        connection._load_config()
+        return connection
+
+    return make
+
+
+class SSHCertificateAuthority:
+    """An OpenSSH user CA made with ssh-keygen, signing real certificates for key pairs it generates."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.key_path = os.path.join(directory, "ca")
+        self._keygen("-t", "ed25519", "-N", "", "-f", self.key_path)
+
+    @staticmethod
+    def _keygen(*args):
+        subprocess.run(["ssh-keygen", "-q", *args], check=True, capture_output=True, stdin=subprocess.DEVNULL)
+
+    def make_key_pair(self, name="id_ed25519", key_type="ed25519", bits=None):
+        """Generates a key pair without a passphrase and returns the public key's path."""
+        private_key_path = os.path.join(self.directory, name)
+        self._keygen("-t", key_type, *(("-b", str(bits)) if bits else ()), "-N", "", "-f", private_key_path)
+        return private_key_path + ".pub"
+
+    def sign(self, public_key_path, principals, validity="-1m:+1h", serial=1, key_id="test-cert"):
+        """Signs public_key_path ('ssh-keygen -V' validity) and returns the path of the '-cert.pub' written next to it.
+
+        Without principals the certificate is valid for any principal.
+        """
+        principal_args = ("-n", ",".join(principals)) if principals else ()
+        self._keygen("-s", self.key_path, "-I", key_id, *principal_args, "-V", validity, "-z", str(serial), public_key_path)
+        return public_key_path[:-len(".pub")] + "-cert.pub"
+
+
+@pytest.fixture
+def ssh_ca(tmp_path):
+    if shutil.which("ssh-keygen") is None:
+        pytest.skip("ssh-keygen is not installed")
+    directory = tmp_path / "ssh-ca"
+    directory.mkdir()
+    return SSHCertificateAuthority(str(directory))
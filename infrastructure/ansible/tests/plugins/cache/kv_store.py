@@ -0,0 +1,58 @@
+"""Local stand-in for a networked key/value cache plugin (redis, memcached) in the tests."""
+
+from __future__ import annotations
+
+DOCUMENTATION = """
+    name: kv_store
+    short_description: In-process stand-in for a shared key/value cache server
+    description:
+        - Keeps one keyspace per O(_uri), shared by every plugin instance in the process the way one redis or memcached
+          server is shared by its clients. Values are stored JSON encoded, as they would cross the wire.
+    options:
+      _uri:
+        description: Name of the keyspace (the server address for a real backend).
+        type: string
+        default: localhost:6379:0
+      _prefix:
+        description: Prefix of every key.
+        type: string
+        default: ''
+      _timeout:
+        description: Expiration timeout in seconds (not enforced).
+        type: integer
+        default: 86400
+"""
+
+import json
+
+from ansible.plugins.cache import BaseCacheModule
+
+# Keyspaces by _uri, inspected by the tests
+SERVERS = {}
+
+
+class CacheModule(BaseCacheModule):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._prefix = self.get_option('_prefix') or ''
+        self._store = SERVERS.setdefault(self.get_option('_uri'), {})
+
+    def get(self, key):
+        return json.loads(self._store[self._prefix + key])
+
+    def set(self, key, value):
+        self._store[self._prefix + key] = json.dumps(value)
+
+    def keys(self):
+        return [key[len(self._prefix):] for key in self._store if key.startswith(self._prefix)]
+
+    def contains(self, key):
+        return self._prefix + key in self._store
+
+    def delete(self, key):
+        self._store.pop(self._prefix + key, None)
+
+    def flush(self):
+        for key in self.keys():
+            self.delete(key)
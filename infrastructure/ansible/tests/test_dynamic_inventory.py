@@ -0,0 +1,721 @@
+"""Tests for inventories/dynamic_inventory.py."""
+
+import copy
+import hashlib
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+
+def assert_same_as_rebuild(dynamic_inventory, inventory, records):
+    """Asserts inventory is exactly what a full rebuild from records renders, down to list and key order."""
+    rebuilt = dynamic_inventory.build_inventory_from_records(records)
+    assert inventory == rebuilt
+    assert json.dumps(inventory) == json.dumps(rebuilt)
+
+
+def make_record(dynamic_inventory, host_name, groups, address="10.0.0.1"):
+    return dynamic_inventory.HostRecord("module.vms", host_name, groups, {"ansible_host": address})
+
+
+def patch_from(dynamic_inventory, old_records, new_records):
+    """Builds the inventory for old_records, patches it to new_records and returns (patched, fingerprints)."""
+    inventory = dynamic_inventory.build_inventory_from_records(old_records)
+    fingerprints = {record.host_name: dynamic_inventory.host_fingerprint(record) for record in old_records}
+    return inventory, dynamic_inventory.patch_inventory(inventory, fingerprints, new_records)
+
+
+def test_patch_removes_host_with_duplicate_groups(dynamic_inventory):
+    old_records = [
+        make_record(dynamic_inventory, "web-1", ["web", "web"]),
+        make_record(dynamic_inventory, "web-2", ["web"]),
+    ]
+    new_records = old_records[1:]
+
+    inventory, fingerprints = patch_from(dynamic_inventory, old_records, new_records)
+
+    assert fingerprints is not None
+    assert_same_as_rebuild(dynamic_inventory, inventory, new_records)
+
+
+def test_patch_changes_host_with_duplicate_groups(dynamic_inventory):
+    old_records = [make_record(dynamic_inventory, "db-1", ["db", "backup", "db"])]
+    new_records = [make_record(dynamic_inventory, "db-1", ["backup", "backup"], address="10.0.0.2")]
+
+    inventory, fingerprints = patch_from(dynamic_inventory, old_records, new_records)
+
+    assert fingerprints is not None
+    assert_same_as_rebuild(dynamic_inventory, inventory, new_records)
+
+
+def test_patch_refuses_inconsistent_cache(dynamic_inventory):
+    old_records = [make_record(dynamic_inventory, "web-1", ["web"])]
+    inventory = dynamic_inventory.build_inventory_from_records(old_records)
+    # Fingerprints name a host the cached inventory doesn't have
+    fingerprints = {record.host_name: dynamic_inventory.host_fingerprint(record)
+                    for record in old_records + [make_record(dynamic_inventory, "db-1", ["db"])]}
+    untouched = copy.deepcopy(inventory)
+
+    assert dynamic_inventory.patch_inventory(inventory, fingerprints, []) is None
+    assert inventory == untouched
+
+
+def test_patch_keeps_rebuild_order(dynamic_inventory):
+    old_records = [make_record(dynamic_inventory, f"web-{index}", ["web"]) for index in range(1, 4)]
+    # web-0 is declared first but added last; web-2 moves to the end of the state
+    new_records = [make_record(dynamic_inventory, "web-0", ["edge", "web"])] + [old_records[0], old_records[2], old_records[1]]
+
+    inventory, fingerprints = patch_from(dynamic_inventory, old_records, new_records)
+
+    assert fingerprints is not None
+    assert inventory["web"]["hosts"] == ["web-0", "web-1", "web-3", "web-2"]
+    assert inventory["all"]["children"] == ["ungrouped", "edge", "web"]
+    assert_same_as_rebuild(dynamic_inventory, inventory, new_records)
+
+
+def test_patch_fingerprints_are_digests(dynamic_inventory):
+    record = make_record(dynamic_inventory, "web-1", ["web"])
+    changed = make_record(dynamic_inventory, "web-1", ["web"], address="10.0.0.2")
+
+    assert dynamic_inventory.host_fingerprint(record) == dynamic_inventory.host_fingerprint(make_record(dynamic_inventory, "web-1", ["web"]))
+    assert dynamic_inventory.host_fingerprint(record) != dynamic_inventory.host_fingerprint(changed)
+    # The cache holds no copy of the variables
+    assert "10.0.0.1" not in json.dumps(dynamic_inventory.host_fingerprint(record))
+
+
+def test_patch_matches_full_rebuild(dynamic_inventory):
+    rng = random.Random(8)
+    group_names = ["web", "db", "cache", "ungrouped", "edge"]
+
+    def random_records():
+        return [
+            make_record(dynamic_inventory, f"vm-{index}", [rng.choice(group_names) for _ in range(rng.randint(0, 3))],
+                        address=f"10.0.0.{rng.randint(1, 3)}")
+            for index in rng.sample(range(12), rng.randint(0, 12))
+        ]
+
+    for _ in range(300):
+        old_records, new_records = random_records(), random_records()
+        inventory, fingerprints = patch_from(dynamic_inventory, old_records, new_records)
+        if fingerprints is None:
+            continue
+        assert_same_as_rebuild(dynamic_inventory, inventory, new_records)
+
+
+def write_json(path, document):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(document), encoding="utf-8")
+
+
+def write_local_state(tofu_dir, host_names=("web-1",), path="terraform.tfstate", serial=3, address_prefix="10.0.0."):
+    write_json(tofu_dir / path, {
+        "version": 4,
+        "serial": serial,
+        "lineage": "1b0c5d3e",
+        "resources": [{
+            "mode": "managed",
+            "type": "ansible_host",
+            "name": "vm",
+            "instances": [
+                {"index_key": index, "attributes": {"name": host_name, "groups": ["web"], "variables": {"ansible_host": f"{address_prefix}{index + 1}"}}}
+                for index, host_name in enumerate(host_names)
+            ],
+        }],
+    })
+
+
+def run_inventory(tmp_path, *args, **env):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "inventories", "dynamic_inventory.py")
+    environment = dict(os.environ, TOFU_INVENTORY_DIR=str(tmp_path / "tofu"), TOFU_INVENTORY_CACHE_DIR=str(tmp_path / "cache"),
+                       TOFU_INVENTORY_STATE_SOURCE="auto")
+    environment.update(env)
+    environment.pop("TOFU_INVENTORY_STATE_FILE", None)
+    environment.pop("TOFU_INVENTORY_SOURCES", None)
+    result = subprocess.run([sys.executable, script, *args], env=environment, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout)
+
+
+def test_state_file_read_natively_without_backend(dynamic_inventory, tmp_path, monkeypatch):
+    monkeypatch.delenv("TOFU_INVENTORY_STATE_FILE", raising=False)
+    write_local_state(tmp_path)
+
+    assert dynamic_inventory.load_state_file(str(tmp_path)) is not None
+    assert dynamic_inventory.read_state_identity(str(tmp_path)) == {"lineage": "1b0c5d3e", "serial": 3}
+
+
+def test_state_file_read_natively_with_local_backend_path(dynamic_inventory, tmp_path, monkeypatch):
+    monkeypatch.delenv("TOFU_INVENTORY_STATE_FILE", raising=False)
+    write_json(tmp_path / ".terraform" / "terraform.tfstate", {"backend": {"type": "local", "config": {"path": "state/main.tfstate"}}})
+    write_local_state(tmp_path, path="state/main.tfstate")
+
+    assert dynamic_inventory.get_state_file_path(str(tmp_path)) == str(tmp_path / "state" / "main.tfstate")
+    assert dynamic_inventory.load_state_file(str(tmp_path)) is not None
+
+
+def test_stale_state_file_ignored_with_remote_backend(dynamic_inventory, tmp_path, monkeypatch):
+    monkeypatch.delenv("TOFU_INVENTORY_STATE_FILE", raising=False)
+    write_json(tmp_path / ".terraform" / "terraform.tfstate", {"backend": {"type": "pg", "config": {"schema_name": "infra"}}})
+    write_local_state(tmp_path)
+
+    assert dynamic_inventory.get_state_file_path(str(tmp_path)) is None
+    assert dynamic_inventory.load_state_file(str(tmp_path)) is None
+    assert dynamic_inventory.read_state_identity(str(tmp_path)) is None
+
+
+def test_expired_cache_for_unchanged_state_skips_parse(dynamic_inventory, tmp_path, monkeypatch):
+    monkeypatch.delenv("TOFU_INVENTORY_STATE_FILE", raising=False)
+    monkeypatch.setenv("TOFU_INVENTORY_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setenv("TOFU_INVENTORY_CACHE_TTL", "300")
+    tofu_dir = tmp_path / "tofu"
+    write_local_state(tofu_dir)
+    inventory = dynamic_inventory.get_inventory(str(tofu_dir))
+
+    # Let the TTL run out without touching the state
+    cache_path = dynamic_inventory.get_cache_path(str(tofu_dir))
+    entry = json.loads(open(cache_path, encoding="utf-8").read())
+    entry["created_at"] -= 600
+    write_json(tmp_path / "cache" / os.path.basename(cache_path), entry)
+
+    def parse_state(*args, **kwargs):
+        raise AssertionError("state parsed although its lineage/serial matched the cache")
+
+    monkeypatch.setattr(dynamic_inventory, "open_state_records", parse_state)
+    assert dynamic_inventory.get_inventory(str(tofu_dir)) == inventory
+
+
+def test_host_lookup_honours_shard(tmp_path):
+    host_names = [f"vm-{index}" for index in range(12)]
+    write_local_state(tmp_path / "tofu", host_names)
+
+    listed = run_inventory(tmp_path, "--list", "--shard", "1/2")["_meta"]["hostvars"]
+
+    assert 0 < len(listed) < len(host_names)
+    for host_name in host_names:
+        host_vars = run_inventory(tmp_path, "--host", host_name, "--shard", "1/2")
+        assert host_vars == listed.get(host_name, {})
+
+
+def test_stats_read_selected_workspace(tmp_path):
+    write_local_state(tmp_path / "tofu", ["default-1"])
+    write_local_state(tmp_path / "tofu", ["staging-1", "staging-2"], path="terraform.tfstate.d/staging/terraform.tfstate")
+
+    assert run_inventory(tmp_path, "--stats")["hosts"] == 1
+    assert run_inventory(tmp_path, "--stats", TF_WORKSPACE="staging")["hosts"] == 2
+    assert set(run_inventory(tmp_path, "--list", TF_WORKSPACE="staging")["_meta"]["hostvars"]) == {"staging-1", "staging-2"}
+
+
+@pytest.mark.parametrize("pattern, terms", [
+    ("web:db", ["web", "db"]),
+    ("web[1:3]", ["web[1:3]"]),
+    ("web[1:]:db", ["web[1:]", "db"]),
+    ("web[0], db[2:3] ,&prod", ["web[0]", "db[2:3]", "&prod"]),
+    ("fe80::1", ["fe80::1"]),
+])
+def test_split_host_pattern_keeps_subscripts_whole(dynamic_inventory, pattern, terms):
+    assert dynamic_inventory.split_host_pattern(pattern) == terms
+
+
+HOSTS = {
+    "web-eu-01": ["web", "prod"],
+    "web-eu-02": ["web", "staging"],
+    "web-us-01": ["web", "prod"],
+    "db-eu-01": ["db", "prod"],
+    "bastion": [],
+}
+
+
+def selected(dynamic_inventory, pattern):
+    host_pattern = dynamic_inventory.parse_host_pattern(pattern)
+    return sorted(host_name for host_name, groups in HOSTS.items() if host_pattern is None or host_pattern.matches(host_name, groups))
+
+
+@pytest.mark.parametrize("pattern, hosts", [
+    ("web-eu-*", ["web-eu-01", "web-eu-02"]),
+    ("web:&prod", ["web-eu-01", "web-us-01"]),
+    ("prod,!db", ["web-eu-01", "web-us-01"]),
+    ("web,!web-eu-0?", ["web-us-01"]),
+    ("~^(db|bastion)", ["bastion", "db-eu-01"]),
+    ("ungrouped", ["bastion"]),
+    ("all,!prod", ["bastion", "web-eu-02"]),
+    ("bastion", ["bastion"]),
+])
+def test_host_pattern_selects_like_ansible(dynamic_inventory, pattern, hosts):
+    assert selected(dynamic_inventory, pattern) == hosts
+
+
+@pytest.mark.parametrize("pattern", ["web[0]", "web[-1]", "web[1:2]", "web[1:]", "web[0-1]", "web[1:2]:&web"])
+def test_host_pattern_subscript_selects_whole_group(dynamic_inventory, pattern):
+    assert selected(dynamic_inventory, pattern) == ["web-eu-01", "web-eu-02", "web-us-01"]
+
+
+def test_host_pattern_excluding_subscript_excludes_nothing(dynamic_inventory):
+    assert selected(dynamic_inventory, "web:!web[0]") == ["web-eu-01", "web-eu-02", "web-us-01"]
+
+
+def test_unparseable_host_pattern_selects_every_host(dynamic_inventory, capsys):
+    assert dynamic_inventory.parse_host_pattern("~web(") is None
+    assert "Ignoring host pattern" in capsys.readouterr().err
+    assert selected(dynamic_inventory, "~web(") == sorted(HOSTS)
+
+
+def test_host_lookup_reads_only_that_hosts_entry(dynamic_inventory, tmp_path, monkeypatch):
+    monkeypatch.delenv("TOFU_INVENTORY_STATE_FILE", raising=False)
+    monkeypatch.setenv("TOFU_INVENTORY_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setenv("TOFU_INVENTORY_CACHE_TTL", "300")
+    tofu_dir = tmp_path / "tofu"
+    write_local_state(tofu_dir, [f"vm-{index}" for index in range(500)])
+    dynamic_inventory.get_inventory(str(tofu_dir))
+
+    def no_rebuild(*args, **kwargs):
+        raise AssertionError("the inventory was read although the host index is fresh")
+
+    decoded = []
+    real_loads = json.loads
+
+    def recording_loads(document, *args, **kwargs):
+        decoded.append(document)
+        return real_loads(document, *args, **kwargs)
+
+    monkeypatch.setattr(dynamic_inventory, "get_inventory", no_rebuild)
+    monkeypatch.setattr(dynamic_inventory, "open_state_records", no_rebuild)
+    monkeypatch.setattr(dynamic_inventory.json, "loads", recording_loads)
+
+    assert dynamic_inventory.get_host_vars(str(tofu_dir), "vm-42")["ansible_host"] == "10.0.0.43"
+    assert dynamic_inventory.get_host_vars(str(tofu_dir), "vm-missing") == {}
+    # The index entry carries no hostvars, and only vm-42's row was decoded
+    index_entry_path = dynamic_inventory.get_host_index_path(dynamic_inventory.get_cache_path(str(tofu_dir)))
+    assert os.path.getsize(index_entry_path) < 512
+    host_documents = [document for document in decoded if "ansible_host" in document]
+    assert len(host_documents) == 1 and '"10.0.0.43"' in host_documents[0]
+
+
+def test_host_index_invalidated_by_state_serial(dynamic_inventory, tmp_path, monkeypatch):
+    monkeypatch.delenv("TOFU_INVENTORY_STATE_FILE", raising=False)
+    monkeypatch.setenv("TOFU_INVENTORY_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setenv("TOFU_INVENTORY_CACHE_TTL", "300")
+    tofu_dir = tmp_path / "tofu"
+    write_local_state(tofu_dir, ["vm-0", "vm-1"])
+    assert dynamic_inventory.get_host_vars(str(tofu_dir), "vm-1")["ansible_host"] == "10.0.0.2"
+
+    write_local_state(tofu_dir, ["vm-0", "vm-1"], serial=4, address_prefix="10.1.0.")
+
+    assert dynamic_inventory.get_host_vars(str(tofu_dir), "vm-1")["ansible_host"] == "10.1.0.2"
+    # The index of the previous state is removed once it is replaced
+    assert len([name for name in os.listdir(tmp_path / "cache") if name.endswith(".sqlite")]) == 1
+
+
+def show_resource(module_address, name, resource_type="ansible_host", values=None):
+    prefix = f"{module_address}." if module_address else ""
+    return {"address": f"{prefix}{resource_type}.{name}", "mode": "managed", "type": resource_type, "name": name,
+            "values": values if values is not None else {"name": name, "groups": ["web"], "variables": {}}}
+
+
+# A 'tofu show -json' document with everything the stream parser must step over: structure characters,
+# quotes and backslashes inside strings, escapes, non-ASCII text, numbers, long keys and nested modules
+SHOW_DOCUMENT = {
+    "format_version": "1.0",
+    "values": {
+        "outputs": {"note": {"value": "} ] , : { [ \"resources\": [", "sensitive": False}},
+        "root_module": {
+            "resources": [
+                show_resource("", "plain"),
+                show_resource("", "escapes", values={
+                    "name": "escapes",
+                    "groups": ["we\"b", "back\\slash\\", "tab\tand\nnewline"],
+                    "variables": {"motd": "caf\u00e9 \u2603 \U0001f680", "quote_end": "\\\"", "path": "C:\\\\dir\\"},
+                }),
+                show_resource("", "vm", resource_type="aws_instance", values={"tags": {"x" * 300: "\"}]"}, "count": -0.5e-3}),
+                show_resource("", "numbers", values={
+                    "name": "numbers",
+                    "groups": [],
+                    "variables": {"port": 2222, "weight": -1.25e+10, "ratio": 0.0, "on": True, "off": False, "none": None,
+                                  "list": [[1, [2, {"k": [3]}]], {}], "long_" + "k" * 300: "v"},
+                }),
+            ],
+            "child_modules": [{
+                "address": "module.outer",
+                "resources": [show_resource("module.outer", "outer-1")],
+                "child_modules": [{
+                    "address": "module.outer.module.inner[\"a\"]",
+                    "resources": [
+                        show_resource("module.outer.module.inner[\"a\"]", "inner-1"),
+                        show_resource("module.outer.module.inner[\"a\"]", "skip", resource_type="null_resource", values={}),
+                    ],
+                }],
+            }, {
+                "address": "module.second",
+                "resources": [show_resource("module.second", "second-1")],
+            }],
+        },
+    },
+}
+
+
+def expected_show_resources(document):
+    """The ansible_host resources of a 'tofu show -json' document, in the parser's order, read with json.loads."""
+    resources = []
+    pending_modules = [document["values"]["root_module"]]
+    while pending_modules:
+        module = pending_modules.pop()
+        resources += [resource for resource in module.get("resources", []) if resource["type"] == "ansible_host"]
+        pending_modules.extend(reversed(module.get("child_modules", [])))
+    return resources
+
+
+def stream_parse(dynamic_inventory, chunks):
+    parser = dynamic_inventory.AnsibleHostStreamParser()
+    resources = []
+    for chunk in chunks:
+        resources += parser.feed(chunk)
+    parser.close()
+    return resources
+
+
+@pytest.mark.parametrize("indent", [None, 2])
+def test_stream_parser_matches_json_loads_at_every_split(dynamic_inventory, indent):
+    text = json.dumps(SHOW_DOCUMENT, indent=indent, ensure_ascii=indent is None)
+    expected = expected_show_resources(json.loads(text))
+    assert [resource["name"] for resource in expected] == ["plain", "escapes", "numbers", "outer-1", "inner-1", "second-1"]
+
+    for split in range(len(text) + 1):
+        assert stream_parse(dynamic_inventory, [text[:split], text[split:]]) == expected, f"split at {split}"
+    for chunk_size in (1, 2, 3, 7, 64):
+        assert stream_parse(dynamic_inventory, [text[start:start + chunk_size] for start in range(0, len(text), chunk_size)]) == expected
+
+
+@pytest.mark.parametrize("text", [
+    "",
+    json.dumps(SHOW_DOCUMENT)[:-1],
+    json.dumps(SHOW_DOCUMENT) + "{}",
+    json.dumps(SHOW_DOCUMENT) + "]",
+])
+def test_stream_parser_rejects_incomplete_documents(dynamic_inventory, text):
+    with pytest.raises(ValueError):
+        stream_parse(dynamic_inventory, [text[:len(text) // 2], text[len(text) // 2:]])
+
+
+@pytest.fixture
+def stub_tofu_show(cert_fixtures, tmp_path, monkeypatch):
+    """Returns a function putting a stub 'tofu' on the PATH that prints document_text for 'tofu show -json'.
+
+    script, formatted with show_path, replaces the stub. The function returns the tofu directory.
+    """
+    def write(document_text, script=None):
+        bin_dir = tmp_path / "bin"
+        bin_dir.mkdir(exist_ok=True)
+        show_path = tmp_path / "show.json"
+        show_path.write_bytes(document_text.encode("utf-8"))
+        if script is None:
+            cert_fixtures.write_stub_tofu(str(bin_dir), str(show_path))
+        else:
+            (bin_dir / "tofu").write_text(script.format(show_path=show_path))
+            (bin_dir / "tofu").chmod(0o755)
+        monkeypatch.setenv("PATH", str(bin_dir) + os.pathsep + os.environ.get("PATH", ""))
+        tofu_dir = tmp_path / "tofu"
+        tofu_dir.mkdir(exist_ok=True)
+        return str(tofu_dir)
+    return write
+
+
+@pytest.mark.parametrize("chunk_size", [1, 5, 65536])
+def test_stream_tofu_show_yields_records_like_json_loads(dynamic_inventory, stub_tofu_show, chunk_size):
+    # Not ASCII-escaped: multi-byte characters get split between chunks
+    text = json.dumps(SHOW_DOCUMENT, ensure_ascii=False)
+    tofu_dir = stub_tofu_show(text)
+    state_key = {}
+
+    records = list(dynamic_inventory.stream_tofu_show(tofu_dir, state_key, chunk_size=chunk_size))
+
+    assert records == list(dynamic_inventory.find_ansible_hosts(json.loads(text)["values"]["root_module"]))
+    assert records[1].variables["motd"] == "caf\u00e9 \u2603 \U0001f680"
+    assert state_key == {"sha256": hashlib.sha256(text.encode("utf-8")).hexdigest()}
+
+
+def test_stream_tofu_show_exits_when_tofu_fails_midway(dynamic_inventory, stub_tofu_show, capsys):
+    text = json.dumps(SHOW_DOCUMENT)
+    # tofu prints half the state, then fails (e.g. the backend connection drops)
+    tofu_dir = stub_tofu_show(text, script=f"#!/bin/sh\nhead -c {len(text) // 2} '{{show_path}}'\necho 'Error: backend went away' >&2\nexit 3\n")
+    state_key = {}
+    records = []
+
+    with pytest.raises(SystemExit) as excinfo:
+        for record in dynamic_inventory.stream_tofu_show(tofu_dir, state_key, chunk_size=64):
+            records.append(record)
+
+    assert excinfo.value.code == 1
+    assert "exit status 3" in capsys.readouterr().err
+    assert state_key == {}
+    # Hosts before the failure were streamed, but the run never completes with them
+    assert [record.host_name for record in records] == ["plain", "escapes"]
+
+
+def test_inventory_not_cached_when_tofu_fails_midway(stub_tofu_show, tmp_path):
+    text = json.dumps(SHOW_DOCUMENT)
+    stub_tofu_show(text, script=f"#!/bin/sh\nhead -c {len(text) // 2} '{{show_path}}'\nexit 3\n")
+
+    with pytest.raises(subprocess.CalledProcessError) as excinfo:
+        run_inventory(tmp_path, "--list", TOFU_INVENTORY_STATE_SOURCE="tofu")
+
+    assert excinfo.value.returncode == 1
+    assert "exit status 3" in excinfo.value.stderr
+    assert not (tmp_path / "cache").exists() or not os.listdir(tmp_path / "cache")
+
+
+def source_inventory(dynamic_inventory, *records):
+    return dynamic_inventory.build_inventory_from_records(
+        [dynamic_inventory.HostRecord("", host_name, groups, variables) for host_name, groups, variables in records])
+
+
+def test_merge_shares_identical_hosts(dynamic_inventory, capsys):
+    eu, us = dynamic_inventory.parse_sources(["eu=tofu/eu", "us=tofu/us"])
+    bastion_vars = {"ansible_host": "192.0.2.10"}
+    merged = dynamic_inventory.merge_inventories([
+        (eu, source_inventory(dynamic_inventory, ("web-1", ["web"], {}), ("bastion", ["edge"], bastion_vars))),
+        (us, source_inventory(dynamic_inventory, ("bastion", ["jump"], bastion_vars), ("web-2", ["web"], {}))),
+    ])
+
+    # Hosts in source order; a shared host joins the groups of every source it is in
+    assert list(merged["_meta"]["hostvars"]) == ["web-1", "bastion", "web-2"]
+    assert [group for group, body in merged.items() if "bastion" in body.get("hosts", [])] == ["eu", "edge", "jump", "us"]
+    assert merged["web"]["hosts"] == ["web-1", "web-2"]
+    assert merged["eu"]["hosts"] == ["web-1", "bastion"]
+    assert merged["us"]["hosts"] == ["bastion", "web-2"]
+    assert capsys.readouterr().err == ""
+
+
+def test_merge_namespaces_conflicting_hosts(dynamic_inventory, capsys):
+    eu, us = dynamic_inventory.parse_sources(["eu=tofu/eu", "us=tofu/us"])
+    merged = dynamic_inventory.merge_inventories([
+        (eu, source_inventory(dynamic_inventory, ("web-1", ["web"], {"ansible_host": "10.0.0.1"}), ("db-1", ["db"], {}))),
+        (us, source_inventory(dynamic_inventory, ("web-1", ["web"], {"ansible_host": "10.1.0.1"}), ("db-1", ["db"], {"role": "replica"}))),
+    ])
+
+    assert merged["web"]["hosts"] == ["eu.web-1", "us.web-1"]
+    assert merged["_meta"]["hostvars"]["eu.web-1"]["ansible_host"] == "10.0.0.1"
+    assert merged["_meta"]["hostvars"]["us.web-1"]["ansible_host"] == "10.1.0.1"
+    assert merged["us"]["hosts"] == ["us.web-1", "us.db-1"]
+    assert "web-1" not in merged["_meta"]["hostvars"]
+    assert "Namespacing hosts defined differently in several OpenTofu sources: db-1, web-1" in capsys.readouterr().err
+
+
+def test_merge_conflict_policy_error_exits(dynamic_inventory, capsys):
+    eu, us = dynamic_inventory.parse_sources(["eu=tofu/eu", "us=tofu/us"])
+
+    with pytest.raises(SystemExit) as excinfo:
+        dynamic_inventory.merge_inventories([
+            (eu, source_inventory(dynamic_inventory, ("web-1", ["web"], {"ansible_host": "10.0.0.1"}))),
+            (us, source_inventory(dynamic_inventory, ("web-1", ["web"], {"ansible_host": "10.1.0.1"}))),
+        ], conflict_policy="error")
+
+    assert excinfo.value.code == 1
+    assert "Hosts defined differently in several OpenTofu sources: web-1" in capsys.readouterr().err
+
+
+def test_fetch_returns_inventories_in_source_order(dynamic_inventory, tmp_path, monkeypatch):
+    monkeypatch.delenv("TOFU_INVENTORY_STATE_FILE", raising=False)
+    monkeypatch.setenv("TOFU_INVENTORY_CACHE_DIR", str(tmp_path / "cache"))
+    for name in ("a", "b", "c"):
+        write_local_state(tmp_path / name, host_names=(f"{name}-1",))
+    sources = dynamic_inventory.parse_sources([str(tmp_path / name) for name in ("a", "b", "c")])
+
+    fetched = dynamic_inventory.fetch_inventories(sources)
+
+    assert [(source.label, list(inventory["_meta"]["hostvars"])) for source, inventory in fetched] == [
+        ("a", ["a-1"]), ("b", ["b-1"]), ("c", ["c-1"])]
+
+
+def test_failing_source_fails_inventory_after_others_are_cached(tmp_path):
+    write_local_state(tmp_path / "eu", host_names=("web-1",))
+    write_local_state(tmp_path / "us", host_names=("web-2",))
+    # No state file and no 'tofu' to read one with
+    (tmp_path / "broken").mkdir()
+    sources = [f"eu={tmp_path / 'eu'}", f"broken={tmp_path / 'broken'}", f"us={tmp_path / 'us'}"]
+
+    with pytest.raises(subprocess.CalledProcessError) as excinfo:
+        run_inventory(tmp_path, "--list", *(f"--source={source}" for source in sources), PATH=str(tmp_path / "no-bin"))
+
+    assert excinfo.value.returncode == 1
+    assert f"Could not read OpenTofu sources: broken ({tmp_path / 'broken'}@default)" in excinfo.value.stderr
+    # The sources that could be read are cached: without the broken one the next run reads no state
+    (tmp_path / "eu" / "terraform.tfstate").rename(tmp_path / "eu.tfstate")
+    (tmp_path / "us" / "terraform.tfstate").rename(tmp_path / "us.tfstate")
+    inventory = run_inventory(tmp_path, "--list", f"--source={sources[0]}", f"--source={sources[2]}", PATH=str(tmp_path / "no-bin"))
+    assert list(inventory["_meta"]["hostvars"]) == ["web-1", "web-2"]
+
+
+def test_hoisting_keeps_all_and_shared_groups_untouched(dynamic_inventory):
+    common = {"ansible_user": "ansible", "vault_ssh_ca_principal": "ansible"}
+    inventory = source_inventory(dynamic_inventory, ("web-1", ["web"], common), ("web-2", ["web"], common), ("db-1", ["db"], common))
+    original = copy.deepcopy(inventory)
+
+    hoisted = dynamic_inventory.hoist_group_vars(inventory)
+
+    assert inventory == original
+    assert hoisted[dynamic_inventory.HOIST_GROUP] == {
+        "hosts": ["web-1", "web-2", "db-1"],
+        "vars": dict(common, ansible_group_priority=dynamic_inventory.HOIST_GROUP_PRIORITY),
+    }
+    assert hoisted["all"] == dict(original["all"], children=[*original["all"]["children"], dynamic_inventory.HOIST_GROUP])
+    assert hoisted["web"] == original["web"] and hoisted["db"] == original["db"]
+    assert hoisted["_meta"]["hostvars"]["web-1"] == {"ansible_host": "web-1"}
+
+    # A state declaring a group of the same name keeps its group and gets no hoisting
+    inventory[dynamic_inventory.HOIST_GROUP] = {"hosts": ["db-1"]}
+    assert dynamic_inventory.hoist_group_vars(inventory) is inventory
+
+
+def write_ansible_hosts_state(tofu_dir, hosts, serial=1):
+    write_json(tofu_dir / "terraform.tfstate", {
+        "version": 4,
+        "serial": serial,
+        "lineage": "1b0c5d3e",
+        "resources": [{
+            "mode": "managed",
+            "type": "ansible_host",
+            "name": "vm",
+            "instances": [
+                {"index_key": index, "attributes": {"name": host_name, "groups": groups, "variables": variables}}
+                for index, (host_name, groups, variables) in enumerate(hosts)
+            ],
+        }],
+    })
+
+
+def ansible_inventory_host(tmp_path, host_name, compact):
+    """Runs 'ansible-inventory --host' over the script and a static inventory, as a run with two sources does."""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "inventories", "dynamic_inventory.py")
+    environment = dict(os.environ, TOFU_INVENTORY_DIR=str(tmp_path / "tofu"), TOFU_INVENTORY_CACHE_TTL="0",
+                       TOFU_INVENTORY_STATE_SOURCE="auto", TOFU_INVENTORY_COMPACT="true" if compact else "false",
+                       ANSIBLE_INVENTORY_ENABLED="script,yaml", ANSIBLE_HOST_PATTERN_MISMATCH="ignore")
+    for name in ("TOFU_INVENTORY_STATE_FILE", "TOFU_INVENTORY_SOURCES", "TOFU_INVENTORY_LIMIT", "TOFU_INVENTORY_SHARD"):
+        environment.pop(name, None)
+    # Run outside the repository so its ansible.cfg (and the tofu_state plugin) stay out of the way
+    result = subprocess.run(["ansible-inventory", "-i", script, "-i", str(tmp_path / "static.yml"), "--host", host_name],
+                            env=environment, cwd=tmp_path, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout)
+
+
+def test_hoisting_keeps_ansible_inventory_host_output(tmp_path):
+    if not shutil.which("ansible-inventory"):
+        pytest.skip("ansible-inventory is not installed")
+    shared = {"vault_ssh_ca_principal": "ansible", "vault_ssh_ca_signing_role": "ssh/roles/deploy"}
+    write_ansible_hosts_state(tmp_path / "tofu", [
+        ("web-1", ["web"], dict(shared, ansible_host="10.0.0.1")),
+        ("web-2", ["web"], dict(shared, ansible_host="10.0.0.2", ansible_port=2222)),
+        ("db-1", ["db"], dict(shared, ansible_host="10.0.1.1")),
+    ])
+    # A second source sharing the 'web' group, with group variables of the same names
+    (tmp_path / "static.yml").write_text(json.dumps({
+        "all": {"vars": {"ntp_server": "pool.ntp.org"}, "children": {"web": {
+            "vars": {"vault_ssh_ca_principal": "static", "ansible_port": 2200},
+            "hosts": {"legacy-web": {"ansible_host": "192.0.2.10"}},
+        }}},
+    }))
+
+    for host_name in ("web-1", "web-2", "db-1", "legacy-web"):
+        assert ansible_inventory_host(tmp_path, host_name, compact=True) == ansible_inventory_host(tmp_path, host_name, compact=False)
+    assert ansible_inventory_host(tmp_path, "legacy-web", compact=True) == {
+        "ansible_host": "192.0.2.10", "ansible_port": 2200, "ntp_server": "pool.ntp.org", "vault_ssh_ca_principal": "static",
+    }
+
+
+STUB_SSH = """#!{python}
+import os, sys
+args = sys.argv[1:]
+with open({log!r}, "a") as log:
+    log.write(" ".join(args) + "\\n")
+control_path = next(arg.split("=", 1)[1] for arg in args if arg.startswith("ControlPath="))
+if "-O" in args:
+    sys.exit(0 if os.path.exists(control_path) else 255)
+target = args[-2]
+if target.startswith("denied@"):
+    print(target + ": Permission denied (publickey).", file=sys.stderr)
+    sys.exit(255)
+open(control_path, "w").close()
+"""
+
+
+@pytest.fixture
+def stub_ssh(tmp_path, monkeypatch):
+    """Puts an 'ssh' on PATH whose masters are files at their ControlPath; 'denied@' targets fail. Returns its call log."""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir(exist_ok=True)
+    calls_log_path = tmp_path / "ssh-calls.log"
+    (bin_dir / "ssh").write_text(STUB_SSH.format(python=sys.executable, log=str(calls_log_path)))
+    (bin_dir / "ssh").chmod(0o755)
+    monkeypatch.setenv("PATH", str(bin_dir) + os.pathsep + os.environ.get("PATH", ""))
+    monkeypatch.setenv("TOFU_INVENTORY_JUMPHOST_CONTROL_DIR", str(tmp_path / "cp"))
+    monkeypatch.delenv("TOFU_INVENTORY_JUMPHOST_PERSIST", raising=False)
+    return calls_log_path
+
+
+def ssh_masters_started(calls_log_path):
+    return [line.split()[-2] for line in calls_log_path.read_text().splitlines() if "-O" not in line.split()]
+
+
+def jumphost_hosts(*jumphosts):
+    return [(f"app-{index}", ["app"], {"ansible_ssh_jumphost": jumphost}) for index, jumphost in enumerate(jumphosts)]
+
+
+def test_warmup_jumphosts_opens_one_master_per_jumphost(dynamic_inventory, stub_ssh, tmp_path):
+    inventory = source_inventory(dynamic_inventory, *jumphost_hosts("bastion-eu", "bastion-us", "bastion-eu", "bastion-eu"),
+                                 ("db-1", ["db"], {}))
+
+    assert dynamic_inventory.warmup_jumphosts(inventory) == {"ansible@bastion-eu": None, "ansible@bastion-us": None}
+    assert sorted(ssh_masters_started(stub_ssh)) == ["ansible@bastion-eu", "ansible@bastion-us"]
+    # The masters sit where the hosts' ProxyCommand looks for them
+    for target in ("ansible@bastion-eu", "ansible@bastion-us"):
+        assert os.path.exists(dynamic_inventory.jumphost_control_path(str(tmp_path / "cp"), target))
+
+
+def test_warmup_jumphosts_reports_failed_master(dynamic_inventory, stub_ssh):
+    inventory = source_inventory(dynamic_inventory, *jumphost_hosts("bastion-eu"),
+                                 ("app-denied", ["app"], {"ansible_user": "denied", "ansible_ssh_jumphost": "bastion-us"}))
+
+    results = dynamic_inventory.warmup_jumphosts(inventory)
+    assert results["ansible@bastion-eu"] is None
+    assert results["denied@bastion-us"] == "denied@bastion-us: Permission denied (publickey)."
+
+
+def test_warmup_jumphosts_disabled_without_multiplexing(dynamic_inventory, stub_ssh, monkeypatch, capsys):
+    monkeypatch.setenv("TOFU_INVENTORY_JUMPHOST_PERSIST", "no")
+    inventory = source_inventory(dynamic_inventory, *jumphost_hosts("bastion-eu"))
+
+    assert dynamic_inventory.warmup_jumphosts(inventory) == {}
+    assert not stub_ssh.exists()
+    assert "nothing to warm up" in capsys.readouterr().err
+
+
+def test_warmup_jumphosts_package_script(stub_ssh, tmp_path):
+    write_ansible_hosts_state(tmp_path / "tofu", [
+        ("app-1", ["app"], {"ansible_host": "10.0.0.1", "ansible_ssh_jumphost": "bastion-eu"}),
+        ("app-2", ["app"], {"ansible_host": "10.0.0.2", "ansible_ssh_jumphost": "bastion-eu"}),
+    ])
+    ansible_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+    with open(os.path.join(ansible_dir, "package.json")) as f:
+        command = json.load(f)["scripts"]["warmup-jumphosts"]
+    environment = dict(os.environ, TOFU_INVENTORY_DIR=str(tmp_path / "tofu"), TOFU_INVENTORY_CACHE_DIR=str(tmp_path / "cache"),
+                       TOFU_INVENTORY_STATE_SOURCE="auto")
+    for name in ("TOFU_INVENTORY_STATE_FILE", "TOFU_INVENTORY_SOURCES", "TOFU_INVENTORY_LIMIT", "TOFU_INVENTORY_SHARD"):
+        environment.pop(name, None)
+
+    def warmup():
+        return subprocess.run(["sh", "-c", command], cwd=ansible_dir, env=environment, capture_output=True, text=True)
+
+    result = warmup()
+    assert result.returncode == 0, result.stderr
+    assert json.loads(result.stdout) == {"ansible@bastion-eu": "ok"}
+
+    write_ansible_hosts_state(tmp_path / "tofu", [
+        ("app-1", ["app"], {"ansible_host": "10.0.0.1", "ansible_ssh_jumphost": "bastion-eu"}),
+        ("app-3", ["app"], {"ansible_host": "10.0.0.3", "ansible_user": "denied", "ansible_ssh_jumphost": "bastion-us"}),
+    ], serial=2)
+    result = warmup()
+    assert result.returncode == 1
+    assert json.loads(result.stdout)["denied@bastion-us"] == "denied@bastion-us: Permission denied (publickey)."
+    assert "Could not open the ssh master of 1 jumphost(s): denied@bastion-us" in result.stderr
@@ -0,0 +1,142 @@
+"""Tests for plugins/inventory/tofu_state.py, cached through a local stand-in for a redis-like cache plugin."""
+
+import hashlib
+import json
+import os
+import sys
+
+import pytest
+
+ANSIBLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+HOSTS = {
+    "web-eu-01": ["web"],
+    "web-eu-02": ["web"],
+    "web-us-01": ["web"],
+    "db-eu-01": ["db"],
+    "db-us-01": ["db"],
+    "bastion": [],
+}
+
+
+@pytest.fixture(scope="module")
+def loaders():
+    pytest.importorskip("ansible")
+    from ansible.plugins.loader import cache_loader, inventory_loader
+    inventory_loader.add_directory(os.path.join(ANSIBLE_DIR, "plugins", "inventory"))
+    cache_loader.add_directory(os.path.join(ANSIBLE_DIR, "tests", "plugins", "cache"))
+    return inventory_loader, cache_loader
+
+
+@pytest.fixture
+def kv_server(loaders):
+    """The stand-in cache server's keyspace, emptied for each test."""
+    _, cache_loader = loaders
+    servers = sys.modules[cache_loader.get("kv_store").__class__.__module__].SERVERS
+    servers.clear()
+    return servers.setdefault("test-server", {})
+
+
+@pytest.fixture
+def tofu_dir(tmp_path, monkeypatch):
+    monkeypatch.delenv("TOFU_INVENTORY_STATE_FILE", raising=False)
+    monkeypatch.delenv("TOFU_INVENTORY_LIMIT", raising=False)
+    monkeypatch.delenv("TOFU_INVENTORY_SHARD", raising=False)
+    # No 'tofu' to fall back to: the state can only be read natively
+    monkeypatch.setenv("PATH", str(tmp_path / "no-bin"))
+    tofu_dir = tmp_path / "tofu"
+    tofu_dir.mkdir()
+    (tofu_dir / "terraform.tfstate").write_text(json.dumps({
+        "version": 4,
+        "serial": 1,
+        "lineage": "5e1f",
+        "resources": [{
+            "mode": "managed",
+            "type": "ansible_host",
+            "name": "vm",
+            "instances": [
+                {"index_key": index, "attributes": {"name": host_name, "groups": groups, "variables": {"ansible_host": f"10.0.0.{index + 1}"}}}
+                for index, (host_name, groups) in enumerate(HOSTS.items())
+            ],
+        }],
+    }))
+    return tofu_dir
+
+
+def cache_keys(kv_server):
+    """Keys in the stand-in server, without the prefix ansible adds for inventory caches."""
+    return [key[key.index("tofu_state_"):] for key in kv_server]
+
+
+def parse(loaders, tmp_path, tofu_dir, cache=True, **options):
+    """Runs the plugin on a tofu_state.yml with options, as InventoryManager does; returns (inventory, plugin, source path)."""
+    from ansible.inventory.data import InventoryData
+    from ansible.parsing.dataloader import DataLoader
+    import yaml
+
+    inventory_loader, _ = loaders
+    source_path = tmp_path / "tofu_state.yml"
+    source_path.write_text(yaml.safe_dump(dict({
+        "plugin": "tofu_state",
+        "tofu_dir": str(tofu_dir),
+        "cache": True,
+        "cache_plugin": "kv_store",
+        "cache_connection": "test-server",
+    }, **options)))
+    plugin = inventory_loader.get("tofu_state")
+    inventory = InventoryData()
+    plugin.parse(inventory, DataLoader(), str(source_path), cache=cache)
+    plugin.update_cache_if_changed()
+    return inventory, plugin, str(source_path)
+
+
+def test_inventory_is_served_from_cache(loaders, kv_server, tmp_path, tofu_dir):
+    inventory, plugin, source_path = parse(loaders, tmp_path, tofu_dir)
+    assert set(inventory.hosts) == set(HOSTS)
+    assert cache_keys(kv_server) == [plugin.get_cache_key(source_path)]
+
+    # Without a state the inventory can only come from the cache
+    (tofu_dir / "terraform.tfstate").unlink()
+    cached_inventory, _, _ = parse(loaders, tmp_path, tofu_dir)
+    assert set(cached_inventory.hosts) == set(HOSTS)
+    assert cached_inventory.get_host("web-eu-02").vars["ansible_host"] == "10.0.0.2"
+
+
+def test_limit_gets_its_own_cache_key(loaders, kv_server, tmp_path, tofu_dir):
+    limited, plugin, source_path = parse(loaders, tmp_path, tofu_dir, limit="web-eu-*")
+    unlimited, _, _ = parse(loaders, tmp_path, tofu_dir)
+
+    assert set(limited.hosts) == {"web-eu-01", "web-eu-02"}
+    assert set(unlimited.hosts) == set(HOSTS)
+    cache_key = plugin.get_cache_key(source_path)
+    assert sorted(cache_keys(kv_server)) == sorted([cache_key, f"{cache_key}_{hashlib.sha1(b'web-eu-*').hexdigest()[:10]}"])
+
+
+def test_shard_is_applied_after_the_cache(loaders, kv_server, tmp_path, tofu_dir):
+    first, _, _ = parse(loaders, tmp_path, tofu_dir, shard="1/2")
+    second, _, _ = parse(loaders, tmp_path, tofu_dir, shard="2/2")
+
+    assert set(first.hosts).isdisjoint(second.hosts)
+    assert set(first.hosts) | set(second.hosts) == set(HOSTS)
+    # Both shards share one cached, unsharded inventory
+    assert len(kv_server) == 1
+    (tofu_dir / "terraform.tfstate").unlink()
+    cached_inventory, _, _ = parse(loaders, tmp_path, tofu_dir)
+    assert set(cached_inventory.hosts) == set(HOSTS)
+
+
+def test_script_exit_becomes_parser_error(loaders, kv_server, tmp_path, tofu_dir):
+    from ansible.errors import AnsibleParserError
+
+    # No state file and no 'tofu': the script's reader prints an error and exits
+    (tofu_dir / "terraform.tfstate").unlink()
+    with pytest.raises(AnsibleParserError, match="Failed to read the OpenTofu state"):
+        parse(loaders, tmp_path, tofu_dir)
+    assert kv_server == {}
+
+
+def test_invalid_shard_is_a_parser_error(loaders, kv_server, tmp_path, tofu_dir):
+    from ansible.errors import AnsibleParserError
+
+    with pytest.raises(AnsibleParserError, match="invalid shard"):
+        parse(loaders, tmp_path, tofu_dir, shard="3/2")
@@ -0,0 +1,909 @@
+"""Tests for plugins/connection/vault_ssh_signer.py, against local stand-ins for Vault."""
+
+import base64
+import hashlib
+import http.server
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+import pytest
+
+SIGNED_KEY = "ssh-ed25519-cert-v01@openssh.com AAAAsigned stub"
+
+
+class StubVaultHandler(http.server.BaseHTTPRequestHandler):
+    """Answers the SSH sign endpoint (200 for the 'deploy' role, 403 for any other role) and AppRole logins.
+
+    Logins issue 's.approle-<n>' tokens for server.token_ttl seconds, renewed for server.renew_ttl (if set).
+    Tokens in server.revoked are refused with 403.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.open_sockets.append(self.connection)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        token = self.headers.get("X-Vault-Token")
+        self.server.requests.append({
+            "path": self.path,
+            "token": token,
+            "body": body,
+            "client_port": self.client_address[1],
+        })
+        if self.path == "/v1/auth/approle/login":
+            issued = f"s.approle-{len(self.requests_to(self.path))}"
+            self._reply(200, {"auth": {"client_token": issued, "accessor": "a." + issued,
+                                       "lease_duration": self.server.token_ttl, "renewable": True}})
+        elif self.path == "/v1/auth/token/renew-self" and token not in self.server.revoked:
+            self._reply(200, {"auth": {"client_token": token, "accessor": "a." + token,
+                                       "lease_duration": self.server.renew_ttl or self.server.token_ttl, "renewable": True}})
+        elif self.path == "/v1/ssh-client-signer/sign/deploy" and token not in self.server.revoked:
+            self._reply(200, {"data": {"signed_key": SIGNED_KEY + "\n"}})
+        else:
+            self._reply(403, {"errors": ["1 error occurred:\n\t* permission denied\n\n"]})
+
+    def requests_to(self, path):
+        return [request for request in self.server.requests if request["path"] == path]
+
+    def _reply(self, status, document):
+        payload = json.dumps(document).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stub_vault():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubVaultHandler)
+    server.daemon_threads = True
+    server.requests = []
+    server.open_sockets = []
+    server.token_ttl = 3600
+    server.renew_ttl = None
+    server.revoked = set()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def vault_client(vault_ssh_signer, stub_vault):
+    return vault_ssh_signer.VaultHTTPClient(f"http://127.0.0.1:{stub_vault.server_address[1]}", "s.test-token", timeout=5)
+
+
+def test_http_client_signs_over_one_pooled_connection(vault_client, stub_vault):
+    first = vault_client.sign_ssh_key("ssh-client-signer/sign/deploy", "ssh-ed25519 AAAA", "admin")
+    second = vault_client.sign_ssh_key("ssh-client-signer/sign/deploy", "ssh-ed25519 AAAA", "admin,ops")
+
+    assert first == second == SIGNED_KEY
+    assert [request["token"] for request in stub_vault.requests] == ["s.test-token"] * 2
+    assert stub_vault.requests[1]["body"] == {"public_key": "ssh-ed25519 AAAA", "valid_principals": "admin,ops"}
+    # The second request reused the keep-alive connection of the first
+    assert stub_vault.requests[0]["client_port"] == stub_vault.requests[1]["client_port"]
+
+
+def test_http_client_maps_error_status(vault_ssh_signer, vault_client, stub_vault):
+    with pytest.raises(vault_ssh_signer.VaultRequestError) as excinfo:
+        vault_client.sign_ssh_key("ssh-client-signer/sign/other", "ssh-ed25519 AAAA", "admin")
+
+    assert excinfo.value.status == 403
+    assert excinfo.value.errors == ["1 error occurred:\n\t* permission denied\n\n"]
+    # An error response leaves the connection usable
+    assert vault_client.sign_ssh_key("ssh-client-signer/sign/deploy", "ssh-ed25519 AAAA", "admin") == SIGNED_KEY
+
+
+def test_http_client_reconnects_after_server_drops_idle_connection(vault_client, stub_vault):
+    assert vault_client.sign_ssh_key("ssh-client-signer/sign/deploy", "ssh-ed25519 AAAA", "admin") == SIGNED_KEY
+    # The server closes the idle keep-alive connection, as Vault does after its idle timeout
+    for open_socket in stub_vault.open_sockets:
+        open_socket.shutdown(socket.SHUT_RDWR)
+
+    assert vault_client.sign_ssh_key("ssh-client-signer/sign/deploy", "ssh-ed25519 AAAA", "admin") == SIGNED_KEY
+    assert len(stub_vault.requests) == 2
+    assert stub_vault.requests[0]["client_port"] != stub_vault.requests[1]["client_port"]
+
+
+@pytest.fixture
+def approle(vault_ssh_signer, stub_vault, tmp_path, monkeypatch):
+    """Returns a function making AppRoleTokenCaches that log in to the stub Vault, sharing tmp_path/tokens.json."""
+    addr = f"http://127.0.0.1:{stub_vault.server_address[1]}"
+    monkeypatch.setenv("VAULT_ADDR", addr)
+    for name in ("VAULT_NAMESPACE", "VAULT_CACERT", "VAULT_CAPATH", "VAULT_SKIP_VERIFY"):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setattr(vault_ssh_signer.AppRoleTokenCache, "_tokens", {})
+
+    def make(role_id="role-id"):
+        return vault_ssh_signer.AppRoleTokenCache(addr, role_id, "secret-id", cache_path=str(tmp_path / "tokens.json"))
+
+    return make
+
+
+def vault_paths(stub_vault):
+    return [request["path"].rsplit("/", 1)[-1] for request in stub_vault.requests]
+
+
+def test_approle_token_reused_from_memory_and_shared_file(vault_ssh_signer, approle, stub_vault):
+    token = approle().token()
+    assert token == "s.approle-1"
+    assert approle().token() == token
+    # Another fork or a later run: nothing in memory, the token comes from the shared file
+    vault_ssh_signer.AppRoleTokenCache._tokens.clear()
+    assert approle().token() == token
+    assert vault_paths(stub_vault) == ["login"]
+    assert stub_vault.requests[0]["body"] == {"role_id": "role-id", "secret_id": "secret-id"}
+
+    # Tokens are kept per RoleID
+    assert approle("other-role-id").token() == "s.approle-2"
+    assert approle().token() == token
+
+
+def age_cached_token(vault_ssh_signer, tokens, remaining_seconds):
+    entry = dict(vault_ssh_signer.AppRoleTokenCache._tokens[tokens.key], expires_at=time.time() + remaining_seconds)
+    vault_ssh_signer.AppRoleTokenCache._tokens[tokens.key] = entry
+    tokens._write_cache_file(entry)
+
+
+def test_approle_token_renewed_near_ttl(vault_ssh_signer, approle, stub_vault):
+    tokens = approle()
+    token = tokens.token()
+    # Past half of its 3600 s TTL the token is renewed rather than used as is
+    age_cached_token(vault_ssh_signer, tokens, 1900)
+    assert tokens.token() == token
+    assert vault_paths(stub_vault) == ["login"]
+
+    age_cached_token(vault_ssh_signer, tokens, 1700)
+    assert tokens.token() == token
+    assert vault_paths(stub_vault) == ["login", "renew-self"]
+    assert stub_vault.requests[1]["token"] == token
+    assert tokens._read_cache_file()["expires_at"] > time.time() + 3500
+    assert tokens.token() == token
+    assert vault_paths(stub_vault) == ["login", "renew-self"]
+
+
+def test_approle_logs_in_again_when_renewal_falls_short(vault_ssh_signer, approle, stub_vault):
+    tokens = approle()
+    tokens.token()
+    # At its max TTL Vault renews the token for less than asked; a new login gets a full TTL
+    stub_vault.renew_ttl = 600
+    age_cached_token(vault_ssh_signer, tokens, 600)
+    assert tokens.token() == "s.approle-2"
+    assert vault_paths(stub_vault) == ["login", "renew-self", "login"]
+
+
+def test_approle_logs_in_again_when_token_cannot_be_renewed(vault_ssh_signer, approle, stub_vault):
+    tokens = approle()
+    tokens.token()
+    stub_vault.revoked.add("s.approle-1")
+    age_cached_token(vault_ssh_signer, tokens, 600)
+    assert tokens.token() == "s.approle-2"
+    assert vault_paths(stub_vault) == ["login", "renew-self", "login"]
+
+
+def test_approle_login_without_vault_addr_raises_ansible_error(approle, stub_vault, monkeypatch):
+    from ansible.errors import AnsibleError
+    tokens = approle()
+    monkeypatch.delenv("VAULT_ADDR")
+    with pytest.raises(AnsibleError, match="VAULT_ADDR must be set"):
+        tokens.token()
+    assert stub_vault.requests == []
+
+
+def test_signing_logs_in_again_after_403(make_connection, cert_fixtures, approle, stub_vault, tmp_path):
+    options = {
+        "public_key_path": cert_fixtures.write_key_pair(str(tmp_path)),
+        "vault_ssh_ca_signing_role": "ssh-client-signer/roles/deploy",
+        "vault_client": "http",
+        "approle_role_id": "role-id",
+        "approle_secret_id": "secret-id",
+        "token_cache_file": str(tmp_path / "tokens.json"),
+    }
+    connection = make_connection(**options)
+    sys.modules[type(connection).__module__].AppRoleTokenCache._tokens.clear()
+    assert connection._request_signed_key() == SIGNED_KEY
+
+    # Vault revoked the cached token before it expired: the next signing is refused once, then logs in again
+    stub_vault.revoked.add("s.approle-1")
+    assert make_connection(**options)._request_signed_key() == SIGNED_KEY
+    assert [(path, request["token"]) for path, request in zip(vault_paths(stub_vault), stub_vault.requests)] == [
+        ("login", None), ("deploy", "s.approle-1"), ("deploy", "s.approle-1"), ("login", None), ("deploy", "s.approle-2"),
+    ]
+    assert approle()._read_cache_file()["token"] == "s.approle-2"
+
+
+def _connect_in_fork(make_connection, options, start_event):
+    # The plugin reports renewals on stdout
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    start_event.wait()
+    make_connection(**options)._connect()
+
+
+def _hold_lock_and_die(lock_path, acquired_event):
+    from fcntl import flock, LOCK_EX
+    fd = os.open(lock_path, os.O_CREAT | os.O_RDWR, 0o600)
+    flock(fd, LOCK_EX)
+    os.write(fd, f"{os.getpid()}\n".encode())
+    acquired_event.set()
+    # Exits without releasing the lock, like a worker killed mid-renewal
+    os._exit(1)
+
+
+def dead_pid():
+    process = multiprocessing.get_context("fork").Process(target=os._exit, args=(0,))
+    process.start()
+    process.join()
+    return process.pid
+
+
+@pytest.fixture
+def expired_certificate(cert_fixtures, tmp_path, monkeypatch):
+    """Returns (options, calls_log_path) for a connection whose certificate expired, signing through the stub 'vault'."""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    calls_log_path = tmp_path / "vault-calls.log"
+    cert_fixtures.write_stub_vault(str(bin_dir), str(calls_log_path), delay_seconds=0.3)
+    public_key_path = cert_fixtures.write_key_pair(str(tmp_path))
+    cert_path = cert_fixtures.write_certificate(str(tmp_path / "id_ed25519-cert.pub"), public_key_path, ["ansible"], -3600)
+    monkeypatch.setenv("PATH", str(bin_dir) + os.pathsep + os.environ.get("PATH", ""))
+    monkeypatch.setenv("VAULT_ADDR", "http://127.0.0.1:8200")
+    options = {
+        "public_key_path": public_key_path,
+        "signed_key_path": cert_path,
+        "vault_client": "cli",
+        "control_path_dir": str(tmp_path / "cp"),
+        "renewal_lock_timeout_seconds": 20,
+    }
+    return options, calls_log_path
+
+
+def renew_in_forks(make_connection, options, forks):
+    """Releases forks workers at once to race for the renewal; returns their exit codes and the seconds taken."""
+    context = multiprocessing.get_context("fork")
+    start_event = context.Event()
+    processes = [context.Process(target=_connect_in_fork, args=(make_connection, options, start_event)) for _ in range(forks)]
+    for process in processes:
+        process.start()
+    started = time.monotonic()
+    start_event.set()
+    for process in processes:
+        process.join(60)
+    return [process.exitcode for process in processes], time.monotonic() - started
+
+
+def vault_calls(calls_log_path):
+    return len(calls_log_path.read_text().splitlines()) if calls_log_path.exists() else 0
+
+
+def test_concurrent_forks_renew_once(make_connection, expired_certificate):
+    options, calls_log_path = expired_certificate
+
+    exit_codes, _ = renew_in_forks(make_connection, options, forks=8)
+
+    assert exit_codes == [0] * 8
+    assert vault_calls(calls_log_path) == 1
+    assert make_connection(**options)._is_cert_fresh()[0]
+
+
+def test_forks_renew_once_after_lock_holder_died(make_connection, expired_certificate):
+    options, calls_log_path = expired_certificate
+    context = multiprocessing.get_context("fork")
+    acquired_event = context.Event()
+    holder = context.Process(target=_hold_lock_and_die, args=(options["signed_key_path"] + ".lock", acquired_event))
+    holder.start()
+    assert acquired_event.wait(10)
+    holder.join()
+
+    exit_codes, seconds = renew_in_forks(make_connection, options, forks=4)
+
+    assert exit_codes == [0] * 4
+    assert vault_calls(calls_log_path) == 1
+    # Nobody waited for the lock timeout: the dead holder's lock was released with its process
+    assert seconds < options["renewal_lock_timeout_seconds"] / 2
+
+
+def test_lock_waiter_wakes_when_holder_releases(vault_ssh_signer, tmp_path):
+    lock_path = str(tmp_path / "id_ed25519-cert.pub.lock")
+    holder = vault_ssh_signer.CertificateLock(lock_path)
+    assert holder.acquire(1)
+    waiter = vault_ssh_signer.CertificateLock(lock_path)
+    acquired_at = []
+    thread = threading.Thread(target=lambda: acquired_at.append((waiter.acquire(10), time.monotonic())))
+    thread.start()
+
+    time.sleep(0.5)
+    assert not acquired_at
+    released_at = time.monotonic()
+    assert holder.release()
+    thread.join(10)
+
+    acquired, acquired_time = acquired_at[0]
+    assert acquired
+    # Well under the 100 ms a polling waiter would sleep by now
+    assert acquired_time - released_at < 0.03
+    assert waiter.holder_pid() == os.getpid()
+    assert waiter.release()
+
+
+def test_lock_acquire_times_out_and_drops_the_late_lock(vault_ssh_signer, tmp_path):
+    lock_path = str(tmp_path / "id_ed25519-cert.pub.lock")
+    holder = vault_ssh_signer.CertificateLock(lock_path)
+    assert holder.acquire(1)
+    waiter = vault_ssh_signer.CertificateLock(lock_path)
+
+    started = time.monotonic()
+    assert not waiter.acquire(0.2)
+    assert 0.2 <= time.monotonic() - started < 1
+    assert not waiter.release()
+
+    # The abandoned waiter gives the lock up as soon as it gets it
+    assert holder.release()
+    assert vault_ssh_signer.CertificateLock(lock_path).acquire(1)
+
+
+@pytest.fixture
+def control_dir():
+    """A short directory for ControlMaster sockets: UNIX socket paths are limited to about 100 bytes."""
+    directory = tempfile.mkdtemp(prefix="cp-")
+    yield directory
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def control_master_options(control_dir, layout):
+    """Returns (connection options, ControlPath ssh will use) for ControlPersist with the given ControlPath layout."""
+    persist = "-o ControlMaster=auto -o ControlPersist=60s"
+    if layout == "ssh_args":
+        return {"ssh_args": f"{persist} -o ControlPath={control_dir}/%h:%p"}, f"{control_dir}/10.0.0.1:22"
+    if layout == "control_path":
+        return {"ssh_args": persist, "control_path_dir": control_dir, "control_path": "%(directory)s/cm-%%h"}, f"{control_dir}/cm-10.0.0.1"
+    # Ansible's default: a digest of host, port and user in control_path_dir
+    return {"ssh_args": persist, "control_path_dir": control_dir}, f"{control_dir}/{hashlib.sha1(b'10.0.0.1-22-None').hexdigest()[:10]}"
+
+
+@pytest.mark.parametrize("layout", ["default", "control_path", "ssh_args"])
+def test_live_controlmaster_skips_certificate_work(make_connection, expired_certificate, control_dir, layout):
+    options, calls_log_path = expired_certificate
+    master_options, control_path = control_master_options(control_dir, layout)
+    master = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    master.bind(control_path)
+    master.listen()
+    try:
+        connection = make_connection(**dict(options, **master_options))
+        assert connection._live_control_socket() == control_path
+        connection._connect()
+    finally:
+        master.close()
+
+    assert connection._controlmaster_reused
+    assert vault_calls(calls_log_path) == 0
+
+
+def test_stale_controlmaster_socket_renews_certificate(make_connection, expired_certificate, control_dir):
+    options, calls_log_path = expired_certificate
+    master_options, control_path = control_master_options(control_dir, "default")
+    # A master that died leaves its socket file behind, refusing connections
+    master = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    master.bind(control_path)
+    master.close()
+    assert os.path.exists(control_path)
+
+    connection = make_connection(**dict(options, **master_options))
+    assert connection._live_control_socket() is None
+    connection._connect()
+
+    assert not connection._controlmaster_reused
+    assert vault_calls(calls_log_path) == 1
+    assert make_connection(**options)._is_cert_fresh()[0]
+
+
+def test_controlmaster_ignored_without_controlpersist(make_connection, control_dir):
+    master_options, control_path = control_master_options(control_dir, "default")
+    master = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    master.bind(control_path)
+    master.listen()
+    try:
+        # Without ControlPersist ssh does not multiplex, whatever is listening at the path
+        assert make_connection(ssh_args="-o ControlMaster=auto", control_path_dir=control_dir)._live_control_socket() is None
+    finally:
+        master.close()
+
+
+def test_exclusive_file_lock_taken_over_from_dead_holder(vault_ssh_signer, tmp_path):
+    lock_path = tmp_path / "id_ed25519-cert.pub.lock"
+    lock_path.write_text(f"{dead_pid()}\n")
+    lock = vault_ssh_signer.CertificateLock(str(lock_path))
+
+    assert lock._acquire_exclusive_file(time.monotonic() + 1)
+    assert lock.holder_pid() == os.getpid()
+    assert lock.release()
+    assert not lock_path.exists()
+
+
+def test_exclusive_file_lock_waits_for_live_holder(vault_ssh_signer, tmp_path):
+    lock_path = tmp_path / "id_ed25519-cert.pub.lock"
+    lock_path.write_text(f"{os.getppid()}\n")
+    lock = vault_ssh_signer.CertificateLock(str(lock_path))
+
+    assert not lock._acquire_exclusive_file(time.monotonic() + 0.2)
+    assert lock_path.read_text() == f"{os.getppid()}\n"
+
+
+def test_certificate_with_all_requested_principals_is_fresh(make_connection, cert_fixtures, tmp_path):
+    public_key_path = cert_fixtures.write_key_pair(str(tmp_path))
+    cert_path = cert_fixtures.write_certificate(str(tmp_path / "id_ed25519-cert.pub"), public_key_path, ["ansible", "deploy"], 7200)
+
+    def is_fresh(principal):
+        connection = make_connection(public_key_path=public_key_path, signed_key_path=cert_path, vault_ssh_ca_principal=principal)
+        return connection._is_cert_fresh()[0]
+
+    assert is_fresh("ansible,deploy")
+    assert is_fresh("deploy, ansible")
+    assert is_fresh("ansible")
+    assert not is_fresh("ansible,root")
+
+
+def ssh_keygen_listing(cert_path):
+    """Returns the fields 'ssh-keygen -L' prints for cert_path, with times in UTC, and the listed principals."""
+    output = subprocess.run(["ssh-keygen", "-L", "-f", cert_path], env=dict(os.environ, TZ="UTC"),
+                            capture_output=True, text=True, check=True).stdout
+    fields, principals, field = {}, [], None
+    for line in output.splitlines()[1:]:
+        if line.startswith(" " * 9):
+            if field == "Principals" and line.strip() != "(none)":
+                principals.append(line.strip())
+            continue
+        field, _, value = line.strip().partition(":")
+        fields[field] = value.strip()
+    return fields, principals
+
+
+def ssh_keygen_validity(cert):
+    """Renders cert's validity the way 'ssh-keygen -L' does."""
+    def render(dt):
+        return dt.strftime("%Y-%m-%dT%H:%M:%S")
+
+    always = cert.valid_after.timestamp() == 0
+    forever = cert.valid_before == datetime.max.replace(tzinfo=timezone.utc)
+    if always and forever:
+        return "forever"
+    if forever:
+        return f"after {render(cert.valid_after)}"
+    if always:
+        return f"before {render(cert.valid_before)}"
+    return f"from {render(cert.valid_after)} to {render(cert.valid_before)}"
+
+
+@pytest.mark.parametrize("key_type, bits", [
+    ("rsa", None), ("ecdsa", 256), ("ecdsa", 384), ("ecdsa", 521), ("ed25519", None),
+])
+def test_certificate_parser_matches_ssh_keygen(vault_ssh_signer, ssh_ca, key_type, bits):
+    public_key_path = ssh_ca.make_key_pair(f"id_{key_type}{bits or ''}", key_type, bits)
+    for serial, (validity, principals) in enumerate([
+        ("-1m:+1h", ["ansible"]),
+        ("always:forever", ["ansible", "deploy"]),
+        ("20260101:forever", []),
+        ("always:20300101", ["root"]),
+        ("20260101120000:20260102120000", ["ansible"]),
+    ], start=1):
+        cert_path = ssh_ca.sign(public_key_path, principals, validity, serial=serial, key_id=f"cert {serial}")
+        with open(cert_path) as f:
+            cert = vault_ssh_signer.parse_ssh_certificate(f.read())
+        fields, listed_principals = ssh_keygen_listing(cert_path)
+
+        assert fields["Type"] == f"{cert.key_type} user certificate"
+        assert cert.cert_type == 1
+        assert cert.public_key_fingerprint == fields["Public key"].split()[1]
+        assert cert.key_id == fields["Key ID"].strip('"')
+        assert cert.serial == int(fields["Serial"]) == serial
+        assert list(cert.principals) == listed_principals == principals
+        assert ssh_keygen_validity(cert) == fields["Valid"], validity
+
+
+def test_certificate_parser_rejects_truncated_and_garbage_blobs(vault_ssh_signer, ssh_ca):
+    cert_path = ssh_ca.sign(ssh_ca.make_key_pair(), ["ansible"])
+    with open(cert_path) as f:
+        blob = base64.b64decode(f.read().split()[1])
+    vault_ssh_signer.parse_ssh_certificate_blob(blob)
+
+    # Every prefix that cuts into the fields the parser reads, and random bytes, fail with ValueError only
+    rng = random.Random(0)
+    candidates = [blob[:length] for length in range(len(blob))]
+    candidates += [rng.randbytes(rng.randrange(1, 400)) for _ in range(500)]
+    candidates += [blob[:4 + 32] + rng.randbytes(len(blob)) for _ in range(100)]
+    for candidate in candidates:
+        try:
+            vault_ssh_signer.parse_ssh_certificate_blob(candidate)
+        except ValueError:
+            pass
+
+    for text in ["", "garbage", "ssh-ed25519-cert-v01@openssh.com", "ssh-ed25519-cert-v01@openssh.com !!notbase64!!",
+                 "ssh-ed25519-cert-v01@openssh.com " + base64.b64encode(blob[:100]).decode("ascii")]:
+        with pytest.raises(ValueError):
+            vault_ssh_signer.parse_ssh_certificate(text)
+
+
+def test_certificate_past_datetime_range_is_rejected(vault_ssh_signer, cert_fixtures, tmp_path):
+    public_key_path = cert_fixtures.write_key_pair(str(tmp_path))
+    with open(public_key_path) as f:
+        public_key_line = f.read()
+    cert_text = cert_fixtures.make_ssh_certificate(public_key_line, ["ansible"], 0, 2 ** 63)
+    with pytest.raises(ValueError, match="invalid certificate timestamp"):
+        vault_ssh_signer.parse_ssh_certificate(cert_text)
+
+
+@pytest.mark.parametrize("contents", [
+    b"",
+    b"garbage\n",
+    b"ssh-ed25519-cert-v01@openssh.com AAAAIHNzaC1lZDI1NTE5LWNlcnQtdjAxQG9wZW5zc2guY29t\n",
+    bytes(range(256)),
+])
+def test_unparseable_certificate_file_is_renewed(make_connection, expired_certificate, contents):
+    options, calls_log_path = expired_certificate
+    with open(options["signed_key_path"], "wb") as f:
+        f.write(contents)
+
+    assert make_connection(**options)._is_cert_fresh() == (False, "certificate parse error")
+    assert make_connection(**options).warm_certificate()
+    assert vault_calls(calls_log_path) == 1
+    assert make_connection(**options)._is_cert_fresh() == (True, "fresh")
+
+
+@pytest.fixture
+def status_sidecar(make_connection, cert_fixtures, tmp_path):
+    """Returns a function reading the certificate through a new Connection, as a sibling fork that did not read it yet would.
+
+    The function returns (certificate, sidecar entry); the sidecar lives at '<cert>.status.json'.
+    """
+    public_key_path = cert_fixtures.write_key_pair(str(tmp_path))
+    cert_path = cert_fixtures.write_certificate(str(tmp_path / "id_ed25519-cert.pub"), public_key_path, ["ansible"], 7200)
+
+    def read():
+        connection = make_connection(public_key_path=public_key_path, signed_key_path=cert_path)
+        sys.modules[type(connection).__module__].Connection._cert_status_cache.clear()
+        cert = connection._read_signed_cert()
+        with open(read.sidecar_path) as f:
+            return cert, json.load(f)
+
+    read.cert_path = cert_path
+    read.public_key_path = public_key_path
+    read.sidecar_path = cert_path + ".status.json"
+    return read
+
+
+def rewrite_sidecar(sidecar_path, **fields):
+    with open(sidecar_path) as f:
+        entry = json.load(f)
+    entry.update(fields)
+    with open(sidecar_path, "w") as f:
+        json.dump(entry, f)
+
+
+def test_status_sidecar_reused_for_same_certificate_file(status_sidecar):
+    cert, entry = status_sidecar()
+    st = os.stat(status_sidecar.cert_path)
+    assert entry["file"] == [st.st_ino, st.st_mtime_ns, st.st_size]
+    assert entry["serial"] == cert.serial == 1
+
+    # Sibling readers trust the sidecar while the certificate file is unchanged, without parsing the certificate again
+    rewrite_sidecar(status_sidecar.sidecar_path, serial=99)
+    assert status_sidecar()[0].serial == 99
+
+
+def test_status_sidecar_ignored_after_certificate_replaced(status_sidecar, cert_fixtures):
+    status_sidecar()
+    rewrite_sidecar(status_sidecar.sidecar_path, serial=99)
+    # A renewal writes a new file in place, which changes its identity even when it has the same size
+    replacement_path = cert_fixtures.write_certificate(status_sidecar.cert_path + ".new", status_sidecar.public_key_path,
+                                                       ["ansible"], 7200)
+    os.replace(replacement_path, status_sidecar.cert_path)
+
+    cert, entry = status_sidecar()
+    st = os.stat(status_sidecar.cert_path)
+    assert cert.serial == entry["serial"] == 1
+    assert entry["file"] == [st.st_ino, st.st_mtime_ns, st.st_size]
+
+
+def test_status_sidecar_ignored_after_certificate_mtime_changed(status_sidecar):
+    status_sidecar()
+    rewrite_sidecar(status_sidecar.sidecar_path, serial=99)
+    st = os.stat(status_sidecar.cert_path)
+    os.utime(status_sidecar.cert_path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+
+    cert, entry = status_sidecar()
+    assert cert.serial == entry["serial"] == 1
+    assert entry["file"][1] == st.st_mtime_ns + 1_000_000_000
+
+
+@pytest.mark.parametrize("corruption", [
+    "",
+    "{not json",
+    "[]",
+    '{"file": null}',
+    "matching file, missing fields",
+    "matching file, bad principals",
+    "matching file, bad timestamp",
+])
+def test_corrupt_status_sidecar_ignored_and_rewritten(status_sidecar, corruption):
+    _, entry = status_sidecar()
+    if corruption.startswith("matching file"):
+        if "missing" in corruption:
+            entry = {"file": entry["file"]}
+        elif "principals" in corruption:
+            entry["principals"] = 5
+        else:
+            entry["valid_before"] = "tomorrow"
+        corruption = json.dumps(entry)
+    with open(status_sidecar.sidecar_path, "w") as f:
+        f.write(corruption)
+
+    cert, rewritten = status_sidecar()
+    assert cert.serial == 1 and cert.principals == ("ansible",)
+    assert rewritten["serial"] == 1 and rewritten["principals"] == ["ansible"]
+
+
+def test_renewal_agent_uses_connection_private_key(make_connection, cert_fixtures, tmp_path, monkeypatch):
+    public_key_path = cert_fixtures.write_key_pair(str(tmp_path))
+    private_key_path = str(tmp_path / "inventory_key")
+    connection = make_connection(public_key_path=public_key_path, signed_key_path=str(tmp_path / "id_ed25519-cert.pub"),
+                                 private_key_file=private_key_path, renewal_agent=True)
+    plugin_module = sys.modules[type(connection).__module__]
+    started = []
+
+    class FakePopen:
+        pid = 4242
+
+        def __init__(self, command, **kwargs):
+            started.append(command)
+
+    monkeypatch.setattr(plugin_module.subprocess, "Popen", FakePopen)
+    connection._ensure_renewal_agent()
+    command = started[0]
+    assert command[command.index("--private-key-file") + 1] == private_key_path
+
+    # The agent configures its connection with that key
+    agent_options = {}
+
+    def run_renewal_agent(agent_connection, watch_pid=None):
+        agent_options["private_key_file"] = agent_connection.get_option("private_key_file")
+        return 0
+
+    monkeypatch.setattr(plugin_module, "run_renewal_agent", run_renewal_agent)
+    monkeypatch.setattr(sys, "argv", command[1:])
+    with pytest.raises(SystemExit) as excinfo:
+        plugin_module.main()
+    assert excinfo.value.code == 0
+    assert agent_options["private_key_file"] == private_key_path
+
+
+def write_signing_vault(bin_dir, ssh_ca, calls_log_path):
+    """Writes a 'vault' CLI stand-in that signs with ssh_ca for two hours, giving each certificate the next serial."""
+    path = os.path.join(bin_dir, "vault")
+    with open(path, "w") as f:
+        f.write(f"""#!{sys.executable}
+import os, shutil, subprocess, sys, tempfile
+args = dict(arg.split("=", 1) for arg in sys.argv[1:] if "=" in arg and not arg.startswith("-"))
+with open({str(calls_log_path)!r}, "a+") as log:
+    log.seek(0)
+    serial = len(log.readlines()) + 1
+    log.write(f"{{os.getpid()}}\\n")
+work_dir = tempfile.mkdtemp()
+shutil.copy(args["public_key"].lstrip("@"), os.path.join(work_dir, "key.pub"))
+subprocess.run(["ssh-keygen", "-q", "-s", {ssh_ca.key_path!r}, "-I", "vault", "-n", args["valid_principals"],
+                "-V", "-1m:+2h", "-z", str(serial), os.path.join(work_dir, "key.pub")], check=True)
+print(open(os.path.join(work_dir, "key-cert.pub")).read().strip())
+shutil.rmtree(work_dir)
+""")
+    os.chmod(path, 0o755)
+
+
+@pytest.fixture
+def managed_agent(ssh_ca, tmp_path, monkeypatch):
+    """Returns options for a connection loading certificates from a 'vault' signing with ssh_ca into a managed ssh-agent.
+
+    The agent is stopped afterwards.
+    """
+    if shutil.which("ssh-agent") is None:
+        pytest.skip("ssh-agent is not installed")
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    write_signing_vault(str(bin_dir), ssh_ca, tmp_path / "vault-calls.log")
+    monkeypatch.setenv("PATH", str(bin_dir) + os.pathsep + os.environ.get("PATH", ""))
+    monkeypatch.setenv("VAULT_ADDR", "http://127.0.0.1:8200")
+    monkeypatch.delenv("SSH_AUTH_SOCK", raising=False)
+    # A short directory: UNIX socket paths are limited to about 100 bytes
+    socket_dir = tempfile.mkdtemp(prefix="agent-")
+    agent_socket = os.path.join(socket_dir, "agent.sock")
+    yield {
+        "public_key_path": ssh_ca.make_key_pair(),
+        "signed_key_path": str(tmp_path / "id_ed25519-cert.pub"),
+        "ssh_agent": "managed",
+        "ssh_agent_socket": agent_socket,
+        "vault_client": "cli",
+        "control_path_dir": str(tmp_path / "cp"),
+        "renewal_lock_timeout_seconds": 5,
+    }
+    if os.path.exists(agent_socket + ".pid"):
+        with open(agent_socket + ".pid") as f:
+            os.kill(int(f.read()), signal.SIGTERM)
+    shutil.rmtree(socket_dir, ignore_errors=True)
+
+
+def agent_certificates(vault_ssh_signer, agent_socket):
+    certificates = []
+    for blob, _ in vault_ssh_signer.ssh_agent_identities(agent_socket):
+        try:
+            certificates.append(vault_ssh_signer.parse_ssh_certificate_blob(blob))
+        except ValueError:
+            pass
+    return certificates
+
+
+def test_managed_agent_started_once_and_passed_to_ssh_only(vault_ssh_signer, make_connection, managed_agent, monkeypatch):
+    agent_socket = make_connection(**managed_agent)._ensure_ssh_agent()
+    with open(agent_socket + ".pid") as f:
+        agent_pid = f.read()
+
+    connection = make_connection(**managed_agent)
+    assert connection._ensure_ssh_agent() == agent_socket
+    with open(agent_socket + ".pid") as f:
+        assert f.read() == agent_pid
+    assert vault_ssh_signer.ssh_agent_identities(agent_socket) == []
+    # ssh gets the agent in its environment; the controller's environment is left alone
+    assert "SSH_AUTH_SOCK" not in os.environ
+    # Stands in for the ssh plugin's own command line, whose options differ between ansible-core releases
+    monkeypatch.setattr(vault_ssh_signer.SSHConnection, "_build_command",
+                        lambda self, binary, subsystem, *other_args: [binary.encode(), *(arg.encode() for arg in other_args)])
+    command = connection._build_command("ssh", "ssh", "10.0.0.1", "true")
+    assert command == [b"env", f"SSH_AUTH_SOCK={agent_socket}".encode(), b"ssh", b"10.0.0.1", b"true"]
+
+
+def test_managed_agent_not_started_after_lock_timeout(vault_ssh_signer, make_connection, managed_agent, monkeypatch):
+    from ansible.errors import AnsibleConnectionFailure
+
+    connection = make_connection(**dict(managed_agent, renewal_lock_timeout_seconds=1))
+    plugin_module = sys.modules[type(connection).__module__]
+    started = []
+    monkeypatch.setattr(plugin_module.subprocess, "run", lambda command, **kwargs: started.append(command))
+    # Another process is (still) starting the agent
+    holder = vault_ssh_signer.CertificateLock(managed_agent["ssh_agent_socket"] + ".lock")
+    assert holder.acquire(1)
+    try:
+        with pytest.raises(AnsibleConnectionFailure, match="waiting for PID"):
+            connection._ensure_ssh_agent()
+    finally:
+        holder.release()
+    assert started == []
+
+
+def test_renewal_replaces_certificate_in_agent(vault_ssh_signer, make_connection, managed_agent):
+    agent_socket = managed_agent["ssh_agent_socket"]
+
+    assert make_connection(**managed_agent).warm_certificate()
+    assert [cert.serial for cert in agent_certificates(vault_ssh_signer, agent_socket)] == [1]
+    assert not make_connection(**managed_agent).warm_certificate()
+
+    assert make_connection(**dict(managed_agent, force_key_refresh=True)).warm_certificate()
+    # The renewed certificate took the place of the first one, next to the private key
+    assert [cert.serial for cert in agent_certificates(vault_ssh_signer, agent_socket)] == [2]
+    assert len(vault_ssh_signer.ssh_agent_identities(agent_socket)) == 2
+    assert make_connection(**managed_agent)._is_cert_fresh()[0]
+
+
+def test_renewal_keeps_certificates_for_other_principals_in_agent(vault_ssh_signer, make_connection, managed_agent):
+    agent_socket = managed_agent["ssh_agent_socket"]
+
+    assert make_connection(**managed_agent).warm_certificate()
+    assert make_connection(**dict(managed_agent, vault_ssh_ca_principal="deploy")).warm_certificate()
+
+    assert sorted(cert.principals for cert in agent_certificates(vault_ssh_signer, agent_socket)) == [("ansible",), ("deploy",)]
+
+
+@pytest.fixture
+def warmup_inventory(cert_fixtures, tmp_path, monkeypatch):
+    """Returns (inventory path, calls_log_path) for hosts signing through the stub 'vault', one certificate per identity."""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    calls_log_path = tmp_path / "vault-calls.log"
+    cert_fixtures.write_stub_vault(str(bin_dir), str(calls_log_path))
+    monkeypatch.setenv("PATH", str(bin_dir) + os.pathsep + os.environ.get("PATH", ""))
+    monkeypatch.setenv("VAULT_ADDR", "http://127.0.0.1:8200")
+    inventory_path = tmp_path / "inventory.yml"
+    inventory_path.write_text(json.dumps({"all": {
+        "hosts": {"legacy-1": {}},
+        "children": {"managed": {
+            "vars": {
+                "vault_ssh_ca_signing_role": "ssh-client-signer/roles/deploy",
+                "vault_ssh_public_key_path": cert_fixtures.write_key_pair(str(tmp_path)),
+                "vault_ssh_cert_store_dir": str(tmp_path / "certs"),
+                "vault_ssh_client": "cli",
+                "vault_ssh_timings_file": "",
+            },
+            "hosts": {
+                "web-1": {"vault_ssh_ca_principal": "ansible"},
+                "web-2": {"vault_ssh_ca_principal": "ansible"},
+                "db-1": {"vault_ssh_ca_principal": "deploy"},
+                "broken-1": {"vault_ssh_ca_principal": "ansible", "vault_ssh_key_min_ttl_seconds": "soon"},
+            },
+        }},
+    }}))
+    return inventory_path, calls_log_path
+
+
+def test_warmup_signs_each_identity_once(vault_ssh_signer, make_connection, warmup_inventory):
+    from ansible.plugins.loader import connection_loader
+    inventory_path, calls_log_path = warmup_inventory
+
+    connection_groups, errors = vault_ssh_signer.warmup_connections(connection_loader, [str(inventory_path)])
+    # web-1 and web-2 share one identity; legacy-1 doesn't use the plugin
+    assert sorted(connection._resolved_vault_ssh_ca_principal for group in connection_groups for connection in group) == ["ansible", "deploy"]
+    assert list(errors) == ["broken-1"]
+
+    results = vault_ssh_signer.warmup_certificates(connection_groups, max_workers=2)
+    assert sorted(results.items()) == [
+        (f"ssh-client-signer/sign/deploy {principal} {connection_groups[0][0]._resolved_public_key_path}", "renewed")
+        for principal in ("ansible", "deploy")
+    ]
+    assert vault_calls(calls_log_path) == 2
+
+    connection_groups, _ = vault_ssh_signer.warmup_connections(connection_loader, [str(inventory_path)], limit="web-*")
+    assert list(vault_ssh_signer.warmup_certificates(connection_groups).values()) == ["fresh"]
+    assert vault_calls(calls_log_path) == 2
+
+
+def test_warmup_reports_shared_certificate_file(vault_ssh_signer, warmup_inventory, tmp_path):
+    from ansible.plugins.loader import connection_loader
+    inventory_path, calls_log_path = warmup_inventory
+    inventory = json.loads(inventory_path.read_text())
+    managed = inventory["all"]["children"]["managed"]
+    del managed["vars"]["vault_ssh_cert_store_dir"]
+    managed["vars"]["vault_ssh_signed_key_path"] = str(tmp_path / "id_ed25519-cert.pub")
+    inventory_path.write_text(json.dumps(inventory))
+
+    connection_groups, _ = vault_ssh_signer.warmup_connections(connection_loader, [str(inventory_path)])
+    # Both identities would be written to one file, so they are renewed in turn by one worker
+    assert [len(group) for group in connection_groups] == [2]
+    assert set(vault_ssh_signer.warmup_certificates(connection_groups).values()) == {"renewed"}
+    assert vault_calls(calls_log_path) == 2
+
+
+def test_warmup_certs_package_script(warmup_inventory):
+    inventory_path, calls_log_path = warmup_inventory
+    ansible_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+    with open(os.path.join(ansible_dir, "package.json")) as f:
+        command = json.load(f)["scripts"]["warmup-certs"]
+
+    def warmup(*args):
+        return subprocess.run(["sh", "-c", command + ' "$@"', "warmup-certs", *args], cwd=ansible_dir,
+                              capture_output=True, text=True)
+
+    result = warmup("-i", str(inventory_path), "--limit", "web-*,db-*")
+    assert result.returncode == 0, result.stderr
+    assert sorted(json.loads(result.stdout).values()) == ["renewed", "renewed"]
+
+    # A host whose options are invalid fails the warmup, after the others were warmed
+    result = warmup("-i", str(inventory_path))
+    assert result.returncode == 1
+    outcomes = json.loads(result.stdout)
+    assert sorted(outcome for label, outcome in outcomes.items() if label != "host broken-1") == ["fresh", "fresh"]
+    assert "soon" in outcomes["host broken-1"]
+    assert vault_calls(calls_log_path) == 2
@@ -0,0 +1,180 @@
+"""Tests for the timings of plugins/connection/vault_ssh_signer.py and their summary in plugins/callback/vault_ssh_timings.py."""
+
+import json
+import multiprocessing
+import os
+import sys
+import threading
+
+import pytest
+
+ANSIBLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+@pytest.fixture
+def timings_callback(monkeypatch, tmp_path):
+    """Returns (callback, displayed lines) for a vault_ssh_timings callback reading tmp_path/timings.jsonl."""
+    pytest.importorskip("ansible")
+    from ansible.plugins.loader import callback_loader
+    callback_loader.add_directory(os.path.join(ANSIBLE_DIR, "plugins", "callback"))
+    # set_options exports the timings file to the workers; restore the environment afterwards
+    monkeypatch.setenv("ANSIBLE_VAULT_SSH_TIMINGS_FILE", "")
+    callback = callback_loader.get("vault_ssh_timings")
+    callback.set_options(direct={"timings_file": str(tmp_path / "timings.jsonl")})
+    displayed = []
+    monkeypatch.setattr(callback._display, "display", lambda msg, *args, **kwargs: displayed.append(msg))
+    monkeypatch.setattr(callback._display, "banner", lambda msg, *args, **kwargs: displayed.append(msg))
+    return callback, displayed
+
+
+@pytest.fixture
+def vault_ssh_timings(timings_callback):
+    """The callback plugin's module, as loaded by Ansible."""
+    return sys.modules[type(timings_callback[0]).__module__]
+
+
+def timing_record(ppid, phases, renewed=False, lock_timeout=False, controlmaster_reuse=False):
+    return {"ppid": ppid, "host": "10.0.0.1", "phases": phases, "renewed": renewed, "lock_timeout": lock_timeout,
+            "controlmaster_reuse": controlmaster_reuse}
+
+
+def _append_records_in_fork(append_timing_record, timings_path, count):
+    for index in range(count):
+        # Padding makes each line larger than a pipe buffer, so interleaved writes would show as broken lines
+        append_timing_record(timings_path, dict(timing_record(os.getppid(), {"vault_request": index / 1000.0}),
+                                                padding="x" * 8192))
+
+
+def _update_textfile_in_fork(update_prometheus_textfile, textfile_path, seconds):
+    assert update_prometheus_textfile(textfile_path, timing_record(os.getppid(), {"vault_request": seconds}, renewed=True))
+
+
+def test_percentile_is_nearest_rank(vault_ssh_timings):
+    timings = vault_ssh_timings
+    values = [float(value) for value in range(1, 101)]
+    assert timings.percentile(values, 50) == 50.0
+    assert timings.percentile(values, 95) == 95.0
+    assert timings.percentile(values, 100) == 100.0
+    assert timings.percentile([0.5], 50) == timings.percentile([0.5], 95) == 0.5
+    assert timings.percentile([1.0, 2.0, 3.0], 50) == 2.0
+    assert timings.percentile([1.0, 2.0, 3.0], 95) == 3.0
+
+
+def test_summary_per_phase_and_counters(vault_ssh_timings):
+    timings = vault_ssh_timings
+    records = [timing_record(1, {"freshness_check": seconds / 100.0}) for seconds in range(20, 0, -1)]
+    records[0]["phases"]["vault_request"] = 0.4
+    records[0]["renewed"] = True
+    records[1].update(lock_timeout=True, controlmaster_reuse=True)
+
+    phases, counters = timings.summarise_timings(records)
+
+    count, total, p50, p95, maximum = phases["freshness_check"]
+    assert (count, p50, p95, maximum) == (20, 0.10, 0.19, 0.20)
+    assert total == pytest.approx(2.1)
+    assert phases["vault_request"] == (1, 0.4, 0.4, 0.4, 0.4)
+    assert counters == {"connections": 20, "renewed": 1, "lock_timeout": 1, "controlmaster_reuse": 1}
+
+
+def test_summary_reads_only_this_runs_workers(vault_ssh_signer, timings_callback, tmp_path):
+    callback, displayed = timings_callback
+    timings_path = str(tmp_path / "timings.jsonl")
+    vault_ssh_signer.append_timing_record(timings_path, timing_record(os.getpid(), {"vault_request": 0.25}, renewed=True))
+    vault_ssh_signer.append_timing_record(timings_path, timing_record(os.getpid(), {"vault_request": 0.75}))
+    # An earlier run sharing the same timings file, and a line cut short by a crashed worker
+    vault_ssh_signer.append_timing_record(timings_path, timing_record(os.getpid() + 1, {"vault_request": 60.0}, renewed=True))
+    with open(timings_path, "a") as f:
+        f.write('{"ppid": %d, "phases": {"vault_' % os.getpid())
+
+    assert [record["phases"]["vault_request"] for record in callback._read_records()] == [0.25, 0.75]
+
+    callback.v2_playbook_on_stats(None)
+    assert displayed[0] == "VAULT SSH SIGNER TIMINGS"
+    assert displayed[2].split() == ["vault_request", "2", "1.000s", "0.2500s", "0.7500s", "0.7500s"]
+    assert displayed[-1] == "connections: 2, renewals: 1, lock timeouts: 0, ControlMaster reuse: 0"
+    # The file was configured, not created for this run, so it stays
+    assert os.path.exists(timings_path)
+
+
+def test_timing_records_from_concurrent_forks_stay_whole(vault_ssh_signer, timings_callback, tmp_path):
+    callback, _ = timings_callback
+    timings_path = str(tmp_path / "timings.jsonl")
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=_append_records_in_fork, args=(vault_ssh_signer.append_timing_record, timings_path, 25))
+                 for _ in range(8)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+
+    with open(timings_path) as f:
+        lines = f.read().splitlines()
+    assert len(lines) == 200
+    assert all(json.loads(line)["ppid"] == os.getpid() for line in lines)
+    assert len(callback._read_records()) == 200
+
+
+def test_prometheus_textfile_aggregates_concurrent_forks(vault_ssh_signer, tmp_path):
+    textfile_path = str(tmp_path / "vault_ssh_signer.prom")
+    seconds = [0.001, 0.02, 0.3, 0.3, 4.0, 45.0, 120.0, 0.005]
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=_update_textfile_in_fork, args=(vault_ssh_signer.update_prometheus_textfile, textfile_path, value))
+                 for value in seconds]
+
+    # node_exporter may read the textfile at any moment: every read must see a complete file
+    reads, stop = [], threading.Event()
+
+    def scrape():
+        while not stop.is_set():
+            try:
+                with open(textfile_path) as f:
+                    reads.append(f.read())
+            except FileNotFoundError:
+                pass
+
+    scraper = threading.Thread(target=scrape)
+    scraper.start()
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+    stop.set()
+    scraper.join()
+
+    assert [process.exitcode for process in processes] == [0] * len(seconds)
+    with open(textfile_path) as f:
+        textfile = f.read()
+    # One phase and the same counters throughout, so a complete file always has as many lines, ending with the last counter
+    assert reads and all(len(read.splitlines()) == len(textfile.splitlines()) for read in reads)
+    assert all(read.rsplit("\n", 2)[1].startswith("vault_ssh_signer_renewals_total ") for read in reads)
+    metrics = dict(line.rsplit(" ", 1) for line in textfile.splitlines() if not line.startswith("#"))
+    assert metrics['vault_ssh_signer_phase_seconds_bucket{phase="vault_request",le="0.005"}'] == "2"
+    assert metrics['vault_ssh_signer_phase_seconds_bucket{phase="vault_request",le="0.5"}'] == "5"
+    assert metrics['vault_ssh_signer_phase_seconds_bucket{phase="vault_request",le="60"}'] == "7"
+    assert metrics['vault_ssh_signer_phase_seconds_bucket{phase="vault_request",le="+Inf"}'] == "8"
+    assert float(metrics['vault_ssh_signer_phase_seconds_sum{phase="vault_request"}']) == pytest.approx(sum(seconds))
+    assert metrics["vault_ssh_signer_connections_total"] == "8"
+    assert metrics["vault_ssh_signer_renewals_total"] == "8"
+    assert sorted(os.listdir(tmp_path)) == ["vault_ssh_signer.prom", "vault_ssh_signer.prom.lock", "vault_ssh_signer.prom.state.json"]
+
+
+def test_prometheus_textfile_kept_when_replacing_it_fails(vault_ssh_signer, tmp_path, monkeypatch):
+    textfile_path = str(tmp_path / "vault_ssh_signer.prom")
+    assert vault_ssh_signer.update_prometheus_textfile(textfile_path, timing_record(os.getpid(), {"vault_request": 0.1}))
+    with open(textfile_path) as f:
+        before = f.read()
+
+    replace = os.replace
+
+    def failing_replace(src, dst):
+        if dst == textfile_path:
+            raise OSError(28, "No space left on device")
+        replace(src, dst)
+
+    monkeypatch.setattr(os, "replace", failing_replace)
+    with pytest.raises(OSError):
+        vault_ssh_signer.update_prometheus_textfile(textfile_path, timing_record(os.getpid(), {"vault_request": 0.2}))
+
+    with open(textfile_path) as f:
+        assert f.read() == before
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]